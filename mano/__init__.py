@@ -15,6 +15,7 @@ from mano.mano import (
     interval,
     studies,
     keyring,
+    keyrings,
     keyring_from_env,
     expand_study_id,
     login,
@@ -46,6 +47,7 @@ __all__ = [
     "interval",
     "studies",
     "keyring",
+    "keyrings",
     "keyring_from_env",
     "expand_study_id",
     "login",
@@ -0,0 +1,255 @@
+"""
+Lazy archive mode: keep downloaded archives on disk and extract members on demand
+
+`mano.sync.download` can write each downloaded archive to an archive directory, named after the
+SHA-256 of its content (so downloading the same archive twice keeps one copy) or after the request.
+`ArchiveTree` indexes every kept archive and resolves `<user_id>/<data_stream>/<timestamp>` paths
+to archive members, which are only decompressed when they are read. Archives are memory mapped, so
+reading a few members never reads the rest of the archive. `ArchiveTree.materialize` extracts
+members into the classic directory layout with `mano.sync.save` whenever that is needed.
+"""
+import hashlib
+import io
+import logging
+import mmap
+import os
+import re
+import zipfile
+from collections.abc import Iterator
+from typing import IO, cast
+
+from mano.storage import Storage
+
+ARCHIVE_EXT = '.zip'
+# damaged downloads are set aside as <name>.zip.bad
+BAD_EXT = '.bad'
+# timestamps in archive names avoid characters that are not allowed in file names on Windows
+NAME_TIME_FORMAT = '%Y-%m-%dT%H_%M_%S'
+
+# members are named like <user_id>/gps/2018-06-15 16_00_00.csv, registry keys use ISO timestamps
+ISO_EXPR = re.compile(r'(\d{4}-\d{2}-\d{2})T(\d{2}):(\d{2}):(\d{2})')
+EXTENSION_EXPR = re.compile(r'\.[a-zA-Z0-9]+$')
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def open_archive(path: str) -> zipfile.ZipFile:
+    """
+    Open a kept archive through a read-only memory map. The archive keeps a descriptor of the file,
+    so `mano.sync.save` can copy stored members with the kernel.
+    """
+    return _open(path, descriptor=True)[0]
+
+
+def _open(path: str, descriptor: bool = False) -> tuple[zipfile.ZipFile, mmap.mmap]:
+    with open(path, 'rb') as fo:
+        if os.fstat(fo.fileno()).st_size == 0:
+            raise ArchiveError(f'empty archive {path}')
+        # the map stays valid after the file is closed
+        mm = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        # a descriptor of the mapped file, the path may be replaced by a later download
+        fd = os.dup(fo.fileno()) if descriptor else None
+    try:
+        archive = zipfile.ZipFile(cast(IO[bytes], _MappedFile(mm, fd)))
+    except zipfile.BadZipFile:
+        mm.close()
+        if fd is not None:
+            os.close(fd)
+        raise
+    # zipfile only knows the path of archives it opened itself
+    archive.filename = path
+    return archive, mm
+
+
+class _MappedFile(io.RawIOBase):
+    """
+    Seekable read-only file object over a memory map (mmap objects are not seekable file objects
+    before Python 3.13)
+    """
+
+    def __init__(self, mm: mmap.mmap, fd: int | None = None):
+        """
+        :param fd: Read-only descriptor of the mapped file, closed with this file object
+        """
+        self._mm = mm
+        self._fd = fd
+
+    def fileno(self) -> int:
+        if self._fd is None:
+            raise io.UnsupportedOperation('no file descriptor')
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        super().close()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> bytes:
+        return self._mm.read(size)
+
+    def readinto(self, buffer) -> int:
+        content = self._mm.read(len(buffer))
+        buffer[:len(content)] = content
+        return len(content)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._mm.seek(offset, whence)  # type: ignore[arg-type]
+        return self._mm.tell()
+
+    def tell(self) -> int:
+        return self._mm.tell()
+
+
+def keep(fileobj: IO[bytes], archive_dir: str, name: str | None = None, digest: str | None = None) -> str:
+    """
+    Move a downloaded archive, written to a temporary file in `archive_dir`, to its final name
+
+    :param fileobj: Closed temporary file object
+    :param name: Archive name, defaults to the SHA-256 of the content
+    :param digest: SHA-256 of the content if it was computed while downloading
+    :returns: Archive path
+    """
+    content_addressed = not name
+    if not name:
+        if not digest:
+            sha256 = hashlib.sha256()
+            with open(fileobj.name, 'rb') as fo:
+                for chunk in iter(lambda: fo.read(1024 * 1024), b''):
+                    sha256.update(chunk)
+            digest = sha256.hexdigest()
+        name = digest
+    path = os.path.join(archive_dir, name + ARCHIVE_EXT)
+    if content_addressed and os.path.exists(path):
+        # the same archive was already kept
+        os.remove(fileobj.name)
+    else:
+        os.replace(fileobj.name, path)
+    return path
+
+
+def normalize(path: str) -> str:
+    """
+    Normalize a virtual path e.g., `<user_id>/gps/2018-06-15T16:00:00` or the member name
+    `<user_id>/gps/2018-06-15 16_00_00.csv` to `<user_id>/gps/2018-06-15 16_00_00`
+    """
+    path = ISO_EXPR.sub(r'\1 \2_\3_\4', path.strip('/'))
+    return EXTENSION_EXPR.sub('', path)
+
+
+class ArchiveTree:
+    """
+    Virtual tree of the members of every archive in `archive_dir`. When several archives contain
+    the same member, the most recently downloaded one wins.
+    """
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = os.path.expanduser(archive_dir)
+        self._archives: dict[str, zipfile.ZipFile] = {}
+        self._maps: dict[str, mmap.mmap] = {}
+        self._members: dict[str, tuple[str, str]] = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Index archives added since the tree was created. Kept archives never change, so archives
+        that are already indexed are not read again.
+        """
+        if not os.path.isdir(self.archive_dir):
+            return
+        entries = [entry for entry in os.scandir(self.archive_dir)
+                   if entry.name.endswith(ARCHIVE_EXT) and not entry.name.startswith('.')]
+        for entry in sorted(entries, key=lambda entry: (entry.stat().st_mtime, entry.name)):
+            if entry.path in self._archives:
+                continue
+            try:
+                archive, self._maps[entry.path] = _open(entry.path)
+            except (zipfile.BadZipFile, ArchiveError, OSError) as e:
+                logger.warning(f'skipping archive {entry.path} that cannot be opened: {e}')
+                continue
+            self._archives[entry.path] = archive
+            for info in archive.infolist():
+                if info.filename == 'registry' or info.is_dir():
+                    continue
+                self._members[normalize(info.filename)] = (entry.path, info.filename)
+
+    def archives(self) -> list[str]:
+        return list(self._archives)
+
+    def paths(self, prefix: str = '') -> Iterator[str]:
+        """
+        Iterate over virtual paths starting with a prefix e.g., `<user_id>/gps/2018-06-15`
+        """
+        prefix = normalize(prefix) if prefix else ''
+        for path in sorted(self._members):
+            if path.startswith(prefix):
+                yield path
+
+    def resolve(self, path: str) -> tuple[str, str]:
+        """
+        Resolve a virtual path to an (archive path, member name) pair
+        """
+        try:
+            return self._members[normalize(path)]
+        except KeyError:
+            raise FileNotFoundError(f'no archive member for {path}')
+
+    def member(self, path: str) -> str:
+        return self.resolve(path)[1]
+
+    def open(self, path: str) -> IO[bytes]:
+        """
+        Open a member for reading, it is decompressed as it is read
+        """
+        archive_path, member = self.resolve(path)
+        return self._archives[archive_path].open(member)
+
+    def read(self, path: str) -> bytes:
+        with self.open(path) as fo:
+            return fo.read()
+
+    def materialize(self, output_dir: str, user_id: str, lock: list[str] | None = None,
+                    passphrase: str | None = None, compress: dict[str, str] | None = None,
+                    storage: Storage | None = None) -> int:
+        """
+        Save every archive containing members of a user into the classic layout with `mano.sync.save`
+
+        :returns: Number of files saved
+        """
+        # deferred import, mano.sync imports this module
+        from mano.sync import save
+        num_saved = 0
+        # oldest first, so members of newer archives replace older ones
+        for archive in self._archives.values():
+            if not any(name.startswith(f'{user_id}/') for name in archive.namelist()):
+                continue
+            # save does not use the keyring
+            num_saved += save({}, archive, user_id, output_dir, lock, passphrase, compress=compress,
+                              storage=storage)
+        return num_saved
+
+    def close(self):
+        for archive in self._archives.values():
+            archive.close()
+        # zipfile does not close file objects it was given
+        for mm in self._maps.values():
+            mm.close()
+        self._archives.clear()
+        self._maps.clear()
+        self._members.clear()
+
+    def __enter__(self) -> 'ArchiveTree':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
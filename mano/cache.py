@@ -0,0 +1,197 @@
+"""
+Persistent cache of parsed API metadata responses e.g., study and user lists
+
+Entries are keyed by request method, URL and parameters. A cached entry is revalidated with the
+ETag or Last-Modified header the server sent with it. Servers that send neither are detected by a
+hash of the response content, which is streamed into a spill buffer in the cache directory while it
+is hashed, so an unchanged response is never parsed twice nor held in memory. Entries are written
+atomically and evicted least recently used first once the cache grows past `max_size`, which makes
+one cache directory safe to share between processes. Each process keeps a running total of the
+cache size and only walks the cache directory when that total says there is something to evict.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from collections.abc import Callable
+from typing import IO, Any
+
+import requests
+
+import mano.client as client
+import mano.fileio as fileio
+import mano.memory as memory
+from mano.locking import FileLock
+
+CACHE_DIR = '~/.cache/mano'
+MAX_SIZE = 64 * 1024 * 1024
+ENTRY_EXT = '.json'
+LOCK_FILE = '.lock'
+# bytes read from streamed responses at a time
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    """
+    On-disk cache of parsed responses under `cache_dir`
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR, max_size: int = MAX_SIZE):
+        """
+        :param cache_dir: Cache directory, shared by every process using the cache
+        :param max_size: Evict entries once the cache is larger than this many bytes
+        """
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # running total of the cache size, None until the cache directory was walked once
+        self._size: int | None = None
+
+    def key(self, method: str, url: str, params: dict[str, str]) -> str:
+        """
+        Get the cache key for a request. Parameters are hashed, so credentials in them are not stored.
+        """
+        content = json.dumps([method.upper(), url, sorted(params.items())])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ENTRY_EXT)
+
+    def get(self, key: str) -> dict | None:
+        try:
+            with open(self.path(key), encoding='utf-8') as fo:
+                return json.load(fo)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, key: str, entry: dict):
+        filename = self.path(key)
+        if not os.path.exists(os.path.dirname(filename)):
+            fileio.makedirs(os.path.dirname(filename), umask=0o077)
+        try:
+            replaced = os.path.getsize(filename)
+        except FileNotFoundError:
+            replaced = 0
+        content = json.dumps(entry).encode('utf-8')
+        fileio.atomic_write(filename, content, permissions=0o0600)
+        if self._size is not None:
+            self._size += len(content) - replaced
+        if self._size is None or self._size > self.max_size:
+            self.evict()
+
+    def touch(self, key: str):
+        """
+        Mark an entry as recently used
+        """
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> int:
+        """
+        Remove least recently used entries until the cache is no larger than `max_size`, and reset the
+        running total to what is left
+
+        :returns: Number of entries removed
+        """
+        entries = []
+        total = 0
+        with FileLock(os.path.join(self.cache_dir, LOCK_FILE)):
+            for dirpath, _, filenames in os.walk(self.cache_dir):
+                for filename in filenames:
+                    if not filename.endswith(ENTRY_EXT):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+            num_removed = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                num_removed += 1
+        self._size = total
+        if num_removed:
+            logger.debug(f'evicted {num_removed} cache entries')
+        return num_removed
+
+    def fetch(self, method: str, url: str, params: dict[str, str], parse: Callable[[requests.Response], Any],
+              **kwargs) -> Any:
+        """
+        Send a request and parse the response, unless the cached response is still current
+
+        :param params: Parameters identifying the response, for the cache key
+        :param parse: Check and parse a response into something JSON serializable
+        :param kwargs: Passed to `requests.request`
+        :returns: Parsed response
+        """
+        key = self.key(method, url, params)
+        entry = self.get(key)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        resp = client.request(method, url, headers=headers, stream=True, **kwargs)
+        if entry and resp.status_code == requests.codes.NOT_MODIFIED:
+            resp.close()
+            return self._hit(key, entry)
+        if resp.status_code != requests.codes.OK:
+            # parse raises for responses that are not ok, nothing is cached
+            self.misses += 1
+            return parse(resp)
+        if not os.path.exists(self.cache_dir):
+            fileio.makedirs(self.cache_dir, umask=0o077)
+        with memory.spool(dir=self.cache_dir) as body:
+            sha256 = hashlib.sha256()
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                sha256.update(chunk)
+                body.write(chunk)
+            digest = sha256.hexdigest()
+            if entry and entry['sha256'] == digest:
+                return self._hit(key, entry)
+            self.misses += 1
+            body.seek(0)
+            value = parse(_replay(resp, body))
+        self.put(key, {
+            'url': url,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'sha256': digest,
+            'value': value,
+            'time': time.time(),
+        })
+        return value
+
+    def _hit(self, key: str, entry: dict) -> Any:
+        self.hits += 1
+        self.touch(key)
+        return entry['value']
+
+
+def _replay(resp: requests.Response, body: IO[bytes]) -> requests.Response:
+    """
+    Copy of a consumed response that streams its content again from `body`
+    """
+    replay = requests.Response()
+    replay.status_code = resp.status_code
+    replay.headers = resp.headers
+    replay.url = resp.url
+    replay.encoding = resp.encoding
+    replay.reason = resp.reason
+    replay.request = resp.request
+    replay.raw = body
+    return replay
@@ -0,0 +1,337 @@
+"""
+Command line interface, installed as the `mano` command
+"""
+import argparse
+import csv
+import getpass
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+
+import dateutil.parser
+
+import mano
+import mano.cache
+import mano.daemon
+import mano.deployments
+import mano.feed
+import mano.fsck
+import mano.hedging
+import mano.memory
+import mano.planner
+import mano.profiling
+import mano.ratelimit
+import mano.storage
+import mano.summary
+import mano.workqueue
+
+
+STORAGES = {
+    'directory': mano.storage.DirectoryStorage,
+    'dedup': mano.storage.DedupStorage,
+    'bundle': mano.storage.BundleStorage,
+}
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser('mano', description='Python API for the Beiwe Research Platform')
+    parser.add_argument('--keyring-section', default=None,
+                        help='keyring section (deployment), read keyring from environment if omitted')
+    parser.add_argument('--keyring-file', default='~/.nrg-keyring.enc')
+    parser.add_argument('--cache-dir', default=None, help='cache study and user lists in this directory')
+    parser.add_argument('--memory-budget', default=None,
+                        help='memory that download and save buffers may hold at once e.g., 2G, unlimited if omitted')
+    parser.add_argument('--bandwidth', default=None,
+                        help='bytes per second of all downloads e.g., 10M or 22:00-06:00=unlimited,06:00-22:00=2M')
+    parser.add_argument('--bandwidth-per-download', default=None, help='bytes per second of each download')
+    parser.add_argument('--hedge', type=float, default=None, metavar='PERCENTILE',
+                        help='send data requests again when slower than this percentile of recent requests e.g., 95')
+    parser.add_argument('--hedge-max-ratio', type=float, default=0.1, help='fraction of requests that may be hedged')
+    parser.add_argument('--profile', default=None, help='write profiles of every window to this directory')
+    parser.add_argument('--profile-mode', default='sample', choices=mano.profiling.MODES)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_daemon = subparsers.add_parser('daemon', help='continuously sync studies')
+    parser_daemon.add_argument('--output-dir', required=True)
+    parser_daemon.add_argument('--study-id', action='append', dest='study_ids',
+                               help='study to sync (repeatable), all studies if omitted')
+    parser_daemon.add_argument('--data-streams', nargs='+', default=None)
+    parser_daemon.add_argument('--start-date', default=mano.sync.BACKFILL_START_DATE)
+    parser_daemon.add_argument('--active', default='1h', help='poll interval for active participants')
+    parser_daemon.add_argument('--dormant', default='1d', help='poll interval for dormant participants')
+    parser_daemon.add_argument('--activity', default='3d',
+                               help='participants that produced data within this interval are active')
+    parser_daemon.add_argument('--refresh', default='6h', help='interval between participant list refreshes')
+    parser_daemon.add_argument('--overlap', default='1h', help='re-request this much before the last window')
+    parser_daemon.add_argument('--lock', nargs='+', default=None,
+                               help='data streams to encrypt, the passphrase is read from MANO_PASSPHRASE or prompted')
+    parser_daemon.add_argument('--compress', action='append', default=None, metavar='DATA_STREAM=CODEC',
+                               help='compress a data stream with a codec e.g., gps=gzip (repeatable)')
+    parser_daemon.add_argument('--storage', default='directory', choices=STORAGES,
+                               help='storage backend for data stream files')
+    parser_daemon.set_defaults(func=daemon)
+
+    parser_enqueue = subparsers.add_parser('enqueue', help='queue backfill windows for workers')
+    parser_enqueue.add_argument('--queue', required=True, help='sqlite:///path/queue.db or file:///shared/dir')
+    parser_enqueue.add_argument('--study-id', required=True)
+    parser_enqueue.add_argument('--study-name', default=None, help='output folder name, defaults to study id')
+    parser_enqueue.add_argument('--user-id', action='append', dest='user_ids',
+                                help='user to backfill (repeatable), all users if omitted')
+    parser_enqueue.add_argument('--data-streams', nargs='+', default=None)
+    parser_enqueue.add_argument('--start-date', default=mano.sync.BACKFILL_START_DATE)
+    parser_enqueue.add_argument('--output-dir', default=None,
+                                help='folder the workers save into, users resume from their backfill file there')
+    parser_enqueue.set_defaults(func=enqueue)
+
+    parser_worker = subparsers.add_parser('worker', help='download queued backfill windows')
+    parser_worker.add_argument('--queue', required=True, help='sqlite:///path/queue.db or file:///shared/dir')
+    parser_worker.add_argument('--output-dir', required=True)
+    parser_worker.add_argument('--lease', type=float, default=300, help='lease duration in seconds')
+    parser_worker.add_argument('--max-attempts', type=int, default=5)
+    parser_worker.add_argument('--idle', default='0s', help='keep polling an empty queue for this long')
+    parser_worker.add_argument('--lock', nargs='+', default=None,
+                               help='data streams to encrypt, the passphrase is read from MANO_PASSPHRASE or prompted')
+    parser_worker.add_argument('--compress', action='append', default=None, metavar='DATA_STREAM=CODEC',
+                               help='compress a data stream with a codec e.g., gps=gzip (repeatable)')
+    parser_worker.add_argument('--storage', default='directory', choices=STORAGES,
+                               help='storage backend for data stream files')
+    parser_worker.set_defaults(func=worker)
+
+    parser_verify = subparsers.add_parser('verify', help='verify saved files against the manifest and registry')
+    parser_verify.add_argument('--output-dir', required=True)
+    parser_verify.add_argument('--user-id', action='append', dest='user_ids',
+                               help='user to verify (repeatable), all users if omitted')
+    parser_verify.add_argument('--workers', type=int, default=None)
+    parser_verify.add_argument('--repair', action='store_true',
+                               help='drop damaged files from the registry so they are downloaded again')
+    parser_verify.add_argument('--queue', default=None, help='also queue downloads of damaged files')
+    parser_verify.add_argument('--study-id', default=None, help='study to queue downloads for')
+    parser_verify.add_argument('--study-name', default=None)
+    parser_verify.set_defaults(func=verify)
+
+    parser_feed = subparsers.add_parser('feed', help='print the saved files after the cursor of a consumer')
+    parser_feed.add_argument('--output-dir', required=True)
+    parser_feed.add_argument('--consumer', default=None, help='read after the cursor of this consumer and move it')
+    parser_feed.add_argument('--offset', type=int, default=0, help='read from this offset if there is no consumer')
+    parser_feed.add_argument('--limit', type=int, default=1000)
+    parser_feed.add_argument('--prune', action='store_true', help='remove segments every consumer has read')
+    parser_feed.set_defaults(func=feed)
+
+    parser_gc = subparsers.add_parser('gc', help='remove unreferenced blobs of a deduplicated output folder')
+    parser_gc.add_argument('--output-dir', required=True)
+    parser_gc.add_argument('--dry-run', action='store_true', help='only report what would be removed')
+    parser_gc.set_defaults(func=gc)
+
+    parser_summary = subparsers.add_parser('summary', help='summarize saved data per user, data stream and day')
+    parser_summary.add_argument('--output-dir', required=True)
+    parser_summary.add_argument('--user-id', action='append', dest='user_ids',
+                                help='user to summarize (repeatable), all users if omitted')
+    parser_summary.add_argument('--data-stream', action='append', dest='data_streams',
+                                help='data stream to summarize (repeatable), all data streams if omitted')
+    parser_summary.add_argument('--start', type=dateutil.parser.parse, default=None)
+    parser_summary.add_argument('--end', type=dateutil.parser.parse, default=None)
+    parser_summary.add_argument('--totals', action='store_true', help='one row per user and data stream')
+    parser_summary.add_argument('--rebuild', action='store_true', help='rebuild summaries from the manifests first')
+    parser_summary.set_defaults(func=summary)
+
+    parser_plan = subparsers.add_parser('plan', help='estimate a backfill without downloading any data')
+    parser_plan.add_argument('--output-dir', required=True, help='base folder with one folder per study')
+    parser_plan.add_argument('--study-id', action='append', dest='study_ids',
+                             help='study to plan (repeatable), all studies if omitted')
+    parser_plan.add_argument('--user-id', action='append', dest='user_ids',
+                             help='user to plan (repeatable), all users if omitted')
+    parser_plan.add_argument('--data-streams', nargs='+', default=None)
+    parser_plan.add_argument('--start-date', default=mano.sync.BACKFILL_START_DATE)
+    parser_plan.add_argument('--concurrency', type=int, default=1, help='windows downloaded at the same time')
+    parser_plan.add_argument('--users', action='store_true', help='print one CSV row per user instead of totals')
+    parser_plan.set_defaults(func=plan)
+
+    parser_sync = subparsers.add_parser('sync', help='backfill several deployments of the keyring in parallel')
+    parser_sync.add_argument('--output-dir', required=True, help='base folder with one folder per deployment')
+    parser_sync.add_argument('--deployment', action='append', dest='deployments',
+                             help='keyring section to sync (repeatable), every section if omitted')
+    parser_sync.add_argument('--study-id', action='append', dest='study_ids',
+                             help='study to sync (repeatable), all studies if omitted')
+    parser_sync.add_argument('--data-streams', nargs='+', default=None)
+    parser_sync.add_argument('--start-date', default=mano.sync.BACKFILL_START_DATE)
+    parser_sync.add_argument('--workers', type=int, default=2, help='users backfilled at the same time per deployment')
+    parser_sync.add_argument('--rate', type=float, default=None, help='requests per second per deployment')
+    parser_sync.add_argument('--burst', type=float, default=None, help='requests sent at once before --rate applies')
+    parser_sync.add_argument('--report', default=None, help='also write the run report to this file')
+    parser_sync.add_argument('--recent-first', action='store_true',
+                             help='backfill newest windows first while keeping up with new data')
+    parser_sync.set_defaults(func=sync_deployments)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    if args.memory_budget:
+        mano.memory.configure(args.memory_budget)
+    if args.bandwidth or args.bandwidth_per_download:
+        mano.ratelimit.configure_bandwidth(args.bandwidth, per_download=args.bandwidth_per_download)
+    if args.hedge:
+        mano.hedging.configure(args.hedge, max_ratio=args.hedge_max_ratio)
+    if args.profile:
+        mano.profiling.configure(args.profile, mode=args.profile_mode)
+    args.func(args)
+
+
+def daemon(args: argparse.Namespace):
+    Keyring = mano.keyring(args.keyring_section, keyring_file=args.keyring_file)
+    d = mano.daemon.Daemon(
+        Keyring,
+        args.output_dir,
+        study_ids=args.study_ids,
+        data_streams=args.data_streams,
+        start_date=args.start_date,
+        active=args.active,
+        dormant=args.dormant,
+        activity=args.activity,
+        refresh=args.refresh,
+        overlap=args.overlap,
+        lock=args.lock,
+        passphrase=_passphrase(args.lock),
+        compress=_compress(args.compress),
+        storage=STORAGES[args.storage],
+        cache=_cache(args),
+    )
+    # stop gracefully between tasks
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        d.run(stop=stop)
+    except KeyboardInterrupt:
+        pass
+
+
+def enqueue(args: argparse.Namespace):
+    Keyring = mano.keyring(args.keyring_section, keyring_file=args.keyring_file)
+    queue = mano.workqueue.open_queue(args.queue)
+    mano.workqueue.enqueue_backfill(queue, Keyring, args.study_id, user_ids=args.user_ids,
+                                    start_date=args.start_date, data_streams=args.data_streams,
+                                    study_name=args.study_name, cache=_cache(args), output_dir=args.output_dir)
+    print(json.dumps(queue.counts()))
+
+
+def worker(args: argparse.Namespace):
+    Keyring = mano.keyring(args.keyring_section, keyring_file=args.keyring_file)
+    queue = mano.workqueue.open_queue(args.queue, lease=args.lease, max_attempts=args.max_attempts)
+    w = mano.workqueue.Worker(queue, Keyring, args.output_dir, lock=args.lock, passphrase=_passphrase(args.lock),
+                              compress=_compress(args.compress), storage=STORAGES[args.storage])
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        w.run(stop=stop, idle=mano.interval(args.idle))
+    except KeyboardInterrupt:
+        pass
+
+
+def verify(args: argparse.Namespace):
+    queue = mano.workqueue.open_queue(args.queue) if args.queue else None
+    report = mano.fsck.verify(args.output_dir, users=args.user_ids, workers=args.workers, repair=args.repair,
+                              queue=queue, study_id=args.study_id, study_name=args.study_name)
+    print(json.dumps(report.summary()))
+    if not report.ok:
+        sys.exit(1)
+
+
+def _passphrase(lock: list[str] | None) -> str | None:
+    if not lock:
+        return None
+    if 'MANO_PASSPHRASE' in os.environ:
+        return os.environ['MANO_PASSPHRASE']
+    return getpass.getpass('enter passphrase for locked data streams: ')
+
+
+def _compress(options: list[str] | None) -> dict[str, str] | None:
+    if not options:
+        return None
+    compress = {}
+    for option in options:
+        data_stream, sep, codec = option.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f'invalid --compress option {option}, expecting DATA_STREAM=CODEC')
+        compress[data_stream] = codec
+    return compress
+
+
+def _cache(args: argparse.Namespace) -> mano.cache.MetadataCache | None:
+    return mano.cache.MetadataCache(args.cache_dir) if args.cache_dir else None
+
+
+def summary(args: argparse.Namespace):
+    if args.rebuild:
+        for user_id in args.user_ids or mano.fsck.user_ids(args.output_dir):
+            mano.summary.rebuild(args.output_dir, user_id)
+    rows = mano.summary.query(args.output_dir, user_ids=args.user_ids, data_streams=args.data_streams,
+                              start=args.start, end=args.end)
+    if args.totals:
+        rows = iter(mano.summary.totals(rows))
+    first = next(rows, None)
+    if first is None:
+        return
+    writer = csv.DictWriter(sys.stdout, fieldnames=list(first))
+    writer.writeheader()
+    writer.writerow(first)
+    writer.writerows(rows)
+
+
+def sync_deployments(args: argparse.Namespace):
+    Keyrings = mano.keyrings(keyring_file=args.keyring_file)
+    report = mano.deployments.sync_deployments(
+        Keyrings,
+        args.output_dir,
+        deployments=args.deployments,
+        study_ids=args.study_ids,
+        start_date=args.start_date,
+        data_streams=args.data_streams,
+        workers=args.workers,
+        rate=args.rate,
+        burst=args.burst,
+        cache=_cache(args),
+        report_file=args.report,
+        recent_first=args.recent_first,
+    )
+    print(json.dumps(report, indent=2))
+    if not report['ok']:
+        sys.exit(1)
+
+
+def feed(args: argparse.Namespace):
+    if args.prune:
+        print(json.dumps({'removed': mano.feed.prune(args.output_dir)}))
+        return
+    consumer = mano.feed.Consumer(args.output_dir, args.consumer) if args.consumer else None
+    if consumer:
+        records = consumer.poll(args.limit)
+    else:
+        records = list(mano.feed.read(args.output_dir, args.offset, args.limit))
+    for record in records:
+        print(json.dumps(record, sort_keys=True))
+    if consumer and records:
+        consumer.commit(records[-1]['offset'])
+
+
+def gc(args: argparse.Namespace):
+    result = mano.storage.DedupStorage(args.output_dir).gc(dry_run=args.dry_run)
+    print(json.dumps(result, indent=2))
+
+
+def plan(args: argparse.Namespace):
+    Keyring = mano.keyring(args.keyring_section, keyring_file=args.keyring_file)
+    result = mano.planner.plan(Keyring, args.output_dir, study_ids=args.study_ids, user_ids=args.user_ids,
+                               start_date=args.start_date, data_streams=args.data_streams,
+                               concurrency=args.concurrency, cache=_cache(args))
+    if args.users:
+        writer = csv.DictWriter(sys.stdout, fieldnames=mano.planner.FIELDS)
+        writer.writeheader()
+        writer.writerows(result.rows)
+    else:
+        print(json.dumps(result.totals(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+HTTP client that requests to the Beiwe API go through
+
+By default requests are sent with the `requests` module functions. Within `use(client)` every
+request of the current thread goes through that `Client` instead, which has its own connection pool
+and rate limit, e.g. one client per deployment when several deployments are synced at the same time
+(see `mano.deployments`).
+"""
+import threading
+from collections.abc import Generator
+from contextlib import contextmanager
+from typing import Any
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from mano.ratelimit import TokenBucket
+
+
+class Client:
+    """
+    Session with its own connection pool and an optional rate limit
+    """
+
+    def __init__(self, pool_size: int = 10, rate: float | None = None, burst: float | None = None):
+        """
+        :param pool_size: Connections kept open per host
+        :param rate: Requests per second, unlimited if None
+        :param burst: Requests that may be sent at once before the rate applies
+        """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        if self.limiter:
+            self.limiter.acquire()
+        with self._lock:
+            self.requests += 1
+        return self.session.request(method, url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self) -> 'Client':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_local = threading.local()
+
+
+def current() -> Client | None:
+    """
+    Get the client of the current thread, if any
+    """
+    return getattr(_local, 'client', None)
+
+
+@contextmanager
+def use(client: Client | None) -> Generator[Client | None, None, None]:
+    """
+    Send the requests of the current thread through a client
+    """
+    previous = current()
+    _local.client = client
+    try:
+        yield client
+    finally:
+        _local.client = previous
+
+
+def request(method: str, url: str, **kwargs: Any) -> requests.Response:
+    client = current()
+    if client:
+        return client.request(method, url, **kwargs)
+    return requests.request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs: Any) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs: Any) -> requests.Response:
+    return request('POST', url, **kwargs)
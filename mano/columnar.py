@@ -0,0 +1,202 @@
+"""
+Columnar reader for saved data stream files, returning NumPy arrays
+
+Each hourly CSV file is parsed in a vectorized way into a structured array, with integer, float,
+datetime64 and string columns detected from the content. Parsed files are cached in `.npy` sidecars
+next to them (hidden, so they are not mistaken for data stream files), keyed by the file's
+modification time and size and by its CRC-32 in the manifest, so later loads memory map the
+sidecar instead of parsing the CSV again. Locked files are decrypted in memory and never get a
+sidecar, which would store their content unencrypted.
+
+NumPy is an optional dependency, install it with `pip install "mano[numpy]"`.
+"""
+import glob
+import logging
+import os
+from collections.abc import Iterator
+from datetime import datetime, timezone
+
+import dateutil.parser
+
+try:
+    import numpy as np
+except ImportError as e:  # pragma: no cover
+    raise ImportError('mano.columnar requires numpy, install it with pip install "mano[numpy]"') from e
+
+import mano.fileio as fileio
+import mano.manifest as manifest
+import mano.sync as sync
+from mano.storage import DirectoryStorage, Storage
+
+SIDECAR_EXT = '.npy'
+TIMESTAMP_COLUMN = 'timestamp'
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnarError(Exception):
+    pass
+
+
+def parse_csv(content: bytes) -> np.ndarray:
+    """
+    Parse a data stream CSV file into a structured array with one field per column
+    """
+    content = content.replace(b'\r\n', b'\n').rstrip(b'\n')
+    header, _, body = content.partition(b'\n')
+    names = header.decode('utf-8').split(',')
+    if not body:
+        return np.empty(0, dtype=[(name, np.float64) for name in names])
+    # split every field at once, rows must all have the same number of fields
+    fields = np.array(body.replace(b'\n', b',').split(b','))
+    if fields.size % len(names):
+        raise ColumnarError(f'rows do not all have {len(names)} fields')
+    fields = fields.reshape(-1, len(names))
+    columns = [_convert(fields[:, i]) for i in range(len(names))]
+    array = np.empty(len(fields), dtype=[(name, column.dtype) for name, column in zip(names, columns)])
+    for name, column in zip(names, columns):
+        array[name] = column
+    return array
+
+
+def _convert(column: np.ndarray) -> np.ndarray:
+    """
+    Convert a column of byte strings to the narrowest of int64, float64, datetime64 and str
+    """
+    for dtype in (np.int64, np.float64):
+        try:
+            return column.astype(dtype)
+        except ValueError:
+            pass
+    strings = column.astype(np.str_)
+    try:
+        return strings.astype('datetime64[ms]')
+    except ValueError:
+        return strings
+
+
+def load(
+        output_dir: str,
+        user_id: str,
+        data_stream: str,
+        time_start: str | datetime | None = None,
+        time_end: str | datetime | None = None,
+        passphrase: str | None = None,
+        sidecars: bool = True,
+        storage: Storage | None = None,
+    ) -> dict[str, np.ndarray]:
+    """
+    Load the saved files of a user and data stream into one array per column
+
+    :param time_start: Only rows at or after this time (UTC)
+    :param time_end: Only rows before this time (UTC)
+    :param passphrase: Passphrase for locked files
+    :param sidecars: Read and write `.npy` sidecars (only with the classic directory layout)
+    :returns: Mapping of column name to array, e.g. {'timestamp': ..., 'latitude': ...}
+    """
+    arrays = [array for _, array in load_files(output_dir, user_id, data_stream, time_start, time_end,
+                                               passphrase=passphrase, sidecars=sidecars, storage=storage)]
+    if not arrays:
+        return {}
+    array = _concatenate(arrays)
+    if TIMESTAMP_COLUMN in (array.dtype.names or ()):
+        # files cover whole hours, trim rows outside of the time range
+        mask = np.ones(len(array), dtype=bool)
+        if time_start:
+            mask &= array[TIMESTAMP_COLUMN] >= _epoch_ms(time_start)
+        if time_end:
+            mask &= array[TIMESTAMP_COLUMN] < _epoch_ms(time_end)
+        if not mask.all():
+            array = array[mask]
+    return {name: array[name] for name in array.dtype.names or ()}
+
+
+def load_files(
+        output_dir: str,
+        user_id: str,
+        data_stream: str,
+        time_start: str | datetime | None = None,
+        time_end: str | datetime | None = None,
+        passphrase: str | None = None,
+        sidecars: bool = True,
+        storage: Storage | None = None,
+    ) -> Iterator[tuple[str, np.ndarray]]:
+    """
+    Load the saved files of a user and data stream that cover [time_start, time_end) one at a time.
+    Arrays loaded from sidecars are read-only memory maps.
+
+    :returns: Generator of (target, structured array)
+    """
+    if not storage:
+        storage = DirectoryStorage(output_dir)
+    keys = sync._KeyCache(passphrase) if passphrase else None
+    entries = manifest.load(output_dir, user_id) if sidecars else {}
+    for target in sync.list_saved(output_dir, user_id, data_stream, time_start, time_end, storage):
+        sidecar = None
+        if sidecars and isinstance(storage, DirectoryStorage) and not target.endswith(sync.LOCK_EXT):
+            sidecar = _sidecar(storage.path(target), entries.get(target))
+            if os.path.exists(sidecar):
+                yield target, np.load(sidecar, mmap_mode='r')
+                continue
+        with sync._open_saved(target, storage, keys) as fo:
+            array = parse_csv(fo.read())
+        if sidecar:
+            _write_sidecar(sidecar, array)
+        yield target, array
+
+
+def _sidecar(path: str, entry: dict | None) -> str:
+    """
+    Get the sidecar file name for a saved file, which changes whenever the file does
+    """
+    st = os.stat(path)
+    key = f'{st.st_mtime_ns:x}-{st.st_size:x}'
+    if entry:
+        key += f'-{entry["crc"]:08x}'
+    dirname, filename = os.path.split(path)
+    return os.path.join(dirname, f'.{filename}.{key}{SIDECAR_EXT}')
+
+
+def _write_sidecar(sidecar: str, array: np.ndarray):
+    dirname, name = os.path.split(sidecar)
+    filename = name[1:].rsplit('.', 2)[0]
+    try:
+        with fileio.atomic_writer(sidecar) as fo:
+            np.save(fo, array, allow_pickle=False)
+        # remove sidecars of previous versions of the file
+        for stale in glob.glob(os.path.join(glob.escape(dirname), f'.{glob.escape(filename)}.*{SIDECAR_EXT}')):
+            if stale != sidecar:
+                os.remove(stale)
+    except OSError as e:
+        # e.g. a read-only tree, the file is parsed again next time
+        logger.debug(f'could not write sidecar {sidecar}: {e}')
+
+
+def _concatenate(arrays: list[np.ndarray]) -> np.ndarray:
+    """
+    Concatenate structured arrays whose columns may have been detected as different types
+    """
+    names = arrays[0].dtype.names or ()
+    if all(array.dtype == arrays[0].dtype for array in arrays):
+        return np.concatenate(arrays)
+    if any(array.dtype.names != names for array in arrays):
+        raise ColumnarError('saved files have different columns')
+    dtype = []
+    for name in names:
+        try:
+            column_dtype = np.result_type(*[array.dtype[name] for array in arrays])
+        except TypeError:
+            column_dtype = np.dtype(np.str_)
+        if column_dtype.kind == 'U':
+            # the widest string, numbers converted to strings are at most 32 characters
+            column_dtype = np.dtype(f'U{max(32, *(array.dtype[name].itemsize // 4 for array in arrays))}')
+        dtype.append((name, column_dtype))
+    return np.concatenate([array.astype(dtype) for array in arrays])
+
+
+def _epoch_ms(timestamp: str | datetime) -> int:
+    if isinstance(timestamp, str):
+        timestamp = dateutil.parser.parse(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1000)
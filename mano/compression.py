@@ -0,0 +1,118 @@
+"""
+Storage codecs for data stream files written by `mano.sync.save`
+"""
+import gzip
+import lzma
+import os
+import struct
+import zipfile
+from typing import IO, cast
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec:
+    """
+    Base class for storage codecs. A codec has a name (used in the `compress` argument to
+    `mano.sync.save`), a file extension appended to saved files, and knows how to wrap a binary file
+    object for compression and decompression.
+    """
+    name = ''
+    extension = ''
+
+    def compressor(self, fileobj: IO[bytes]) -> IO[bytes]:
+        """
+        Wrap a writable binary file object. Closing the wrapper must not close `fileobj`.
+        """
+        raise NotImplementedError
+
+    def decompressor(self, fileobj: IO[bytes]) -> IO[bytes]:
+        """
+        Wrap a readable binary file object
+        """
+        raise NotImplementedError
+
+    def frame(self, info: zipfile.ZipInfo) -> tuple[bytes, bytes] | None:
+        """
+        Header and trailer that turn the raw (still compressed) bytes of an archive member into a
+        valid stream for this codec, or None if the member must be recompressed.
+        """
+        return None
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    extension = '.gz'
+
+    # gzip header with no file name and a zero modification time, which keeps output reproducible
+    HEADER = b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + b'\x00\xff'
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compressor(self, fileobj: IO[bytes]) -> IO[bytes]:
+        return cast(IO[bytes], gzip.GzipFile(filename='', mode='wb', fileobj=fileobj, compresslevel=self.level,
+                                            mtime=0))
+
+    def decompressor(self, fileobj: IO[bytes]) -> IO[bytes]:
+        return cast(IO[bytes], gzip.GzipFile(mode='rb', fileobj=fileobj))
+
+    def frame(self, info: zipfile.ZipInfo) -> tuple[bytes, bytes] | None:
+        # a deflated zip member is a raw deflate stream, which is exactly the body of a gzip member
+        if info.compress_type != zipfile.ZIP_DEFLATED or info.flag_bits & 0x1:
+            return None
+        trailer = struct.pack('<II', info.CRC, info.file_size & 0xffffffff)
+        return self.HEADER, trailer
+
+
+class LzmaCodec(Codec):
+    name = 'lzma'
+    extension = '.xz'
+
+    def __init__(self, preset: int = 6):
+        self.preset = preset
+
+    def compressor(self, fileobj: IO[bytes]) -> IO[bytes]:
+        return cast(IO[bytes], lzma.LZMAFile(fileobj, mode='wb', format=lzma.FORMAT_XZ, preset=self.preset))
+
+    def decompressor(self, fileobj: IO[bytes]) -> IO[bytes]:
+        return cast(IO[bytes], lzma.LZMAFile(fileobj, mode='rb'))
+
+
+CODECS: dict[str, Codec] = {}
+
+
+def register(codec: Codec) -> None:
+    """
+    Register a codec so it can be referred to by name and recognized by file extension
+    """
+    if not codec.name or not codec.extension.startswith('.'):
+        raise CodecError(f'codec must have a name and an extension starting with ".": {codec!r}')
+    CODECS[codec.name] = codec
+
+
+def get(name: str) -> Codec:
+    """
+    Get a registered codec by name
+    """
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise CodecError(f'unknown codec "{name}", expecting one of {sorted(CODECS)}')
+
+
+def for_filename(filename: str) -> Codec | None:
+    """
+    Get the codec matching the extension of a saved file, if any
+    """
+    _, ext = os.path.splitext(filename)
+    for codec in CODECS.values():
+        if codec.extension == ext:
+            return codec
+    return None
+
+
+register(GzipCodec())
+register(LzmaCodec())
@@ -0,0 +1,267 @@
+"""
+Time coverage index of saved data
+
+Beiwe data stream files each cover one hour and are named after it e.g., `2018-06-15 16_00_00.csv`.
+The coverage index records which hours have a saved file, per data stream, as one 24-bit bitmap per
+day, and is stored in `<output_dir>/<user_id>/.coverage`. Hours that were requested to fill a gap
+and came back without data are kept in the same format in `<output_dir>/<user_id>/.checked`, so
+they are not requested again.
+"""
+import json
+import locale
+import os
+import re
+from collections.abc import Iterable
+from datetime import datetime, timedelta
+
+import mano.fileio as fileio
+from mano.storage import DirectoryStorage, Storage
+
+COVERAGE_FILE = '.coverage'
+CHECKED_FILE = '.checked'
+FULL_DAY = (1 << 24) - 1
+DAY_FORMAT = '%Y-%m-%d'
+
+TIMESTAMP_EXPR = re.compile(r'^(\d{4}-\d{2}-\d{2}) (\d{2})_\d{2}_\d{2}')
+# registry keys look like CHUNKED_DATA/<study_id>/<user_id>/gps/2018-06-15T16:00:00.csv
+REGISTRY_EXPR = re.compile(r'^(?:.*/)?([^/]+)/([a-zA-Z_]+)/(?:.*/)?(\d{4}-\d{2}-\d{2})T(\d{2}):\d{2}:\d{2}')
+
+
+class CoverageError(Exception):
+    pass
+
+
+def parse_target(target: str) -> tuple[str, datetime] | None:
+    """
+    Parse the data stream and hour from a saved target e.g., `<user_id>/gps/2018-06-15 16_00_00.csv`
+
+    :returns: Data stream and hour, or None if the target is not named after an hour
+    """
+    parts = target.split('/')
+    if len(parts) < 3:
+        return None
+    match = TIMESTAMP_EXPR.match(parts[-1])
+    if not match:
+        return None
+    day, hour = match.groups()
+    return parts[1], datetime.strptime(day, DAY_FORMAT) + timedelta(hours=int(hour))
+
+
+def parse_registry_key(key: str) -> tuple[str, str, datetime] | None:
+    """
+    Parse the user, data stream and hour from a Beiwe registry key
+
+    :returns: User ID, data stream and hour, or None if the key could not be parsed
+    """
+    match = REGISTRY_EXPR.match(key)
+    if not match:
+        return None
+    user_id, data_stream, day, hour = match.groups()
+    return user_id, data_stream, datetime.strptime(day, DAY_FORMAT) + timedelta(hours=int(hour))
+
+
+class Coverage:
+    """
+    Hour bitmaps per data stream and day
+    """
+
+    def __init__(self, bitmaps: dict[str, dict[str, int]] | None = None):
+        self.bitmaps = bitmaps or {}
+
+    @classmethod
+    def load(cls, filename: str) -> 'Coverage':
+        if not os.path.exists(filename):
+            return cls()
+        with open(filename) as fo:
+            try:
+                return cls(json.load(fo))
+            except ValueError as e:
+                raise CoverageError(f'could not parse coverage file {filename}: {e}')
+
+    def dump(self, filename: str):
+        content = json.dumps(self.bitmaps, sort_keys=True)
+        fileio.atomic_write(filename, content.encode(locale.getpreferredencoding()))
+
+    def add(self, data_stream: str, hour: datetime):
+        days = self.bitmaps.setdefault(data_stream, {})
+        day = hour.strftime(DAY_FORMAT)
+        days[day] = days.get(day, 0) | (1 << hour.hour)
+
+    def covered(self, data_stream: str, hour: datetime) -> bool:
+        bitmap = self.bitmaps.get(data_stream, {}).get(hour.strftime(DAY_FORMAT), 0)
+        return bool(bitmap & (1 << hour.hour))
+
+    def data_streams(self) -> list[str]:
+        return sorted(self.bitmaps)
+
+    def span(self) -> tuple[datetime, datetime] | None:
+        """
+        Get the first covered hour and the end of the last covered hour across data streams
+
+        :returns: Interval [first, last), or None if nothing is covered
+        """
+        days = sorted(day for bitmaps in self.bitmaps.values() for day, bitmap in bitmaps.items() if bitmap)
+        if not days:
+            return None
+        first_bitmap = 0
+        last_bitmap = 0
+        for bitmaps in self.bitmaps.values():
+            first_bitmap |= bitmaps.get(days[0], 0)
+            last_bitmap |= bitmaps.get(days[-1], 0)
+        # lowest and highest set bit
+        first_hour = (first_bitmap & -first_bitmap).bit_length() - 1
+        last_hour = last_bitmap.bit_length() - 1
+        first = datetime.strptime(days[0], DAY_FORMAT) + timedelta(hours=first_hour)
+        last = datetime.strptime(days[-1], DAY_FORMAT) + timedelta(hours=last_hour + 1)
+        return first, last
+
+    def hours(self, data_stream: str) -> int:
+        """
+        Count the covered hours for a data stream
+        """
+        return sum(bin(bitmap).count('1') for bitmap in self.bitmaps.get(data_stream, {}).values())
+
+    def missing(self, data_stream: str, start: datetime, end: datetime) -> list[tuple[datetime, datetime]]:
+        """
+        Get the intervals of hours in [start, end) with no coverage for a data stream
+        """
+        days = self.bitmaps.get(data_stream, {})
+        intervals: list[tuple[datetime, datetime]] = []
+        gap_start = None
+        hour = _floor_hour(start)
+        while hour < end:
+            day = hour.strftime(DAY_FORMAT)
+            bitmap = days.get(day, 0)
+            # skip whole days at once when they are either fully covered or empty
+            if hour.hour == 0 and hour + timedelta(days=1) <= end and bitmap in (0, FULL_DAY):
+                if bitmap == FULL_DAY and gap_start is not None:
+                    intervals.append((gap_start, hour))
+                    gap_start = None
+                elif bitmap == 0 and gap_start is None:
+                    gap_start = hour
+                hour += timedelta(days=1)
+                continue
+            is_covered = bool(bitmap & (1 << hour.hour))
+            if is_covered and gap_start is not None:
+                intervals.append((gap_start, hour))
+                gap_start = None
+            elif not is_covered and gap_start is None:
+                gap_start = hour
+            hour += timedelta(hours=1)
+        if gap_start is not None:
+            intervals.append((gap_start, end))
+        return intervals
+
+
+def coverage_file(output_dir: str, user_id: str) -> str:
+    return os.path.join(output_dir, user_id, COVERAGE_FILE)
+
+
+def load(output_dir: str, user_id: str) -> Coverage:
+    """
+    Load the coverage index for a user
+    """
+    return Coverage.load(coverage_file(output_dir, user_id))
+
+
+def update(output_dir: str, user_id: str, targets: Iterable[str]) -> Coverage:
+    """
+    Add saved targets to the coverage index for a user
+    """
+    coverage = load(output_dir, user_id)
+    for target in targets:
+        parsed = parse_target(target)
+        if parsed:
+            coverage.add(*parsed)
+    coverage.dump(coverage_file(output_dir, user_id))
+    return coverage
+
+
+def checked_file(output_dir: str, user_id: str) -> str:
+    return os.path.join(output_dir, user_id, CHECKED_FILE)
+
+
+def load_checked(output_dir: str, user_id: str) -> Coverage:
+    """
+    Load the hours of a user that were requested to fill a gap and came back without data
+    """
+    return Coverage.load(checked_file(output_dir, user_id))
+
+
+def check(output_dir: str, user_id: str, data_streams: list[str], start: datetime, end: datetime) -> int:
+    """
+    Record the hours in [start, end) that are still not covered after they were requested
+
+    :returns: Number of hours recorded across data streams
+    """
+    cov = load(output_dir, user_id)
+    checked = load_checked(output_dir, user_id)
+    num_checked = 0
+    for data_stream in data_streams:
+        for gap_start, gap_end in cov.missing(data_stream, start, end):
+            hour = gap_start
+            while hour < gap_end:
+                checked.add(data_stream, hour)
+                hour += timedelta(hours=1)
+                num_checked += 1
+    if num_checked:
+        checked.dump(checked_file(output_dir, user_id))
+    return num_checked
+
+
+def rebuild(output_dir: str, user_id: str, storage: Storage | None = None) -> Coverage:
+    """
+    Rebuild the coverage index for a user from the saved files, e.g. after files were deleted
+    """
+    if not storage:
+        storage = DirectoryStorage(output_dir)
+    coverage = Coverage()
+    for target in storage.names(f'{user_id}/'):
+        parsed = parse_target(target)
+        if parsed:
+            coverage.add(*parsed)
+    coverage.dump(coverage_file(output_dir, user_id))
+    return coverage
+
+
+def gaps(coverage: Coverage, data_streams: list[str], start: datetime, end: datetime,
+         max_window: timedelta, checked: Coverage | None = None,
+         merge: timedelta = timedelta(0)) -> list[tuple[datetime, datetime, list[str]]]:
+    """
+    Group missing hours across data streams into download windows no longer than `max_window`
+
+    :param checked: Hours that were already requested and came back without data, not missing
+    :param merge: Join missing hours that are at most this far apart into one window, the
+                  covered hours in between are in the registry and not sent again
+    :returns: List of (window start, window end, data streams missing within the window)
+    """
+    # collect the set of missing data streams for every missing hour
+    missing: dict[datetime, set[str]] = {}
+    for data_stream in data_streams:
+        for gap_start, gap_end in coverage.missing(data_stream, start, end):
+            hour = gap_start
+            while hour < gap_end:
+                if not checked or not checked.covered(data_stream, hour):
+                    missing.setdefault(hour, set()).add(data_stream)
+                hour += timedelta(hours=1)
+
+    windows: list[tuple[datetime, datetime, list[str]]] = []
+    win_start: datetime | None = None
+    win_end: datetime | None = None
+    win_streams: set[str] = set()
+    for hour in sorted(missing):
+        nearby = win_end is not None and hour - win_end <= merge
+        if win_start is not None and win_end is not None and (not nearby or hour - win_start >= max_window):
+            windows.append((win_start, win_end, sorted(win_streams)))
+            win_start = None
+        if win_start is None:
+            win_start, win_streams = hour, set()
+        win_end = min(hour + timedelta(hours=1), end)
+        win_streams |= missing[hour]
+    if win_start is not None and win_end is not None:
+        windows.append((win_start, win_end, sorted(win_streams)))
+    return windows
+
+
+def _floor_hour(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
@@ -0,0 +1,333 @@
+"""
+Continuous sync daemon
+
+The daemon keeps a priority queue of (study, user, data stream) tasks ordered by when each task is
+next due. Every time a task runs it downloads data from its frontier (the end of its last download)
+up to the present, one BACKFILL_WINDOW at a time. Participants that produced data recently are
+polled every `active` interval, dormant ones every `dormant` interval. Intervals use the syntax of
+`mano.interval` e.g., 30m, 12h, 1d. Each request only sends the part of the local registry that
+falls within the requested window, and tasks of participants or studies that disappear from the
+server are removed from the schedule.
+"""
+import heapq
+import itertools
+import json
+import locale
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable
+from datetime import datetime, timedelta
+
+import dateutil.parser
+
+import mano
+import mano.coverage as coverage
+import mano.fileio as fileio
+import mano.hedging as hedging
+import mano.memory as memory
+import mano.ratelimit as ratelimit
+import mano.sync as sync
+from mano.cache import MetadataCache
+from mano.storage import Storage
+
+STATE_FILE = '.daemon'
+
+logger = logging.getLogger(__name__)
+
+
+class Task:
+    """
+    A (study, user, data stream) sync task and its state
+    """
+
+    def __init__(self, study_id: str, user_id: str, data_stream: str, output_dir: str,
+                 frontier: str | None = None, last_poll: float = 0.0, last_data: float = 0.0):
+        self.study_id = study_id
+        self.user_id = user_id
+        self.data_stream = data_stream
+        self.output_dir = output_dir
+        # end of the last successful download window, in mano.TIME_FORMAT
+        self.frontier = frontier
+        # unix time of the last poll and of the last poll that saved any files
+        self.last_poll = last_poll
+        self.last_data = last_data
+
+    @property
+    def key(self) -> str:
+        return f'{self.study_id}/{self.user_id}/{self.data_stream}'
+
+    def state(self) -> dict:
+        return {'frontier': self.frontier, 'last_poll': self.last_poll, 'last_data': self.last_data}
+
+    def __repr__(self):
+        return f'Task({self.key}, frontier={self.frontier})'
+
+
+class Scheduler:
+    """
+    Priority queue of tasks ordered by due time. Ties are broken by staleness (time since the last
+    poll), so when the daemon is behind, the tasks that waited longest run first.
+    """
+
+    def __init__(self, active: str = '1h', dormant: str = '1d', activity: str = '3d',
+                 clock: Callable[[], float] = time.time):
+        self.active = mano.interval(active)
+        self.dormant = mano.interval(dormant)
+        self.activity = mano.interval(activity)
+        self.clock = clock
+        self._heap: list[tuple[float, float, int, Task]] = []
+        self._counter = itertools.count()
+        self.tasks: dict[str, Task] = {}
+        # tasks removed from the schedule, which are not put back after they ran
+        self._removed: set[str] = set()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task: Task):
+        """
+        Add a task, due immediately if it has never been polled
+        """
+        if task.key in self.tasks:
+            return
+        self._removed.discard(task.key)
+        self.tasks[task.key] = task
+        due = task.last_poll + self.interval(task) if task.last_poll else self.clock()
+        self._push(task, due)
+
+    def remove(self, key: str) -> Task | None:
+        """
+        Remove a task from the schedule, it is dropped from the queue when it comes up
+
+        :returns: The removed task, or None if there is no such task
+        """
+        self._removed.add(key)
+        return self.tasks.pop(key, None)
+
+    def interval(self, task: Task) -> int:
+        """
+        Get the polling interval for a task based on how recently it produced data
+        """
+        if task.last_data and self.clock() - task.last_data <= self.activity:
+            return self.active
+        return self.dormant
+
+    def reschedule(self, task: Task, caught_up: bool = True):
+        """
+        Put a task back on the queue after it ran. Tasks that have not caught up with the present
+        are due again immediately.
+        """
+        if task.key in self._removed:
+            # removed while it ran
+            return
+        self.tasks.setdefault(task.key, task)
+        due = self.clock() if not caught_up else task.last_poll + self.interval(task)
+        self._push(task, due)
+
+    def pop(self) -> tuple[float, Task]:
+        """
+        Remove and return the next task and its due time
+        """
+        self._drop_removed()
+        due, _, _, task = heapq.heappop(self._heap)
+        return due, task
+
+    def peek(self) -> float | None:
+        """
+        Get the due time of the next task
+        """
+        self._drop_removed()
+        return self._heap[0][0] if self._heap else None
+
+    def _drop_removed(self):
+        while self._heap and self.tasks.get(self._heap[0][3].key) is not self._heap[0][3]:
+            heapq.heappop(self._heap)
+
+    def _push(self, task: Task, due: float):
+        # the last poll time breaks ties, so the stalest task wins among tasks due at the same time
+        heapq.heappush(self._heap, (due, task.last_poll, next(self._counter), task))
+
+
+class Daemon:
+    """
+    Long-running sync of one or more studies into `<output_dir>/<study_name>/<user_id>`
+    """
+
+    def __init__(
+            self,
+            Keyring: dict[str, str],
+            output_dir: str,
+            study_ids: list[str] | None = None,
+            data_streams: list[str] | None = None,
+            start_date: str = sync.BACKFILL_START_DATE,
+            active: str = '1h',
+            dormant: str = '1d',
+            activity: str = '3d',
+            refresh: str = '6h',
+            overlap: str = '1h',
+            lock: list[str] | None = None,
+            passphrase: str | None = None,
+            compress: dict[str, str] | None = None,
+            storage: Callable[[str], Storage] | None = None,
+            cache: MetadataCache | None = None,
+            clock: Callable[[], float] = time.time,
+        ):
+        self.Keyring = Keyring
+        self.output_dir = output_dir
+        self.study_ids = study_ids
+        self.data_streams = data_streams or mano.DATA_STREAMS
+        self.start_date = start_date
+        self.refresh = mano.interval(refresh)
+        self.overlap = mano.interval(overlap)
+        self.lock = lock
+        self.passphrase = passphrase
+        self.compress = compress
+        # storage backends are rooted at the folder of each study
+        self.storage = storage
+        self._storages: dict[str, Storage] = {}
+        # registries by file, with the modification time and size they were read at
+        self._registries: dict[str, tuple[int, int, dict[str, tuple[str, tuple[str, datetime] | None]]]] = {}
+        # study and user lists are refreshed often but rarely change
+        self.cache = cache
+        self.clock = clock
+        self.scheduler = Scheduler(active, dormant, activity, clock=clock)
+        self.state_file = os.path.join(output_dir, STATE_FILE)
+        self._state = self._load_state()
+        self._last_refresh = 0.0
+
+    def discover(self):
+        """
+        Add tasks for every user and data stream of the configured studies, e.g. new participants,
+        and remove the tasks of users and studies that are gone
+        """
+        found = set()
+        for study_name, study_id in mano.studies(self.Keyring, cache=self.cache):
+            if self.study_ids and study_id not in self.study_ids:
+                continue
+            study_dir = os.path.join(self.output_dir, study_name)
+            for user_id in mano.users(self.Keyring, study_id, cache=self.cache):
+                for data_stream in self.data_streams:
+                    key = f'{study_id}/{user_id}/{data_stream}'
+                    found.add(key)
+                    self.scheduler.add(Task(study_id, user_id, data_stream, study_dir, **self._state.get(key, {})))
+        for key in set(self.scheduler.tasks) - found:
+            logger.info(f'removing task {key}')
+            self.remove(key)
+        self._last_refresh = self.clock()
+        logger.info(f'daemon is tracking {len(self.scheduler.tasks)} tasks')
+
+    def remove(self, key: str) -> Task | None:
+        """
+        Stop syncing a task, e.g. `STUDY_ID/USER_ID/gps`. Its state is kept, so the task resumes from
+        its frontier if it is added again.
+        """
+        return self.scheduler.remove(key)
+
+    def run_task(self, task: Task) -> bool:
+        """
+        Download and save the next window of data for a task
+
+        :returns: True if the task has caught up with the present
+        """
+        timestamp = task.frontier or self.start_date
+        # re-request a little before the frontier for files that were uploaded late
+        if task.frontier:
+            timestamp = (dateutil.parser.parse(timestamp) - timedelta(seconds=self.overlap)).strftime(
+                mano.TIME_FORMAT)
+        start, stop, resume = sync._window(timestamp, sync.BACKFILL_WINDOW)
+        logger.info(f'running task {task.key} for window [{start}, {stop}]')
+
+        registry = self._registry(task, dateutil.parser.parse(start), dateutil.parser.parse(stop))
+        archive = sync.download(self.Keyring, task.study_id, [task.user_id], [task.data_stream],
+                                time_start=start, time_end=stop, registry=registry)
+        num_saved = sync.save(self.Keyring, archive, task.user_id, task.output_dir, self.lock,
+                              self.passphrase, compress=self.compress, storage=self._storage(task.output_dir))
+
+        now = self.clock()
+        task.frontier = stop
+        task.last_poll = now
+        if num_saved:
+            task.last_data = now
+        self._state[task.key] = task.state()
+        self._dump_state()
+        logger.debug(f'memory budget after task {task.key}: {memory.get().metrics()}')
+        bandwidth = ratelimit.bandwidth()
+        if bandwidth:
+            logger.debug(f'bandwidth after task {task.key}: {bandwidth.metrics()}')
+        hedger = hedging.get()
+        if hedger:
+            logger.debug(f'hedged requests after task {task.key}: {hedger.metrics()}')
+        return resume is None
+
+    def _registry(self, task: Task, start: datetime, stop: datetime) -> dict[str, str]:
+        """
+        Get the registry entries of a task that fall within a window, the server only needs those to
+        skip the files that were already saved. The registry file is only read again once it changed.
+        """
+        registry_file = os.path.join(task.output_dir, task.user_id, '.registry')
+        try:
+            st = os.stat(registry_file)
+        except FileNotFoundError:
+            return {}
+        cached = self._registries.get(registry_file)
+        if not cached or cached[:2] != (st.st_mtime_ns, st.st_size):
+            with open(registry_file) as fo:
+                parsed: dict[str, tuple[str, tuple[str, datetime] | None]] = {}
+                for key, value in json.load(fo).items():
+                    match = coverage.parse_registry_key(key)
+                    # keep what cannot be parsed, the server may need it
+                    parsed[key] = (value, match[1:] if match else None)
+            cached = (st.st_mtime_ns, st.st_size, parsed)
+            self._registries[registry_file] = cached
+        return {key: value for key, (value, match) in cached[2].items()
+                if not match or (match[0] == task.data_stream and start <= match[1] < stop)}
+
+    def _storage(self, study_dir: str) -> Storage | None:
+        if not self.storage:
+            return None
+        if study_dir not in self._storages:
+            self._storages[study_dir] = self.storage(study_dir)
+        return self._storages[study_dir]
+
+    def run(self, stop: threading.Event | None = None, max_tasks: int | None = None):
+        """
+        Run tasks as they become due until `stop` is set (or `max_tasks` tasks have run)
+        """
+        stop = stop or threading.Event()
+        num_tasks = 0
+        while not stop.is_set() and (max_tasks is None or num_tasks < max_tasks):
+            if not self._last_refresh or self.clock() - self._last_refresh >= self.refresh:
+                self.discover()
+            due = self.scheduler.peek()
+            if due is None:
+                stop.wait(min(self.refresh, 60))
+                continue
+            wait = due - self.clock()
+            if wait > 0:
+                # wake up for the next refresh too, and never sleep so long that a stop is missed
+                stop.wait(min(wait, self.refresh, 60))
+                continue
+            _, task = self.scheduler.pop()
+            caught_up = True
+            try:
+                caught_up = self.run_task(task)
+            except Exception as e:
+                # keep going, the task will be retried at its next due time
+                logger.exception(f'task {task.key} failed: {e}')
+                task.last_poll = self.clock()
+            self.scheduler.reschedule(task, caught_up=caught_up)
+            num_tasks += 1
+
+    def _load_state(self) -> dict[str, dict]:
+        if not os.path.exists(self.state_file):
+            return {}
+        with open(self.state_file) as fo:
+            return json.load(fo)
+
+    def _dump_state(self):
+        if not os.path.exists(self.output_dir):
+            fileio.makedirs(self.output_dir, umask=0o077)
+        content = json.dumps(self._state, indent=2)
+        fileio.atomic_write(self.state_file, content.encode(locale.getpreferredencoding()))
@@ -0,0 +1,178 @@
+"""
+Sync several Beiwe deployments at the same time from one keyring
+
+The keyring file is decrypted once (see `mano.keyrings`). Every deployment gets its own
+`mano.client.Client`, with its own connection pool and rate limit, and its own pool of worker threads
+that backfill its participants into `<output_base>/<deployment>/<study_name>/<user_id>`, so a slow or
+failing deployment does not hold up the others. Once every deployment is done, one report of the
+whole run is returned (and written to a file if asked for).
+"""
+import json
+import locale
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import mano
+import mano.client as client
+import mano.fileio as fileio
+import mano.sync as sync
+from mano.cache import MetadataCache
+
+logger = logging.getLogger(__name__)
+
+
+class DeploymentError(Exception):
+    pass
+
+
+def sync_deployments(
+        Keyrings: dict[str, dict[str, str]],
+        output_base: str,
+        deployments: list[str] | None = None,
+        study_ids: list[str] | None = None,
+        start_date: str = sync.BACKFILL_START_DATE,
+        data_streams: list[str] | None = None,
+        lock: list[str] | None = None,
+        passphrase: str | None = None,
+        compress: dict[str, str] | None = None,
+        workers: int = 2,
+        rate: float | None = None,
+        burst: float | None = None,
+        cache: MetadataCache | None = None,
+        report_file: str | None = None,
+        recent_first: bool = False,
+        profile: str | None = None,
+    ) -> dict:
+    """
+    Backfill every participant of every study of several deployments in parallel
+
+    :param Keyrings: Keyrings by deployment name, see `mano.keyrings`
+    :param deployments: Deployments to sync, every deployment in `Keyrings` if None
+    :param study_ids: Studies to sync, all studies of each deployment if None
+    :param workers: Participants backfilled at the same time, per deployment
+    :param rate: Requests per second, per deployment, unlimited if None
+    :param burst: Requests per deployment that may be sent at once before the rate applies
+    :param report_file: Also write the report to this file
+    :param recent_first: Backfill each participant newest window first, see `mano.sync.backfill`
+    :param profile: Profile every backfill window into `<profile>/<deployment>`, see `mano.profiling`
+    :returns: Report with one entry per deployment, see `_sync_deployment`
+    """
+    if deployments is None:
+        deployments = sorted(Keyrings)
+    unknown = [name for name in deployments if name not in Keyrings]
+    if unknown:
+        raise DeploymentError(f'deployments not found in keyring: {", ".join(unknown)}')
+    if workers < 1:
+        raise DeploymentError(f'workers must be at least 1, got {workers}')
+
+    started = datetime.now()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(len(deployments), 1), thread_name_prefix='mano-deployment') as pool:
+        futures = {
+            pool.submit(_sync_deployment, name, Keyrings[name], os.path.join(output_base, name), study_ids,
+                        start_date, data_streams, lock, passphrase, compress, workers, rate, burst, cache,
+                        recent_first, os.path.join(profile, name) if profile else None): name
+            for name in deployments
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    report = {
+        'started': started.isoformat(timespec='seconds'),
+        'finished': datetime.now().isoformat(timespec='seconds'),
+        'seconds': round((datetime.now() - started).total_seconds(), 3),
+        'ok': all(not result['error'] and not result['failed'] for result in results.values()),
+        'deployments': [results[name] for name in deployments],
+    }
+    if report_file:
+        fileio.atomic_write(report_file, json.dumps(report, indent=2).encode(locale.getpreferredencoding()))
+    return report
+
+
+def _sync_deployment(
+        name: str,
+        Keyring: dict[str, str],
+        output_dir: str,
+        study_ids: list[str] | None,
+        start_date: str,
+        data_streams: list[str] | None,
+        lock: list[str] | None,
+        passphrase: str | None,
+        compress: dict[str, str] | None,
+        workers: int,
+        rate: float | None,
+        burst: float | None,
+        cache: MetadataCache | None,
+        recent_first: bool = False,
+        profile: str | None = None,
+    ) -> dict:
+    """
+    Backfill the participants of one deployment. Errors are recorded in the result, they never
+    affect other deployments.
+
+    :returns: {'deployment', 'url', 'studies', 'users', 'completed', 'failed', 'requests',
+              'rate_limited_seconds', 'seconds', 'error'}
+    """
+    started = time.monotonic()
+    result: dict = {
+        'deployment': name,
+        'url': Keyring.get('URL'),
+        'studies': 0,
+        'users': 0,
+        'completed': 0,
+        'failed': [],
+        'requests': 0,
+        'rate_limited_seconds': 0.0,
+        'seconds': 0.0,
+        'error': None,
+    }
+    with client.Client(pool_size=workers, rate=rate, burst=burst) as deployment_client:
+        try:
+            with client.use(deployment_client):
+                tasks = []
+                for study_name, study_id in mano.studies(Keyring, cache=cache):
+                    if study_ids and study_id not in study_ids:
+                        continue
+                    result['studies'] += 1
+                    study_dir = os.path.join(output_dir, study_name or study_id)
+                    tasks += [(study_id, study_dir, user_id) for user_id in mano.users(Keyring, study_id, cache=cache)]
+            result['users'] = len(tasks)
+            logger.info(f'deployment {name}: backfilling {len(tasks)} users of {result["studies"]} studies')
+
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'mano-{name}') as pool:
+                futures = {
+                    pool.submit(_backfill, deployment_client, Keyring, study_id, user_id, study_dir, start_date,
+                                data_streams, lock, passphrase, compress, recent_first, profile): (study_id, user_id)
+                    for study_id, study_dir, user_id in tasks
+                }
+                for future in as_completed(futures):
+                    study_id, user_id = futures[future]
+                    try:
+                        future.result()
+                        result['completed'] += 1
+                    except Exception as e:
+                        logger.exception(f'deployment {name}: backfill of user {user_id} failed: {e}')
+                        result['failed'].append({'study_id': study_id, 'user_id': user_id, 'error': repr(e)})
+        except Exception as e:
+            logger.exception(f'deployment {name} failed: {e}')
+            result['error'] = repr(e)
+        result['requests'] = deployment_client.requests
+        if deployment_client.limiter:
+            result['rate_limited_seconds'] = round(deployment_client.limiter.waited, 3)
+    result['seconds'] = round(time.monotonic() - started, 3)
+    return result
+
+
+def _backfill(deployment_client: client.Client, Keyring: dict[str, str], study_id: str, user_id: str,
+              output_dir: str, start_date: str, data_streams: list[str] | None, lock: list[str] | None,
+              passphrase: str | None, compress: dict[str, str] | None, recent_first: bool = False,
+              profile: str | None = None):
+    logger.debug(f'backfilling user {user_id} in {threading.current_thread().name}')
+    with client.use(deployment_client):
+        sync.backfill(Keyring, study_id, user_id, output_dir, start_date=start_date, data_streams=data_streams,
+                      lock=lock, passphrase=passphrase, compress=compress, recent_first=recent_first,
+                      profile=profile)
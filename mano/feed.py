@@ -0,0 +1,314 @@
+"""
+Append-only change feed of saved files
+
+`mano.sync.save` appends one record per saved file to the feed of its output directory, so
+downstream processors can pick up new files without scanning the output directory. The feed is a
+series of JSON lines segments in `<output_dir>/.feed`, each named after the offset of its first
+record, and a new segment is started once the current one holds SEGMENT_RECORDS records. Every
+record has an offset one greater than the record before it:
+
+    {"offset": 41, "target": "<user_id>/gps/2018-06-15 16_00_00.csv", "user_id": "<user_id>",
+     "data_stream": "gps", "timestamp": "2018-06-15T16:00:00", "size": 1234, "crc": 305419896,
+     "locked": false, "time": "2024-01-01T12:00:00"}
+
+Members of kept archives (see `mano.archive`) are recorded as well, with an `archived` field holding
+the path of their archive.
+
+A `Consumer` reads the records after its cursor, which is kept in `<output_dir>/.feed/cursors` so
+that a processor that restarts continues where it left off.
+"""
+import json
+import locale
+import logging
+import os
+import re
+import time
+from collections.abc import Iterable, Iterator
+
+import mano.fileio as fileio
+from mano.coverage import parse_target
+from mano.locking import FileLock
+
+FEED_DIR = '.feed'
+CURSORS_DIR = 'cursors'
+SEGMENT_EXT = '.log'
+SEGMENT_RECORDS = 100000
+# bytes read from the end of a segment to find its last record
+TAIL_SIZE = 64 * 1024
+LOCK_FILE = '.lock'
+LOCK_EXT = '.lock'
+CONSUMER_EXPR = re.compile(r'^[\w.-]+$')
+
+logger = logging.getLogger(__name__)
+
+
+class FeedError(Exception):
+    pass
+
+
+def feed_dir(output_dir: str) -> str:
+    return os.path.join(output_dir, FEED_DIR)
+
+
+def segments(output_dir: str) -> list[tuple[int, str]]:
+    """
+    List the segments of a feed as (first offset, path), oldest first
+    """
+    directory = feed_dir(output_dir)
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        base, ext = os.path.splitext(name)
+        if ext == SEGMENT_EXT and base.isdigit():
+            found.append((int(base), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def _segment_file(output_dir: str, first_offset: int) -> str:
+    return os.path.join(feed_dir(output_dir), f'{first_offset:020d}{SEGMENT_EXT}')
+
+
+def _records(segment: str) -> Iterator[dict]:
+    with open(segment, encoding='utf-8') as fo:
+        for line in fo:
+            # ignore a torn final line
+            if not line.endswith('\n'):
+                break
+            yield json.loads(line)
+
+
+def _tail(segment: str, first_offset: int) -> tuple[int, int]:
+    """
+    Count the complete records of a segment, and get the size of the segment up to the last one,
+    from the offset of its last record
+    """
+    size = os.path.getsize(segment)
+    with open(segment, 'rb') as fo:
+        start = max(size - TAIL_SIZE, 0)
+        fo.seek(start)
+        data = fo.read()
+    end = data.rfind(b'\n')
+    previous = data.rfind(b'\n', 0, end) if end >= 0 else -1
+    if end < 0 or (previous < 0 and start > 0):
+        # no complete record in the tail, e.g. after a long torn record
+        return _scan(segment)
+    last = json.loads(data[previous + 1:end + 1])
+    return last['offset'] - first_offset + 1, start + end + 1
+
+
+def _scan(segment: str) -> tuple[int, int]:
+    count = 0
+    size = 0
+    with open(segment, 'rb') as fo:
+        for line in fo:
+            if not line.endswith(b'\n'):
+                break
+            count += 1
+            size += len(line)
+    return count, size
+
+
+def head(output_dir: str) -> int:
+    """
+    Get the offset the next record of a feed gets
+    """
+    found = segments(output_dir)
+    if not found:
+        return 0
+    first_offset, segment = found[-1]
+    return first_offset + _tail(segment, first_offset)[0]
+
+
+def first(output_dir: str) -> int:
+    """
+    Get the offset of the oldest record that is still in a feed
+    """
+    found = segments(output_dir)
+    return found[0][0] if found else 0
+
+
+def record(user_id: str, entry: dict, lock_ext: str = LOCK_EXT) -> dict:
+    """
+    Make a feed record (without offset) for a manifest entry of a saved file (see `mano.manifest`)
+    """
+    target = entry['target']
+    parsed = parse_target(target)
+    parts = target.split('/')
+    item = {
+        'target': target,
+        'user_id': user_id,
+        'data_stream': parsed[0] if parsed else (parts[1] if len(parts) > 2 else None),
+        'timestamp': parsed[1].isoformat() if parsed else None,
+        'size': entry['size'],
+        'crc': entry['crc'],
+        'locked': target.endswith(lock_ext),
+    }
+    # the file is in a kept archive, not in the output directory
+    if entry.get('archived'):
+        item['archived'] = entry['archived']
+    return item
+
+
+def append(output_dir: str, records: Iterable[dict], segment_records: int = SEGMENT_RECORDS) -> int:
+    """
+    Append records to a feed, assigning their offsets
+
+    :returns: Number of records appended
+    """
+    records = list(records)
+    if not records:
+        return 0
+    directory = feed_dir(output_dir)
+    os.makedirs(directory, exist_ok=True)
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    # several processes may be saving into the same output directory
+    with FileLock(os.path.join(directory, LOCK_FILE)):
+        found = segments(output_dir)
+        if found:
+            first_offset, segment = found[-1]
+            count, size = _tail(segment, first_offset)
+            if os.path.getsize(segment) != size:
+                # drop a torn record left behind by a crash
+                with open(segment, 'r+b') as fo:
+                    fo.truncate(size)
+        else:
+            first_offset, segment, count = 0, _segment_file(output_dir, 0), 0
+        offset = first_offset + count
+        lines: list[str] = []
+        for item in records:
+            if count == segment_records:
+                _write(segment, lines)
+                lines = []
+                first_offset, segment, count = offset, _segment_file(output_dir, offset), 0
+                logger.debug(f'starting feed segment {segment}')
+            lines.append(json.dumps({'offset': offset, **item, 'time': now}, sort_keys=True) + '\n')
+            offset += 1
+            count += 1
+        _write(segment, lines)
+    return len(records)
+
+
+def _write(segment: str, lines: list[str]):
+    if not lines:
+        return
+    with open(segment, 'a', encoding='utf-8') as fo:
+        fo.write(''.join(lines))
+        fo.flush()
+        os.fsync(fo.fileno())
+
+
+def read(output_dir: str, offset: int = 0, limit: int | None = None) -> Iterator[dict]:
+    """
+    Read the records of a feed from an offset on
+
+    :raises FeedError: If the records at the offset were removed from the feed
+    """
+    found = segments(output_dir)
+    if found and offset < found[0][0]:
+        raise FeedError(f'records before offset {found[0][0]} were removed, cannot read from offset {offset}')
+    remaining = limit
+    for i, (first_offset, segment) in enumerate(found):
+        # skip segments that end before the offset
+        if i + 1 < len(found) and found[i + 1][0] <= offset:
+            continue
+        for item in _records(segment):
+            if item['offset'] < offset:
+                continue
+            if remaining is not None:
+                if remaining <= 0:
+                    return
+                remaining -= 1
+            yield item
+
+
+def prune(output_dir: str, keep: int = 1) -> int:
+    """
+    Remove the oldest segments that every consumer has read past, keeping at least `keep` segments
+
+    :returns: Number of segments removed
+    """
+    directory = feed_dir(output_dir)
+    if not os.path.isdir(directory):
+        return 0
+    # the newest segment is where records are appended
+    keep = max(keep, 1)
+    with FileLock(os.path.join(directory, LOCK_FILE)):
+        found = segments(output_dir)
+        positions = [Consumer(output_dir, name).position for name in consumers(output_dir)]
+        oldest = min(positions) if positions else head(output_dir)
+        removed = 0
+        for i, (_, segment) in enumerate(found[:max(len(found) - keep, 0)]):
+            # a segment is read once its successor starts at or before the oldest cursor
+            if found[i + 1][0] > oldest:
+                break
+            os.remove(segment)
+            removed += 1
+    return removed
+
+
+def consumers(output_dir: str) -> list[str]:
+    """
+    List the consumers with a cursor
+    """
+    directory = os.path.join(feed_dir(output_dir), CURSORS_DIR)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-len('.json')] for name in os.listdir(directory) if name.endswith('.json'))
+
+
+class Consumer:
+    """
+    Read a feed incrementally, with a cursor that is persisted once records are processed
+
+        consumer = Consumer(output_dir, 'my-pipeline')
+        for record in consumer.poll():
+            process(record)
+            consumer.commit(record['offset'])
+    """
+
+    def __init__(self, output_dir: str, name: str):
+        if not CONSUMER_EXPR.match(name):
+            raise FeedError(f'invalid consumer name {name}, use letters, digits, ".", "_" and "-"')
+        self.output_dir = output_dir
+        self.name = name
+        self.cursor_file = os.path.join(feed_dir(output_dir), CURSORS_DIR, f'{name}.json')
+        self.position = self._load()
+
+    def _load(self) -> int:
+        if not os.path.exists(self.cursor_file):
+            return 0
+        with open(self.cursor_file) as fo:
+            return json.load(fo)['offset']
+
+    def poll(self, limit: int | None = 1000) -> list[dict]:
+        """
+        Get the records after the cursor, without moving it
+        """
+        return list(read(self.output_dir, self.position, limit))
+
+    def commit(self, offset: int):
+        """
+        Move the cursor past a processed record and persist it
+        """
+        if offset + 1 > self.position:
+            self._persist(offset + 1)
+
+    def seek(self, offset: int):
+        """
+        Move the cursor to an offset and persist it, e.g. to `first(output_dir)` after records were
+        pruned, or to `head(output_dir)` to skip everything saved so far
+        """
+        self._persist(offset)
+
+    def _persist(self, position: int):
+        os.makedirs(os.path.dirname(self.cursor_file), exist_ok=True)
+        cursor = json.dumps({'offset': position, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        fileio.atomic_write(self.cursor_file, cursor.encode(locale.getpreferredencoding()))
+        self.position = position
+
+    def lag(self) -> int:
+        """
+        Get the number of records after the cursor
+        """
+        return head(self.output_dir) - self.position
@@ -0,0 +1,64 @@
+"""
+Writing files safely
+
+Helpers shared by every module that writes state or data files: directories are created with a
+temporary umask, and files are written to a temporary file in the same directory that is renamed
+over the target, so readers never see a partly written file.
+"""
+import os
+import tempfile as tf
+from collections.abc import Generator
+from contextlib import contextmanager
+from typing import IO
+
+# compressed or re-encoded content is spooled in memory up to this size before it spills to disk
+SPOOL_SIZE = 64 * 1024 * 1024
+
+
+class WriteError(Exception):
+    pass
+
+
+def makedirs(path: str, umask: int | None = None, exist_ok: bool = True):
+    """
+    Create directories recursively with a temporary umask
+    """
+    old_umask = None
+    if umask is not None:
+        old_umask = os.umask(umask)
+    try:
+        os.makedirs(path, exist_ok=exist_ok)
+    finally:
+        if old_umask is not None:
+            os.umask(old_umask)
+
+
+def atomic_write(filename: str, content: bytes, overwrite: bool = True, permissions: int = 0o0644):
+    """
+    Write a file by first saving the content to a temporary file first, then
+    renaming the file. Overwrites silently by default o_o
+    """
+    with atomic_writer(filename, overwrite=overwrite, permissions=permissions) as tmp:
+        tmp.write(content)
+
+
+@contextmanager
+def atomic_writer(filename: str, overwrite: bool = True,
+                  permissions: int = 0o0644) -> Generator[IO[bytes], None, None]:
+    """
+    Same as `atomic_write`, but yields the temporary file so content can be streamed into it. The
+    temporary file is removed if anything goes wrong.
+    """
+    filename = os.path.expanduser(filename)
+    if not overwrite and os.path.exists(filename):
+        raise WriteError(f"file already exists: {filename}")
+    dirname = os.path.dirname(filename)
+    with tf.NamedTemporaryFile(dir=dirname, prefix='.', delete=False) as tmp:
+        try:
+            yield tmp
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    os.chmod(tmp.name, permissions)
+    os.rename(tmp.name, filename)
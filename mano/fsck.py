@@ -0,0 +1,278 @@
+"""
+Verify saved files against the manifest and local registry (a file system check for the output tree)
+
+Every file `mano.sync.save` writes is recorded in the user's manifest with its size and CRC-32.
+Files are hashed in parallel worker processes using memory mapped reads and reported as:
+
+- missing: in the manifest or registry, but not on disk
+- truncated: smaller than recorded in the manifest
+- corrupt: different size or checksum than recorded in the manifest
+- extra: on disk, but neither in the manifest nor the registry
+- unverified: on disk and in the registry, but saved before manifests were kept
+
+Members of kept archives (see `mano.archive`) are recorded in the manifest as `archived`, they are
+present as long as their archive is.
+"""
+import json
+import locale
+import logging
+import mmap
+import os
+import re
+import zlib
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import timedelta
+
+import mano
+import mano.coverage as coverage
+import mano.fileio as fileio
+import mano.manifest as manifest
+import mano.summary as summary
+import mano.sync as sync
+from mano.storage import DirectoryStorage
+from mano.workqueue import WorkItem, WorkQueue
+
+MISSING = 'missing'
+TRUNCATED = 'truncated'
+CORRUPT = 'corrupt'
+EXTRA = 'extra'
+UNVERIFIED = 'unverified'
+PROBLEMS = (MISSING, TRUNCATED, CORRUPT, EXTRA, UNVERIFIED)
+# problems that are fixed by downloading the file again
+DAMAGED = (MISSING, TRUNCATED, CORRUPT)
+
+# beiwe file names use ISO timestamps, saved file names use a file system friendly variant
+ISO_EXPR = re.compile(r'(\d{4}-\d{2}-\d{2})T(\d{2}):(\d{2}):(\d{2})')
+
+logger = logging.getLogger(__name__)
+
+
+class Report:
+    """
+    Targets with problems, by kind of problem
+    """
+
+    def __init__(self) -> None:
+        self.checked = 0
+        self.problems: dict[str, list[str]] = {problem: [] for problem in PROBLEMS}
+
+    def add(self, problem: str, target: str):
+        self.problems[problem].append(target)
+
+    @property
+    def ok(self) -> bool:
+        return not any(self.problems[problem] for problem in DAMAGED + (EXTRA,))
+
+    def summary(self) -> dict[str, int]:
+        return {'checked': self.checked} | {problem: len(targets) for problem, targets in self.problems.items()}
+
+
+def registry_member(key: str, user_id: str) -> str | None:
+    """
+    Convert a registry key e.g., `CHUNKED_DATA/<study_id>/<user_id>/gps/2018-06-15T16:00:00.csv`
+    to the name of the archive member it is saved from e.g., `<user_id>/gps/2018-06-15 16_00_00.csv`
+    """
+    index = key.find(f'{user_id}/')
+    if index < 0 or (index > 0 and key[index - 1] != '/'):
+        return None
+    return ISO_EXPR.sub(r'\1 \2_\3_\4', key[index:])
+
+
+def checksum(path: str) -> int:
+    """
+    Compute the CRC-32 of a file using a memory mapped read
+    """
+    with open(path, 'rb') as fo:
+        if os.fstat(fo.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                return zlib.crc32(view)
+
+
+def _check(tasks: list[tuple[str, str, int, int]]) -> list[tuple[str, str]]:
+    """
+    Check a chunk of (target, path, size, crc) files, in a worker process
+    """
+    problems = []
+    for target, path, size, crc in tasks:
+        try:
+            actual_size = os.stat(path).st_size
+        except FileNotFoundError:
+            problems.append((MISSING, target))
+            continue
+        if actual_size < size:
+            problems.append((TRUNCATED, target))
+        elif actual_size > size or checksum(path) != crc:
+            problems.append((CORRUPT, target))
+    return problems
+
+
+def user_ids(output_dir: str) -> list[str]:
+    """
+    List the user directories in an output directory
+    """
+    return sorted(entry.name for entry in os.scandir(output_dir)
+                  if entry.is_dir() and not entry.name.startswith('.'))
+
+
+def verify(
+        output_dir: str,
+        users: list[str] | None = None,
+        workers: int | None = None,
+        chunk_size: int = 256,
+        repair: bool = False,
+        queue: WorkQueue | None = None,
+        study_id: str | None = None,
+        study_name: str | None = None,
+    ) -> Report:
+    """
+    Verify the files saved in the classic directory layout under `output_dir`
+
+    :param users: Users to verify, every user directory if None
+    :param workers: Number of worker processes (defaults to the number of CPUs)
+    :param chunk_size: Number of files checked per task sent to a worker
+    :param repair: Delete damaged files and drop missing and damaged files from the local registry
+                   and coverage index, so that `mano.sync.gapfill` downloads them again
+    :param queue: Also queue a download of each day with damaged files for `study_id`
+    """
+    if queue and not study_id:
+        raise ValueError('a study_id is needed to queue downloads')
+    report = Report()
+    storage = DirectoryStorage(output_dir)
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for user_id in users or user_ids(output_dir):
+            user_report = _verify_user(output_dir, user_id, storage, executor, chunk_size, 4 * workers)
+            report.checked += user_report.checked
+            for problem, targets in user_report.problems.items():
+                report.problems[problem].extend(targets)
+            damaged = [target for problem in DAMAGED for target in user_report.problems[problem]]
+            if damaged and repair:
+                _repair(output_dir, user_id, damaged, storage)
+            if damaged and queue and study_id:
+                _enqueue(queue, study_id, study_name, user_id, damaged)
+    logger.info(f'verified {output_dir}: {report.summary()}')
+    return report
+
+
+def _verify_user(output_dir: str, user_id: str, storage: DirectoryStorage, executor: ProcessPoolExecutor,
+                 chunk_size: int, max_pending: int) -> Report:
+    report = Report()
+    entries = manifest.load(output_dir, user_id)
+    members = {entry['member'] for entry in entries.values()}
+
+    # files in the registry that were never recorded in a manifest
+    registry = _load_registry(output_dir, user_id)
+    unrecorded = set()
+    for key in registry:
+        member = registry_member(key, user_id)
+        if member and member not in members:
+            unrecorded.add(member)
+
+    # members of kept archives are not on disk, only their archive is
+    for target, entry in entries.items():
+        if entry.get('archived'):
+            report.checked += 1
+            if isinstance(entry['archived'], str) and not os.path.exists(entry['archived']):
+                report.add(MISSING, target)
+
+    # hash files in the manifest in worker processes, with a bounded number of chunks in flight
+    tasks = ((target, storage.path(target), entry['size'], entry['crc']) for target, entry in entries.items()
+             if not entry.get('archived'))
+    pending: deque[Future] = deque()
+    for chunk in _chunks(tasks, chunk_size):
+        report.checked += len(chunk)
+        pending.append(executor.submit(_check, chunk))
+        if len(pending) >= max_pending:
+            for problem, target in pending.popleft().result():
+                report.add(problem, target)
+    while pending:
+        for problem, target in pending.popleft().result():
+            report.add(problem, target)
+
+    # files on disk that are not in the manifest
+    found = set()
+    for target in storage.names(f'{user_id}/'):
+        if target in entries:
+            continue
+        member = _strip_extensions(target)
+        if member in unrecorded:
+            found.add(member)
+            report.add(UNVERIFIED, target)
+        else:
+            report.add(EXTRA, target)
+    for member in sorted(unrecorded - found):
+        report.add(MISSING, member)
+    return report
+
+
+def _repair(output_dir: str, user_id: str, damaged: list[str], storage: DirectoryStorage):
+    """
+    Delete damaged files and forget them in the registry, manifest, coverage index and summary
+    """
+    members = {_strip_extensions(target) for target in damaged}
+    user_dir = os.path.join(output_dir, user_id)
+    with sync._user_lock(user_dir):
+        for target in damaged:
+            if storage.exists(target):
+                os.remove(storage.path(target))
+        registry = _load_registry(output_dir, user_id)
+        registry = {key: value for key, value in registry.items() if registry_member(key, user_id) not in members}
+        content = json.dumps(registry, indent=2)
+        fileio.atomic_write(os.path.join(user_dir, '.registry'), content.encode(locale.getpreferredencoding()))
+        manifest.remove(output_dir, user_id, damaged)
+        coverage.rebuild(output_dir, user_id, storage)
+    summary.rebuild(output_dir, user_id)
+    logger.info(f'dropped {len(members)} damaged files for user {user_id}')
+
+
+def _enqueue(queue: WorkQueue, study_id: str, study_name: str | None, user_id: str, damaged: list[str]):
+    """
+    Queue one download per data stream and day with damaged files
+    """
+    days = set()
+    for target in damaged:
+        parsed = coverage.parse_target(target)
+        if parsed:
+            data_stream, hour = parsed
+            days.add((data_stream, hour.replace(hour=0)))
+    for data_stream, day in sorted(days):
+        time_start = day.strftime(mano.TIME_FORMAT)
+        time_end = (day + timedelta(days=1)).strftime(mano.TIME_FORMAT)
+        queue.put(WorkItem(study_id, user_id, time_start, time_end, [data_stream], study_name))
+
+
+def _load_registry(output_dir: str, user_id: str) -> dict[str, str]:
+    registry_file = os.path.join(output_dir, user_id, '.registry')
+    if not os.path.exists(registry_file):
+        return {}
+    with open(registry_file) as fo:
+        return json.load(fo)
+
+
+def _strip_extensions(target: str) -> str:
+    """
+    Remove lock and codec extensions from a target to get the archive member name
+    """
+    if target.endswith(sync.LOCK_EXT):
+        target = target[:-len(sync.LOCK_EXT)]
+    codec = sync.compression.for_filename(target)
+    if codec:
+        target = target[:-len(codec.extension)]
+    return target
+
+
+def _chunks(iterable: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
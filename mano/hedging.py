@@ -0,0 +1,197 @@
+"""
+Hedged requests for windows that stall
+
+A few data requests of a large backfill can take minutes before the server sends a response, while
+every other window is done in seconds. A `Hedger` keeps the recent latencies of requests (the time
+until the response headers arrive, before any bytes of the archive flow) and, when a request takes
+longer than a high percentile of them, sends the same request again. The delay runs from when a
+request is sent, not from when it was queued for a free worker, so a busy pool does not hedge
+requests that never had a chance. The first response wins. The other request is cancelled if it is
+still waiting for a worker, or closed as soon as its headers arrive. Extra requests are capped to a
+fraction of all requests so that a slow server is not flooded with duplicates, and `Hedger.metrics`
+counts how often hedging happened and won.
+
+Hedging is off unless a `Hedger` is passed to `mano.sync.download`, or set with `configure` or the
+`--hedge` command line option.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import requests
+
+import mano.client as client
+
+logger = logging.getLogger(__name__)
+
+
+class HedgingError(Exception):
+    pass
+
+
+class Hedger:
+    """
+    Send a duplicate of requests that take longer than a percentile of recent latencies
+    """
+
+    def __init__(self, percentile: float = 95.0, max_ratio: float = 0.1, min_samples: int = 20,
+                 min_delay: float = 1.0, samples: int = 1000, max_workers: int = 32):
+        """
+        :param percentile: Hedge requests slower than this percentile of recent latencies
+        :param max_ratio: At most this fraction of requests are hedged
+        :param min_samples: Latencies to collect before hedging anything
+        :param min_delay: Never hedge a request before this many seconds
+        :param samples: Number of recent latencies to keep
+        :param max_workers: Requests in flight at the same time, hedges included
+        """
+        if not 0 < percentile < 100:
+            raise HedgingError(f'percentile must be between 0 and 100, got {percentile}')
+        if max_ratio < 0:
+            raise HedgingError(f'max_ratio must not be negative, got {max_ratio}')
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.latencies: deque[float] = deque(maxlen=samples)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_won = 0
+        self.capped = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mano-hedge')
+
+    def delay(self) -> float | None:
+        """
+        Get the seconds after which a request is hedged, or None until enough latencies are known
+        """
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        # nearest rank
+        rank = max(int(len(latencies) * self.percentile / 100.0 + 0.5), 1)
+        return max(latencies[rank - 1], self.min_delay)
+
+    def request(self, send: Callable[[], requests.Response]) -> requests.Response:
+        """
+        Send a request, and send it again if no response arrives before `delay()` seconds. The first
+        response (or the last error, if both fail) is returned.
+
+        :param send: Sends the request, called once more for a hedge. It runs in another thread
+                     with the `mano.client.Client` of the calling thread.
+        """
+        with self._lock:
+            self.requests += 1
+        delay = self.delay()
+        primary, started = self._submit(send)
+        attempts = [primary]
+        try:
+            if delay is not None:
+                # time spent waiting for a free worker does not count
+                started.wait()
+                done, _ = wait(attempts, timeout=delay)
+                if not done and self._allow_hedge():
+                    logger.info(f'no response after {delay:.1f}s, sending a hedged request')
+                    attempts.append(self._submit(send)[0])
+            pending = set(attempts)
+            while True:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                succeeded = [future for future in done if future.exception() is None]
+                if succeeded or not pending:
+                    break
+            winner = succeeded[0] if succeeded else next(iter(done))
+        except BaseException:
+            for future in attempts:
+                _drop(future)
+            raise
+        if winner is not primary:
+            with self._lock:
+                self.hedge_won += 1
+        for future in attempts:
+            if future is not winner:
+                _drop(future)
+        return winner.result()
+
+    def _allow_hedge(self) -> bool:
+        with self._lock:
+            if self.hedged + 1 > self.max_ratio * self.requests:
+                self.capped += 1
+                return False
+            self.hedged += 1
+            return True
+
+    def _submit(self, send: Callable[[], requests.Response]) -> tuple['Future[requests.Response]', threading.Event]:
+        """
+        Send a request from the pool
+
+        :returns: Future of the response, and an event set once a worker sends the request
+        """
+        current = client.current()
+        sent = threading.Event()
+
+        def attempt() -> requests.Response:
+            sent.set()
+            started = time.monotonic()
+            with client.use(current):
+                response = send()
+            with self._lock:
+                self.latencies.append(time.monotonic() - started)
+            return response
+
+        return self._pool.submit(attempt), sent
+
+    def metrics(self) -> dict[str, float | int | None]:
+        """
+        Requests, hedges sent, hedges that won, hedges skipped because of the cap, and the current
+        hedging delay
+        """
+        delay = self.delay()
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hedged': self.hedged,
+                'hedge_won': self.hedge_won,
+                'capped': self.capped,
+                'delay': round(delay, 3) if delay is not None else None,
+            }
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+
+def _drop(future: 'Future[requests.Response]'):
+    """
+    Cancel a request that is still waiting for a worker, or close its response as soon as it arrives
+    """
+    if not future.cancel():
+        future.add_done_callback(_close)
+
+
+def _close(future: 'Future[requests.Response]'):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+_default: Hedger | None = None
+
+
+def get() -> Hedger | None:
+    """
+    Get the process-wide hedger, if one is configured
+    """
+    return _default
+
+
+def configure(percentile: float | None, max_ratio: float = 0.1, **kwargs) -> Hedger | None:
+    """
+    Hedge every data request of this process that is not given a `hedge=` option, or stop doing so
+    if `percentile` is None
+    """
+    global _default
+    if _default:
+        _default.close()
+    _default = Hedger(percentile, max_ratio=max_ratio, **kwargs) if percentile else None
+    return _default
@@ -0,0 +1,135 @@
+"""
+Advisory inter-process file locks
+
+POSIX record locks (`fcntl.lockf`) are used where available since, unlike `flock`, they also work
+on NFS. On Windows `msvcrt.locking` is used instead.
+"""
+import os
+import sys
+import threading
+import time
+from types import TracebackType
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+# POSIX record locks do not exclude other threads of the same process (and closing any descriptor
+# of the file drops the process' lock), so threads are serialized per lock file first
+_thread_locks: dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+
+
+class LockError(Exception):
+    pass
+
+
+class FileLock:
+    """
+    Exclusive lock on a lock file, usable as a context manager. The lock file is created if it does
+    not exist and is never removed, since removing it would race with other processes. The lock
+    excludes other processes as well as other threads of the same process.
+    """
+
+    def __init__(self, path: str, timeout: float | None = None, poll: float = 0.05):
+        """
+        :param path: Lock file path
+        :param timeout: Seconds to wait for the lock, forever if None
+        :param poll: Seconds between attempts when waiting with a timeout
+        """
+        self.path = os.path.expanduser(path)
+        self.timeout = timeout
+        self.poll = poll
+        self._fd: int | None = None
+        with _thread_locks_guard:
+            self._thread_lock = _thread_locks.setdefault(os.path.realpath(self.path), threading.Lock())
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Acquire the lock
+
+        :param blocking: Wait for the lock (up to `timeout`), otherwise try once
+        :returns: True if the lock was acquired
+        """
+        if self._fd is not None:
+            raise LockError(f'lock is already held: {self.path}')
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        timeout: float = -1 if self.timeout is None or not blocking else self.timeout
+        if not self._thread_lock.acquire(blocking, timeout=timeout):
+            return False
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o0644)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        try:
+            while True:
+                if blocking and deadline is None:
+                    _lock(fd, blocking=True)
+                    break
+                if _lock(fd, blocking=False):
+                    break
+                if not blocking or (deadline is not None and time.monotonic() >= deadline):
+                    os.close(fd)
+                    self._thread_lock.release()
+                    return False
+                time.sleep(self.poll)
+        except BaseException:
+            os.close(fd)
+            self._thread_lock.release()
+            raise
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            _unlock(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            self._thread_lock.release()
+
+    def __enter__(self) -> 'FileLock':
+        if not self.acquire():
+            raise LockError(f'timed out waiting for lock {self.path}')
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, exc: BaseException | None,
+                 tb: TracebackType | None):
+        self.release()
+
+
+def _lock(fd: int, blocking: bool) -> bool:
+    if sys.platform == 'win32':
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+                time.sleep(0.05)
+    else:
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            if blocking:
+                raise
+            return False
+        return True
+
+
+def _unlock(fd: int):
+    if sys.platform == 'win32':
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.lockf(fd, fcntl.LOCK_UN)
@@ -0,0 +1,91 @@
+"""
+Manifest of saved files
+
+`mano.sync.save` appends one JSON line per saved file to `<output_dir>/<user_id>/.manifest`,
+recording the size and CRC-32 of the bytes written (after compression and encryption) and of the
+original archive member. The last line for a target wins. `mano.fsck` uses the manifest to verify
+the saved files.
+"""
+import hashlib
+import json
+import os
+import zlib
+from collections.abc import Iterable
+from typing import IO
+
+import mano.fileio as fileio
+
+MANIFEST_FILE = '.manifest'
+
+
+class ChecksumWriter:
+    """
+    Wrap a writable binary file object to count the bytes written and compute their CRC-32, and
+    optionally their SHA-256
+    """
+
+    def __init__(self, fileobj: IO[bytes], sha256: 'hashlib._Hash | None' = None):
+        """
+        :param fileobj: Writable binary file object
+        :param sha256: Update this hash with the bytes written as well e.g., `hashlib.sha256()`
+        """
+        self.fileobj = fileobj
+        self.size = 0
+        self.crc = 0
+        self.sha256 = sha256
+
+    def write(self, b) -> int:
+        if self.sha256:
+            self.sha256.update(b)
+        self.crc = zlib.crc32(b, self.crc)
+        self.size += len(b)
+        return self.fileobj.write(b)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def writable(self) -> bool:
+        return True
+
+
+def manifest_file(output_dir: str, user_id: str) -> str:
+    return os.path.join(output_dir, user_id, MANIFEST_FILE)
+
+
+def append(output_dir: str, user_id: str, entries: Iterable[dict]):
+    """
+    Append entries to the manifest of a user. The caller must hold the user lock.
+    """
+    lines = ''.join(json.dumps(entry, sort_keys=True) + '\n' for entry in entries)
+    if not lines:
+        return
+    with open(manifest_file(output_dir, user_id), 'a', encoding='utf-8') as fo:
+        fo.write(lines)
+
+
+def remove(output_dir: str, user_id: str, targets: Iterable[str]):
+    """
+    Rewrite the manifest of a user without some targets. The caller must hold the user lock.
+    """
+    targets = set(targets)
+    entries = [entry for target, entry in load(output_dir, user_id).items() if target not in targets]
+    content = ''.join(json.dumps(entry, sort_keys=True) + '\n' for entry in entries)
+    fileio.atomic_write(manifest_file(output_dir, user_id), content.encode('utf-8'))
+
+
+def load(output_dir: str, user_id: str) -> dict[str, dict]:
+    """
+    Load the manifest of a user as a mapping of target to its latest entry
+    """
+    entries: dict[str, dict] = {}
+    filename = manifest_file(output_dir, user_id)
+    if not os.path.exists(filename):
+        return entries
+    with open(filename, encoding='utf-8') as fo:
+        for line in fo:
+            # ignore a torn final line
+            if not line.endswith('\n'):
+                break
+            entry = json.loads(line)
+            entries[entry['target']] = entry
+    return entries
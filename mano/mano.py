@@ -1,4 +1,5 @@
-from collections.abc import Generator
+from collections.abc import Generator, Iterable, Iterator
+import codecs
 from datetime import timedelta
 import getpass
 import json
@@ -6,12 +7,15 @@ import locale
 import logging
 import os
 import re
-from typing import Any
+from typing import Any, NoReturn
 
 import cryptease as crypt
 import lxml.html as html
 import requests
 
+import mano.client as client
+from mano.cache import MetadataCache
+
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +30,9 @@ DATA_STREAMS = Config['data_streams']
 TIME_FORMAT = Config['time_format']
 LOCALE = str(Config['locale'])
 
+# bytes read from streamed responses at a time
+CHUNK_SIZE = 64 * 1024
+
 locale.setlocale(locale.LC_ALL, LOCALE)
 
 
@@ -92,22 +99,35 @@ def interval(x: str) -> int:
     return int(offset.total_seconds())
 
 
-def studies(Keyring: dict[str, str]) -> Generator[tuple[str, str], None, None]:
+def studies(Keyring: dict[str, str], cache: MetadataCache | None = None) -> Generator[tuple[str, str], None, None]:
     """
     Request a list of studies
+
+    :param Keyring: Keyring dictionary
+    :param cache: Reuse the cached list if it has not changed on the server
+    :returns: Generator of (study_name, study_id)
     """
     # setup
     url = Keyring['URL'].rstrip('/') + '/get-studies/v1'
     payload = {'access_key': Keyring['ACCESS_KEY'], 'secret_key': Keyring['SECRET_KEY']}
 
     # request
-    resp = requests.post(url, data=payload, stream=True)
+    if cache is not None:
+        response = cache.fetch('POST', url, {'access_key': Keyring['ACCESS_KEY']},
+                               lambda resp: list(_parse_studies(resp)), data=payload)
+        # cached entries are JSON, so tuples come back as lists
+        yield from ((study_name, study_id) for study_name, study_id in response)
+        return
+    resp = client.post(url, data=payload, stream=True)
+    yield from _parse_studies(resp)
+
+
+def _parse_studies(resp: requests.Response) -> Generator[tuple[str, str], None, None]:
     if resp.status_code != requests.codes.OK:
         raise APIError(f'response not ok ({resp.status_code}) {resp.url}')
-    response: dict = json.loads(resp.content)
 
-    # yield each study name and id
-    for study_id, study_name in iter(response.items()):
+    # yield each study name and id as soon as it arrives
+    for study_id, study_name in _JSONStream(resp.iter_content(CHUNK_SIZE)):
         yield study_name, study_id
 
 
@@ -126,6 +146,19 @@ def keyring(
     # if no deployment string was provided, get keyring from environment
     if deployment is None:
         return keyring_from_env()
+    return keyrings(keyring_file, passphrase)[deployment]
+
+
+def keyrings(
+        keyring_file: str = '~/.nrg-keyring.enc',
+        passphrase: str | None = None
+    ) -> dict[str, dict[str, str]]:
+    """
+    Get the keyrings of every deployment, decrypting the keyring file once
+    :param keyring_file: Keyring file location
+    :param passphrase: Passphrase to decrypt keyring
+    :returns: Deployment keyrings by deployment name
+    """
     # if no passphrase was provided, get it from the environment or prompt
     if passphrase is None:
         if 'NRG_KEYRING_PASS' in os.environ:
@@ -146,7 +179,7 @@ def keyring(
         js = json.loads(content)
     except ValueError:
         raise KeyringError(f'could not decrypt file {keyring_file} (wrong passphrase perhaps?)')
-    return js[deployment]
+    return js
 
 
 def keyring_from_env() -> dict[str, str]:
@@ -198,7 +231,7 @@ def login(Keyring: dict[str, str]) -> requests.cookies.RequestsCookieJar:
     url = Keyring['URL'].rstrip('/') + '/validate_login'
     payload = {'username': Keyring['USERNAME'], 'password': Keyring['PASSWORD']}
     # request
-    resp = requests.post(url, data=payload)
+    resp = client.post(url, data=payload)
     if resp.status_code != requests.codes.OK:
         raise LoginError(f'response not ok ({resp.status_code}) for {resp.url}')
     # there is a redirect after login
@@ -208,19 +241,30 @@ def login(Keyring: dict[str, str]) -> requests.cookies.RequestsCookieJar:
 # FIXME: this function depends on the HTML structure of the Beiwe website, AND the content of the
 # page may not accurately represent the state of data collected by the study. beiwe-backend now has
 # an issue for this, #320
-def device_settings(Keyring: dict[str, str], study_id: str) -> Generator[tuple[str, str], None, None]:
+def device_settings(Keyring: dict[str, str], study_id: str,
+                    cache: MetadataCache | None = None) -> Generator[tuple[str, str], None, None]:
     """
     Get device settings for a Study
 
     :param Keyring: Keyring namespace
     :param study_id: Study ID
+    :param cache: Reuse the cached settings if the settings page has not changed
     :returns: Generator of sensor (name, setting)
     """
     # get login cookies
     cookies = login(Keyring)
     # request choose_study html page
     url = Keyring['URL'].rstrip('/') + f'/device_settings/{study_id}'
-    resp = requests.get(url, cookies=cookies)
+    if cache is not None:
+        settings = cache.fetch('GET', url, {'username': Keyring['USERNAME']},
+                               lambda resp: list(_parse_device_settings(resp)), cookies=cookies)
+        yield from ((name, value) for name, value in settings)
+        return
+    resp = client.get(url, cookies=cookies)
+    yield from _parse_device_settings(resp)
+
+
+def _parse_device_settings(resp: requests.Response) -> Generator[tuple[str, str], None, None]:
     if resp.status_code != requests.codes.OK:
         raise StudySettingsError(f'response not ok ({resp.status_code}) for url={resp.url}')
     # parse html page
@@ -239,13 +283,14 @@ def device_settings(Keyring: dict[str, str], study_id: str) -> Generator[tuple[s
         yield e.name, e.value
 
 
-def users(Keyring: dict[str, str], study_id: str) -> Generator[str, None, None]:
+def users(Keyring: dict[str, str], study_id: str, cache: MetadataCache | None = None) -> Generator[str, None, None]:
     """
     Request a list of users within a study
 
     :param Keyring: Keyring dictionary
     :param study_id: Study ID
-    :returns: Generator of (study_name, study_id)
+    :param cache: Reuse the cached list if it has not changed on the server
+    :returns: Generator of user IDs
     :rtype: generator
     """
     url = Keyring['URL'].rstrip('/') + '/get-users/v1'
@@ -254,10 +299,18 @@ def users(Keyring: dict[str, str], study_id: str) -> Generator[str, None, None]:
         'secret_key': Keyring['SECRET_KEY'],
         'study_id': study_id
     }
-    resp = requests.post(url, data=payload, stream=True)
+    if cache is not None:
+        yield from cache.fetch('POST', url, {'access_key': Keyring['ACCESS_KEY'], 'study_id': study_id},
+                               lambda resp: list(_parse_users(resp)), data=payload)
+        return
+    resp = client.post(url, data=payload, stream=True)
+    yield from _parse_users(resp)
+
+
+def _parse_users(resp: requests.Response) -> Generator[str, None, None]:
     if resp.status_code != requests.codes.OK:
         raise APIError(f'response not ok ({resp.status_code}) {resp.url}')
-    yield from json.loads(resp.content)
+    yield from _JSONStream(resp.iter_content(CHUNK_SIZE))
 
 
 def studyid(Keyring: dict[str, str], name: str) -> str:
@@ -286,3 +339,90 @@ def studyname(Keyring: dict[str, str], sid: str) -> str:
         if sid == study_id:
             return study_name
     raise StudyNameError(f'study not found {sid}')
+
+
+class _JSONStream:
+    """
+    Incrementally parse a top-level JSON array or object from byte chunks, yielding each array
+    element or (key, value) pair of the object as soon as it has been received
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    DELIMITERS = ' \t\n\r,:]}'
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self) -> Iterator[Any]:
+        start = self._next()
+        if start not in ('[', '{'):
+            self._error('expecting a JSON array or object')
+        end = ']' if start == '[' else '}'
+        self._pos += 1
+        if self._next() == end:
+            self._pos += 1
+            return
+        while True:
+            if start == '[':
+                yield self._value()
+            else:
+                key = self._value()
+                if self._next() != ':':
+                    self._error("expecting ':'")
+                self._pos += 1
+                yield key, self._value()
+            delimiter = self._next()
+            self._pos += 1
+            if delimiter == end:
+                return
+            if delimiter != ',':
+                self._error(f"expecting ',' or '{end}'")
+
+    def _fill(self) -> bool:
+        """
+        Read the next chunk into the buffer, dropping what was already parsed
+        """
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                self._buf += self._text.decode(chunk)
+                return True
+        self._buf += self._text.decode(b'', final=True)
+        self._eof = True
+        return True
+
+    def _next(self) -> str:
+        """
+        Skip whitespace and peek at the next character, an empty string at the end of the stream
+        """
+        while True:
+            self._pos = self.WHITESPACE.match(self._buf, self._pos).end()  # type: ignore[union-attr]
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def _value(self) -> Any:
+        self._next()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number is only complete once it is followed by a delimiter e.g., 1 may be 1.5e3
+            if (end == len(self._buf) or self._buf[end] not in self.DELIMITERS) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _error(self, msg: str) -> NoReturn:
+        raise json.JSONDecodeError(msg, self._buf, self._pos)
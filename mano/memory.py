@@ -0,0 +1,290 @@
+"""
+Process-wide memory budget for the buffers of downloads and saves
+
+Every download buffers its archive, `mano.sync.save` reads archive members fully when hooks want
+their content, and compressed members are spooled before they are encrypted. With several downloads
+and saves running in one process, these buffers all reserve their size against one `MemoryBudget`.
+Buffers that may live on disk (`SpillBuffer`) only grow in memory while the budget has room and
+otherwise spill to a temporary file, and they are spilled as well when a reservation that must be in
+memory is waiting. Such reservations block until enough memory is released (backpressure).
+`MemoryBudget.metrics` reports the current reservation level and how often work waited or spilled.
+
+The default budget is unlimited and only keeps track of reservations, set a limit with `configure`
+or the `--memory-budget` command line option.
+"""
+import io
+import logging
+import re
+import tempfile as tf
+import threading
+import time
+import weakref
+from typing import IO, cast
+
+# the size units accepted by parse_size
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+SIZE_EXPR = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', re.IGNORECASE)
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBudgetError(Exception):
+    pass
+
+
+class MemoryBudget:
+    """
+    Number of bytes that buffers may hold in memory at the same time
+    """
+
+    def __init__(self, limit: int | None = None):
+        """
+        :param limit: Budget in bytes, unlimited if None
+        """
+        if limit is not None and limit < 1:
+            raise MemoryBudgetError(f'memory budget must be at least 1 byte, got {limit}')
+        self.limit = limit
+        self.reserved = 0
+        self.peak = 0
+        self.waits = 0
+        self.spills = 0
+        self.spilled_bytes = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self._spillable: weakref.WeakSet[SpillBuffer] = weakref.WeakSet()
+
+    def _fits(self, nbytes: int) -> bool:
+        return self.limit is None or self.reserved + nbytes <= self.limit
+
+    def _take(self, nbytes: int):
+        self.reserved += nbytes
+        self.peak = max(self.peak, self.reserved)
+
+    def try_reserve(self, nbytes: int, buffer: 'SpillBuffer | None' = None) -> bool:
+        """
+        Reserve memory if the budget has room for it, without blocking
+
+        :param buffer: Buffer the memory is for, which may be spilled to make room for others
+        """
+        with self._cond:
+            if not self._fits(nbytes):
+                return False
+            self._take(nbytes)
+            if buffer is not None:
+                self._spillable.add(buffer)
+            return True
+
+    def reserve(self, nbytes: int, timeout: float | None = None) -> int:
+        """
+        Reserve memory, spilling buffers to disk and then blocking until enough memory is released.
+        A reservation larger than the whole budget waits until nothing else is reserved and then
+        takes the whole budget.
+
+        :returns: Number of bytes reserved, pass it to `release`
+        """
+        if self.limit is not None:
+            nbytes = min(nbytes, self.limit)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        while True:
+            with self._cond:
+                if self._fits(nbytes):
+                    self._take(nbytes)
+                    return nbytes
+                buffers = sorted(self._spillable, key=lambda buffer: buffer.held, reverse=True)
+                if not buffers:
+                    if not waited:
+                        waited = True
+                        self.waits += 1
+                        logger.debug(f'waiting for {nbytes} bytes of memory, {self.reserved} bytes are reserved')
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise MemoryBudgetError(f'timed out waiting for {nbytes} bytes of memory')
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                    continue
+            # spill outside of the budget lock, spilling writes to disk and releases memory
+            buffers[0].spill()
+
+    def release(self, nbytes: int):
+        with self._cond:
+            self.reserved -= nbytes
+            self._cond.notify_all()
+
+    def _spilled(self, buffer: 'SpillBuffer', nbytes: int):
+        with self._cond:
+            self._spillable.discard(buffer)
+            self.spills += 1
+            self.spilled_bytes += nbytes
+
+    def _forget(self, buffer: 'SpillBuffer'):
+        with self._cond:
+            self._spillable.discard(buffer)
+
+    def metrics(self) -> dict[str, int | None]:
+        """
+        Current reservation level and counters, e.g. to export to a monitoring system
+        """
+        with self._cond:
+            return {
+                'limit': self.limit,
+                'reserved': self.reserved,
+                'peak': self.peak,
+                'waiting': self._waiting,
+                'waits': self.waits,
+                'spills': self.spills,
+                'spilled_bytes': self.spilled_bytes,
+                'buffers': len(self._spillable),
+            }
+
+    def __repr__(self):
+        return f'MemoryBudget(limit={self.limit}, reserved={self.reserved})'
+
+
+_budget = MemoryBudget()
+
+
+def get() -> MemoryBudget:
+    """
+    Get the process-wide memory budget
+    """
+    return _budget
+
+
+def configure(limit: int | str | None) -> MemoryBudget:
+    """
+    Replace the process-wide memory budget, e.g. configure('2G'). Reservations made against the
+    previous budget are released against it.
+    """
+    global _budget
+    if isinstance(limit, str):
+        limit = parse_size(limit)
+    _budget = MemoryBudget(limit)
+    return _budget
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a size such as '512M', '2G' or '1.5GiB' into bytes
+    """
+    match = SIZE_EXPR.match(size)
+    if not match:
+        raise MemoryBudgetError(f'could not parse size {size}')
+    value, unit = match.groups()
+    return int(float(value) * UNITS[unit.upper()])
+
+
+def spool(budget: MemoryBudget | None = None, max_size: int | None = None, dir: str | None = None) -> IO[bytes]:
+    """
+    Create a `SpillBuffer`, typed as the binary file it behaves like
+    """
+    return cast(IO[bytes], SpillBuffer(budget, max_size=max_size, dir=dir))
+
+
+class SpillBuffer(io.BufferedIOBase):
+    """
+    Seekable in-memory buffer that reserves its size against a memory budget, and moves its content
+    to a temporary file when the budget has no room for it, when it grows beyond `max_size` or when
+    a blocking reservation needs the memory. Closing the buffer releases its memory.
+    """
+
+    def __init__(self, budget: MemoryBudget | None = None, max_size: int | None = None,
+                 dir: str | None = None):
+        """
+        :param budget: Memory budget, defaults to the process-wide budget
+        :param max_size: Spill once the content grows beyond this many bytes
+        :param dir: Directory of the temporary file
+        """
+        self.budget = budget or get()
+        self.max_size = max_size
+        self.dir = dir
+        self.held = 0
+        self.size = 0
+        self._file: IO[bytes] = io.BytesIO()
+        self._in_memory = True
+        self._lock = threading.RLock()
+
+    @property
+    def spilled(self) -> bool:
+        return not self._in_memory
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:  # type: ignore[override]
+        n = memoryview(b).nbytes
+        with self._lock:
+            if self._in_memory:
+                end = self._file.tell() + n
+                growth = end - self.held
+                if growth > 0:
+                    if (self.max_size is not None and end > self.max_size) or \
+                            not self.budget.try_reserve(growth, self):
+                        self._spill()
+                    else:
+                        self.held = end
+            written = self._file.write(b)
+            self.size = max(self.size, self._file.tell())
+            return written
+
+    def read(self, size: int | None = -1) -> bytes:
+        with self._lock:
+            return self._file.read(-1 if size is None else size)
+
+    def read1(self, size: int = -1) -> bytes:
+        return self.read(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        with self._lock:
+            return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        with self._lock:
+            return self._file.tell()
+
+    def spill(self) -> int:
+        """
+        Move the content to a temporary file
+
+        :returns: Number of bytes of memory released
+        """
+        with self._lock:
+            if self.closed or not self._in_memory:
+                return 0
+            return self._spill()
+
+    def _spill(self) -> int:
+        assert isinstance(self._file, io.BytesIO)
+        position = self._file.tell()
+        spool = tf.TemporaryFile(dir=self.dir)
+        with self._file.getbuffer() as view:
+            spool.write(view)
+        spool.seek(position)
+        self._file.close()
+        self._file = spool
+        self._in_memory = False
+        released, self.held = self.held, 0
+        self.budget._spilled(self, self.size)
+        self.budget.release(released)
+        logger.debug(f'spilled {self.size} bytes to disk')
+        return released
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self._file.close()
+            if self._in_memory:
+                self.budget._forget(self)
+                self.budget.release(self.held)
+                self.held = 0
+            super().close()
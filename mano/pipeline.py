@@ -0,0 +1,165 @@
+"""
+Per-file post-processing hooks that run while `mano.sync.save` writes files
+
+Hooks are registered per data stream (or for every data stream with `'*'`) and called with a
+readable binary stream of the plain content of each archive member as it is saved, so checksums,
+conversions and summaries are produced without decrypting or decompressing the saved files. Plain
+files are streamed from the saved file, which is still in the page cache, while compressed and
+locked files are streamed from the member content that `save` read once for writing them. Hooks run
+on a bounded pool of worker threads. When too many files are waiting for their hooks, `save` blocks
+until workers catch up (backpressure). A failing hook is logged and recorded per file, it never
+fails the save. The most recent results are kept, or taken as they arrive with `drain`.
+"""
+import io
+import logging
+import threading
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import TracebackType
+from typing import IO, Any
+
+ALL_STREAMS = '*'
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineError(Exception):
+    pass
+
+
+class HookContext:
+    """
+    The file a hook is called for
+    """
+
+    def __init__(self, user_id: str, data_stream: str, member: str, target: str, output_dir: str):
+        self.user_id = user_id
+        self.data_stream = data_stream
+        # archive member name e.g., <user_id>/gps/2018-06-15 16_00_00.csv
+        self.member = member
+        # saved target, with codec and lock extensions
+        self.target = target
+        # hooks may write derived outputs under the output directory
+        self.output_dir = output_dir
+
+    def __repr__(self):
+        return f'HookContext({self.target})'
+
+
+Hook = Callable[[HookContext, IO[bytes]], Any]
+
+
+class HookResult:
+    """
+    The outcome of one hook for one file
+    """
+
+    def __init__(self, target: str, hook: str, value: Any = None, error: BaseException | None = None):
+        self.target = target
+        self.hook = hook
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return f'HookResult({self.target}, {self.hook}, ok={self.ok})'
+
+
+class Pipeline:
+    """
+    Registry of hooks per data stream and the worker pool they run on. Use it as a context manager,
+    or call `close` to wait for every hook to finish.
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 16, max_results: int | None = 10000):
+        """
+        :param max_workers: Number of worker threads
+        :param max_pending: Number of files whose hooks may be queued or running before `submit` blocks
+        :param max_results: Number of recent results to keep, older ones are dropped unless they are
+                            taken with `drain`. None keeps every result.
+        """
+        if max_pending < 1:
+            raise PipelineError(f'max_pending must be at least 1, got {max_pending}')
+        self.hooks: dict[str, list[Hook]] = {}
+        self.results: deque[HookResult] = deque(maxlen=max_results)
+        # failures are counted even after their results are dropped
+        self.num_failed = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mano-pipeline')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def register(self, data_stream: str, hook: Hook):
+        """
+        Call `hook(context, stream)` for every saved file of a data stream, or of every data stream
+        if `data_stream` is '*'. Each hook gets its own stream of the plain file content.
+        """
+        self.hooks.setdefault(data_stream, []).append(hook)
+
+    def wants(self, data_stream: str) -> bool:
+        return bool(self.hooks.get(data_stream) or self.hooks.get(ALL_STREAMS))
+
+    def submit(self, context: HookContext, content: bytes | Callable[[], IO[bytes]]) -> Future | None:
+        """
+        Run the hooks of a file's data stream on the worker pool, blocking while `max_pending` files
+        are already waiting
+
+        :param content: File content, or a function that opens a stream of it (called once per hook)
+        """
+        hooks = self.hooks.get(context.data_stream, []) + self.hooks.get(ALL_STREAMS, [])
+        if not hooks:
+            return None
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._run, hooks, context, content)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _run(self, hooks: list[Hook], context: HookContext, content: bytes | Callable[[], IO[bytes]]):
+        for hook in hooks:
+            name = getattr(hook, '__name__', repr(hook))
+            try:
+                with io.BytesIO(content) if isinstance(content, bytes) else content() as stream:
+                    result = HookResult(context.target, name, value=hook(context, stream))
+            except Exception as e:
+                logger.exception(f'hook {name} failed for {context.target}: {e}')
+                result = HookResult(context.target, name, error=e)
+            with self._lock:
+                self.results.append(result)
+                if not result.ok:
+                    self.num_failed += 1
+
+    def failures(self) -> list[HookResult]:
+        """
+        Get the failed results that are still kept
+        """
+        with self._lock:
+            return [result for result in self.results if not result.ok]
+
+    def drain(self) -> list[HookResult]:
+        """
+        Take the results kept so far, e.g. periodically in a long-running process
+        """
+        with self._lock:
+            results = list(self.results)
+            self.results.clear()
+        return results
+
+    def close(self):
+        """
+        Wait for every submitted hook to finish and shut down the worker pool
+        """
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> 'Pipeline':
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, exc: BaseException | None,
+                 tb: TracebackType | None):
+        self.close()
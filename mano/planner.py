@@ -0,0 +1,285 @@
+"""
+Dry-run planner for backfills
+
+Enumerates the windows `mano.sync.backfill` would still request for every participant of every
+study, from the `.backfill` resume point and finished windows in `.claims`, or from the frontiers in
+`.backfill-reverse` of recent-first backfills (nothing is claimed or written), and estimates the
+number of requests, the bytes to transfer, the disk footprint and the time it takes at a given
+concurrency. Estimates come from the statistics that backfills record in `<output_dir>/.stats` (see
+`mano.stats`), pooled across studies for data streams a study has no statistics for yet, and from the
+saved to downloaded size ratio in the summaries (see `mano.summary`). No data is downloaded, only the
+study and participant lists are requested.
+
+Bytes are only estimated from a participant's first data on: the first hour in its coverage index
+(see `mano.coverage`), or for participants without saved data the first hour any participant of the
+study has data for, since the server does not report when a participant enrolled. Windows before
+that are still counted as requests.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+
+import dateutil.parser
+
+import mano
+import mano.coverage as coverage
+import mano.stats as stats
+import mano.summary as summary
+import mano.sync as sync
+from mano.cache import MetadataCache
+
+# used until a backfill has recorded statistics
+DEFAULT_OVERHEAD = 10.0
+DEFAULT_THROUGHPUT = 2 * 1024 * 1024
+FIELDS = ('study_id', 'study_name', 'user_id', 'status', 'windows', 'registered', 'bytes', 'disk_bytes', 'seconds')
+
+logger = logging.getLogger(__name__)
+
+
+class PlanError(Exception):
+    pass
+
+
+class Estimator:
+    """
+    Bytes per participant day and request latency of one output directory
+    """
+
+    def __init__(self, output_dir: str, pooled: dict | None = None):
+        """
+        :param pooled: Statistics pooled across output directories, used where this one has none
+        """
+        own = stats.load(output_dir)
+        self.rates = {**stats.rates(pooled or own), **stats.rates(own)}
+        self.latency = stats.latency(own) or stats.latency(pooled or own)
+        # saved size (after compression or encryption) to member size, by data stream
+        saved: dict[str, list[int]] = {}
+        if os.path.isdir(output_dir):
+            for total in summary.totals(summary.query(output_dir)):
+                sizes = saved.setdefault(total['data_stream'], [0, 0])
+                sizes[0] += total['bytes']
+                sizes[1] += total['member_bytes']
+        self.disk_ratios = {data_stream: size / member_size for data_stream, (size, member_size) in saved.items()
+                            if member_size}
+        # member size to transferred size, by data stream
+        self.member_ratios = {
+            data_stream: totals['member_bytes'] / totals['bytes']
+            for data_stream, totals in {**(pooled or own)['streams'], **own['streams']}.items() if totals['bytes']
+        }
+
+    def bytes(self, data_stream: str, days: float) -> float | None:
+        rate = self.rates.get(data_stream)
+        return None if rate is None else rate * days
+
+    def disk_bytes(self, data_stream: str, nbytes: float) -> float:
+        """
+        Saved size of files that take `nbytes` to transfer
+        """
+        return nbytes * self.member_ratios.get(data_stream, 1.0) * self.disk_ratios.get(data_stream, 1.0)
+
+    def seconds(self, nbytes: float) -> float:
+        if self.latency:
+            overhead, per_byte = self.latency
+            return overhead + per_byte * nbytes
+        return DEFAULT_OVERHEAD + nbytes / DEFAULT_THROUGHPUT
+
+
+class Plan:
+    """
+    Estimates per participant, see FIELDS
+    """
+
+    def __init__(self, concurrency: int = 1):
+        if concurrency < 1:
+            raise PlanError(f'concurrency must be at least 1, got {concurrency}')
+        self.concurrency = concurrency
+        self.rows: list[dict] = []
+        # data streams without statistics, which are estimated as empty
+        self.unknown: set[str] = set()
+
+    def totals(self) -> dict:
+        seconds = sum(row['seconds'] for row in self.rows)
+        return {
+            'studies': len({row['study_id'] for row in self.rows}),
+            'users': len(self.rows),
+            'pending_users': sum(1 for row in self.rows if row['status'] != 'complete'),
+            # one request per window
+            'requests': sum(row['windows'] for row in self.rows),
+            'bytes': sum(row['bytes'] for row in self.rows),
+            'disk_bytes': sum(row['disk_bytes'] for row in self.rows),
+            'seconds': seconds,
+            'concurrency': self.concurrency,
+            # windows of different participants (and, with a work queue, of the same participant)
+            # run in parallel
+            'wall_seconds': seconds / self.concurrency,
+            'unknown_data_streams': sorted(self.unknown),
+        }
+
+
+def pending_windows(user_dir: str, start_date: str = sync.BACKFILL_START_DATE) -> list[tuple[str, str, str | None]]:
+    """
+    Get the windows a backfill of a user would still request, without claiming them
+
+    :returns: List of (start, stop, resume) windows
+    """
+    # a recent-first backfill requests the windows between its frontiers and the floor instead
+    state = sync._read_reverse_state(user_dir)
+    if state is not None:
+        return _pending_reverse_windows(user_dir, state)
+    timestamp: str | None = start_date
+    backfill_file = os.path.join(user_dir, '.backfill')
+    if os.path.exists(backfill_file):
+        with open(backfill_file) as fo:
+            timestamp = fo.read().strip() or start_date
+    if timestamp == 'COMPLETE':
+        return []
+    windows = []
+    while timestamp:
+        window = sync._window(timestamp, sync.BACKFILL_WINDOW)
+        if not os.path.exists(sync._claim_file(user_dir, window[0], '.done')):
+            windows.append(window)
+        timestamp = window[2]
+    return windows
+
+
+def _pending_reverse_windows(user_dir: str, state: dict[str, str]) -> list[tuple[str, str, str | None]]:
+    windows = []
+    timestamp: str | None = state['backward']
+    while timestamp and timestamp != state['floor']:
+        window = sync._reverse_window(timestamp, state['floor'], sync.BACKFILL_WINDOW)
+        if not os.path.exists(sync._claim_file(user_dir, window[0], '.rdone')):
+            windows.append(window)
+        timestamp = window[2]
+    # and the new data after the forward frontier, once it is pulled
+    forward: str | None = state['forward']
+    age = datetime.today() - dateutil.parser.parse(state['forward'])
+    while forward and age.total_seconds() >= sync.FRESHNESS_INTERVAL:
+        window = sync._window(forward, sync.BACKFILL_WINDOW)
+        windows.append(window)
+        forward = window[2]
+    return windows
+
+
+def first_data(output_dir: str) -> datetime | None:
+    """
+    Get the first hour any user of an output directory has saved data for
+    """
+    if not os.path.isdir(output_dir):
+        return None
+    first: datetime | None = None
+    for user_id in os.listdir(output_dir):
+        if not os.path.exists(coverage.coverage_file(output_dir, user_id)):
+            continue
+        span = coverage.load(output_dir, user_id).span()
+        if span and (first is None or span[0] < first):
+            first = span[0]
+    return first
+
+
+def plan_user(
+        output_dir: str,
+        user_id: str,
+        estimator: Estimator,
+        start_date: str = sync.BACKFILL_START_DATE,
+        data_streams: list[str] | None = None,
+        plan: Plan | None = None,
+        study_first_data: datetime | None = None,
+    ) -> dict:
+    """
+    Estimate the backfill of one user
+
+    :param study_first_data: First hour of the study with data (see `first_data`), the estimate of a
+                             user without saved data starts there
+    :returns: Row with the keys in FIELDS, without the study keys
+    """
+    if not data_streams:
+        data_streams = mano.DATA_STREAMS
+    user_dir = os.path.join(output_dir, user_id)
+    windows = pending_windows(user_dir, start_date)
+
+    # files of pending windows that were downloaded before, e.g. by a gap fill. Backfills request them
+    # again, so they are reported but still estimated.
+    registered = 0
+    registry_file = os.path.join(user_dir, '.registry')
+    if windows and os.path.exists(registry_file):
+        first = datetime.fromisoformat(windows[0][0])
+        last = datetime.fromisoformat(windows[-1][1])
+        with open(registry_file) as fo:
+            for key in json.load(fo):
+                parsed = coverage.parse_registry_key(key)
+                if parsed and parsed[1] in data_streams and first <= parsed[2] < last:
+                    registered += 1
+
+    # a user has no data before its first hour with data, e.g. before it enrolled
+    first_hour = study_first_data
+    if windows and os.path.exists(coverage.coverage_file(output_dir, user_id)):
+        span = coverage.load(output_dir, user_id).span()
+        if span:
+            first_hour = span[0]
+
+    nbytes = disk_bytes = seconds = 0.0
+    for start, stop, resume in windows:
+        window_start = datetime.fromisoformat(start)
+        if first_hour and first_hour > window_start:
+            window_start = first_hour
+        days = max((datetime.fromisoformat(stop) - window_start).total_seconds() / 86400, 0.0)
+        window_bytes = 0.0
+        for data_stream in data_streams:
+            estimate = estimator.bytes(data_stream, days)
+            if estimate is None:
+                if plan:
+                    plan.unknown.add(data_stream)
+                continue
+            window_bytes += estimate
+            disk_bytes += estimator.disk_bytes(data_stream, estimate)
+        nbytes += window_bytes
+        seconds += estimator.seconds(window_bytes)
+        if resume:
+            seconds += sync.BACKFILL_INTERVAL_SLEEP
+    backfill_file = os.path.join(user_dir, '.backfill')
+    status = 'complete' if not windows else 'partial' if os.path.exists(backfill_file) else 'new'
+    return {
+        'user_id': user_id,
+        'status': status,
+        'windows': len(windows),
+        'registered': registered,
+        'bytes': round(nbytes),
+        'disk_bytes': round(disk_bytes),
+        'seconds': round(seconds, 1),
+    }
+
+
+def plan(
+        Keyring: dict[str, str],
+        output_base: str,
+        study_ids: list[str] | None = None,
+        user_ids: list[str] | None = None,
+        start_date: str = sync.BACKFILL_START_DATE,
+        data_streams: list[str] | None = None,
+        concurrency: int = 1,
+        cache: MetadataCache | None = None,
+    ) -> Plan:
+    """
+    Plan a backfill of studies into `<output_base>/<study_name>` without downloading any data
+
+    :param study_ids: Studies to plan, all studies if None
+    :param user_ids: Users to plan, all users of each study if None
+    :param concurrency: Number of backfill windows downloaded at the same time
+    :param cache: Reuse cached study and user lists
+    """
+    result = Plan(concurrency)
+    studies = [(name, study_id) for name, study_id in mano.studies(Keyring, cache=cache)
+               if not study_ids or study_id in study_ids]
+    pooled = stats.merge([stats.load(os.path.join(output_base, study_name or study_id))
+                          for study_name, study_id in studies])
+    for study_name, study_id in studies:
+        output_dir = os.path.join(output_base, study_name or study_id)
+        estimator = Estimator(output_dir, pooled)
+        study_first_data = first_data(output_dir)
+        for user_id in user_ids or mano.users(Keyring, study_id, cache=cache):
+            row = plan_user(output_dir, user_id, estimator, start_date, data_streams, plan=result,
+                            study_first_data=study_first_data)
+            result.rows.append({'study_id': study_id, 'study_name': study_name, **row})
+        logger.info(f'planned study {study_name} ({study_id})')
+    return result
@@ -0,0 +1,289 @@
+"""
+Built-in profiling of backfill windows and saves
+
+A `Profiler` times the phases of each window (request, buffer, unzip, encrypt, write, registry),
+tracks the memory they allocate with `tracemalloc` and profiles the CPU, either with a low overhead
+sampling profiler (the default) or with `cProfile`. When a window ends a report is written to the
+profile directory:
+
+    <profile_dir>/<time>_<window>.json       phase times and memory, top allocation sites
+    <profile_dir>/<time>_<window>.collapsed  sampled stacks in collapsed format (sampling mode), for
+                                             flamegraph.pl, speedscope or similar tools
+    <profile_dir>/<time>_<window>.pstats     cProfile statistics (cprofile mode)
+
+Profiling is enabled with the `profile=` option of `mano.sync.backfill` and `mano.sync.save`, the
+`--profile` option of the command line and downloader script, or without any code changes by setting
+the MANO_PROFILE environment variable to a profile directory (and optionally MANO_PROFILE_MODE to
+`sample` or `cprofile`, and MANO_PROFILE_INTERVAL to the sampling interval in seconds).
+"""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import Generator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from types import FrameType
+
+PHASES = ('request', 'buffer', 'unzip', 'encrypt', 'write', 'registry')
+MODES = ('sample', 'cprofile')
+ENV_DIR = 'MANO_PROFILE'
+ENV_MODE = 'MANO_PROFILE_MODE'
+ENV_INTERVAL = 'MANO_PROFILE_INTERVAL'
+TOP_ALLOCATIONS = 20
+TOP_FUNCTIONS = 30
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilingError(Exception):
+    pass
+
+
+class _Window:
+    """
+    Measurements of one window in one thread
+    """
+
+    def __init__(self, name: str, thread_id: int):
+        self.name = name
+        self.thread_id = thread_id
+        self.phase: str | None = None
+        self.phases: dict[str, dict[str, float]] = {}
+        self.samples: Counter[str] = Counter()
+        self.started = time.perf_counter()
+
+
+class Profiler:
+    """
+    Profile windows of work into reports in a profile directory
+    """
+
+    def __init__(self, profile_dir: str, mode: str = 'sample', interval: float = 0.005, memory: bool = True):
+        """
+        :param mode: 'sample' for the sampling profiler, or 'cprofile' for cProfile
+        :param interval: Seconds between samples of the sampling profiler
+        :param memory: Trace allocations with tracemalloc
+        """
+        if mode not in MODES:
+            raise ProfilingError(f'unknown profiling mode {mode}, expected one of {", ".join(MODES)}')
+        self.profile_dir = os.path.expanduser(profile_dir)
+        self.mode = mode
+        self.interval = interval
+        self.memory = memory
+        self.reports: list[str] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # windows of several threads share tracemalloc, which is stopped after the last one if it
+        # was started for them
+        self._tracing = 0
+        self._started_tracing = False
+
+    def _current(self) -> _Window | None:
+        return getattr(self._local, 'window', None)
+
+    @contextmanager
+    def window(self, name: str) -> Generator[None, None, None]:
+        """
+        Profile a window of work and write its report when it ends. Windows nested in a window of the
+        same thread are part of the outer window.
+        """
+        if self._current() is not None:
+            yield
+            return
+        window = _Window(name, threading.get_ident())
+        self._local.window = window
+        if self.memory:
+            with self._lock:
+                if not self._tracing and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._started_tracing = True
+                self._tracing += 1
+        before = tracemalloc.take_snapshot() if self.memory else None
+        stop = threading.Event()
+        sampler = None
+        profile = None
+        if self.mode == 'sample':
+            sampler = threading.Thread(target=self._sample, args=(window, stop), daemon=True,
+                                       name='mano-profiler')
+            sampler.start()
+        else:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                # only one profiler can be active at a time, e.g. windows in several threads
+                logger.warning(f'could not enable cProfile for window {name}: {e}')
+                profile = None
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            if sampler:
+                stop.set()
+                sampler.join()
+            after = tracemalloc.take_snapshot() if self.memory else None
+            if self.memory:
+                with self._lock:
+                    self._tracing -= 1
+                    if not self._tracing and self._started_tracing:
+                        tracemalloc.stop()
+                        self._started_tracing = False
+            self._local.window = None
+            try:
+                self._report(window, before, after, profile)
+            except OSError as e:
+                logger.warning(f'could not write profile of window {name}: {e}')
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        """
+        Time a phase of the current window, and the memory it allocates
+        """
+        window = self._current()
+        if window is None:
+            yield
+            return
+        previous, window.phase = window.phase, name
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            allocated, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            yield
+        finally:
+            stats = window.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+                                                    'allocated': 0, 'peak': 0})
+            stats['calls'] += 1
+            stats['seconds'] += time.perf_counter() - started
+            stats['cpu_seconds'] += time.thread_time() - cpu_started
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                stats['allocated'] += current - allocated
+                # the peak is process-wide, other threads allocating at the same time are included
+                stats['peak'] = max(stats['peak'], peak - allocated)
+            window.phase = previous
+
+    def _sample(self, window: _Window, stop: threading.Event):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(window.thread_id)
+            if frame is not None:
+                window.samples[_collapse(frame, window.phase)] += 1
+
+    def _report(self, window: _Window, before: tracemalloc.Snapshot | None, after: tracemalloc.Snapshot | None,
+                profile: cProfile.Profile | None):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        base = os.path.join(self.profile_dir, f'{time.strftime("%Y%m%dT%H%M%S")}_{_safe(window.name)}')
+        report: dict = {
+            'window': window.name,
+            'mode': self.mode,
+            'seconds': round(time.perf_counter() - window.started, 6),
+            'phases': {name: {key: round(value, 6) for key, value in stats.items()}
+                       for name, stats in window.phases.items()},
+        }
+        if before and after:
+            ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+            diff = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'lineno')
+            report['top_allocations'] = [
+                {'site': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}', 'size_diff': stat.size_diff,
+                 'size': stat.size, 'count_diff': stat.count_diff}
+                for stat in diff[:TOP_ALLOCATIONS]
+            ]
+        if self.mode == 'sample':
+            report['samples'] = sum(window.samples.values())
+            with open(base + '.collapsed', 'w') as fo:
+                for stack, count in sorted(window.samples.items()):
+                    fo.write(f'{stack} {count}\n')
+        elif profile:
+            profile.dump_stats(base + '.pstats')
+            stats = pstats.Stats(profile).sort_stats(pstats.SortKey.CUMULATIVE)
+            report['top_functions'] = [
+                {'function': f'{filename}:{lineno}({function})', 'calls': nc, 'seconds': round(tt, 6),
+                 'cumulative_seconds': round(ct, 6)}
+                for (filename, lineno, function), (_, nc, tt, ct, _) in
+                sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]  # type: ignore
+            ]
+        with open(base + '.json', 'w') as fo:
+            json.dump(report, fo, indent=2)
+        with self._lock:
+            self.reports.append(base + '.json')
+        logger.info(f'wrote profile of window {window.name} to {base}.json')
+
+
+def _collapse(frame: FrameType | None, phase: str | None) -> str:
+    """
+    Format a stack as a collapsed stack line, root first, e.g. `phase:write;backfill (sync.py:93);...`
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    names.append(f'phase:{phase or "other"}')
+    return ';'.join(reversed(names))
+
+
+def _safe(name: str) -> str:
+    return re.sub(r'[^\w.-]+', '_', name)
+
+
+_profilers: dict[tuple[str, str], Profiler] = {}
+_profilers_lock = threading.Lock()
+_default: Profiler | None = None
+
+
+def configure(profile_dir: str | None, mode: str = 'sample', interval: float = 0.005) -> Profiler | None:
+    """
+    Profile every backfill and save of this process that is not given a `profile=` option, or stop
+    doing so if `profile_dir` is None
+    """
+    global _default
+    _default = Profiler(profile_dir, mode=mode, interval=interval) if profile_dir else None
+    return _default
+
+
+def get(profile: 'Profiler | str | None' = None) -> Profiler | None:
+    """
+    Get the profiler for a `profile=` option: a Profiler, a profile directory, or None for the
+    profiler set with `configure` or the profile directory in the MANO_PROFILE environment variable
+    (if either is set)
+    """
+    if isinstance(profile, Profiler):
+        return profile
+    if profile is None and _default is not None:
+        return _default
+    mode = os.environ.get(ENV_MODE, 'sample')
+    if profile is None:
+        profile = os.environ.get(ENV_DIR)
+        if not profile:
+            return None
+    # one profiler per directory and mode, so every call adds to the same reports
+    with _profilers_lock:
+        key = (profile, mode)
+        if key not in _profilers:
+            interval = float(os.environ.get(ENV_INTERVAL, 0.005))
+            _profilers[key] = Profiler(profile, mode=mode, interval=interval)
+        return _profilers[key]
+
+
+def phase(profiler: Profiler | None, name: str) -> AbstractContextManager:
+    """
+    Time a phase if profiling is enabled
+    """
+    return profiler.phase(name) if profiler else nullcontext()
+
+
+def window(profiler: Profiler | None, name: str) -> AbstractContextManager:
+    """
+    Profile a window if profiling is enabled
+    """
+    return profiler.window(name) if profiler else nullcontext()
@@ -0,0 +1,312 @@
+"""
+Rate limits for requests to a Beiwe deployment, and bandwidth shaping of the data they download
+
+`TokenBucket` limits the number of requests per second (see `mano.client.Client`). A `Bandwidth`
+limits the bytes per second that downloads stream from the server, with a cap shared by every
+download of the process and a cap per download. Either cap may follow a time-of-day `Schedule`,
+e.g. `22:00-06:00=unlimited,06:00-22:00=2M` for full speed at night and 2 MiB per second during the
+day. The process-wide bandwidth is unlimited unless set with `configure_bandwidth` or the
+`--bandwidth` command line option.
+"""
+import logging
+import re
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from datetime import time as dtime
+
+import mano.memory as memory
+
+# a schedule rule e.g., 06:00-22:00=2M
+RULE_EXPR = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(\S+)\s*$')
+UNLIMITED = ('', 'unlimited', 'none', '0')
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Token bucket that refills at `rate` tokens per second up to `capacity` tokens, e.g. to allow 2
+    requests per second on average with bursts of up to 10
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        """
+        :param rate: Tokens added per second
+        :param capacity: Maximum number of tokens, defaults to one second worth of tokens (at least 1)
+        """
+        if rate <= 0:
+            raise RateLimitError(f'rate must be positive, got {rate}')
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        if self.capacity <= 0:
+            raise RateLimitError(f'capacity must be positive, got {self.capacity}')
+        self.tokens = self.capacity
+        self.waited = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate: float, capacity: float | None = None):
+        """
+        Change the rate (and capacity), keeping the tokens collected at the previous rate
+        """
+        if rate <= 0:
+            raise RateLimitError(f'rate must be positive, got {rate}')
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.capacity = capacity if capacity is not None else max(rate, 1.0)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens: float = 1, timeout: float | None = None) -> float:
+        """
+        Take tokens, waiting until the bucket has enough of them. Requests for more tokens than the
+        capacity wait for a full bucket and take all of it.
+
+        :returns: Seconds waited
+        """
+        tokens = min(tokens, self.capacity)
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    waited = now - started
+                    self.waited += waited
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            if timeout is not None and now + delay - started > timeout:
+                raise RateLimitError(f'timed out waiting for {tokens} tokens')
+            time.sleep(delay)
+
+
+class Schedule:
+    """
+    Rate by time of day, e.g. `Schedule.parse('06:00-22:00=2M')` for 2 MiB per second from 6:00 to
+    22:00 and no limit otherwise
+    """
+
+    def __init__(self, rules: list[tuple[dtime, dtime, float | None]] | None = None, default: float | None = None):
+        """
+        :param rules: (start, end, rate) rules, the first rule that covers the time of day applies. A
+                      rule whose end is before its start covers midnight. A rate of None is unlimited.
+        :param default: Rate when no rule applies
+        """
+        self.rules = rules or []
+        self.default = default
+
+    @classmethod
+    def parse(cls, spec: 'str | float | Schedule | None') -> 'Schedule':
+        """
+        Parse a rate such as `2M` (bytes per second), `unlimited`, or comma separated rules such as
+        `22:00-06:00=unlimited,06:00-22:00=512K`
+        """
+        if isinstance(spec, Schedule):
+            return spec
+        if spec is None or isinstance(spec, (int, float)):
+            return cls(default=_positive(spec))
+        rules = []
+        default = None
+        for part in spec.split(','):
+            match = RULE_EXPR.match(part)
+            if not match:
+                default = _parse_rate(part)
+                continue
+            start_hour, start_minute, end_hour, end_minute, rate = match.groups()
+            try:
+                start, end = dtime(int(start_hour), int(start_minute)), dtime(int(end_hour), int(end_minute))
+            except ValueError:
+                raise RateLimitError(f'invalid time of day in bandwidth rule {part}')
+            rules.append((start, end, _parse_rate(rate)))
+        return cls(rules, default)
+
+    def rate(self, now: datetime | None = None) -> float | None:
+        """
+        Get the rate at a time (now by default), or None if unlimited
+        """
+        of_day = (now or datetime.now()).time()
+        for start, end, rate in self.rules:
+            if start <= end and start <= of_day < end:
+                return rate
+            if start > end and (of_day >= start or of_day < end):
+                return rate
+        return self.default
+
+    def __repr__(self):
+        return f'Schedule(rules={self.rules}, default={self.default})'
+
+
+def _parse_rate(rate: str) -> float | None:
+    if rate.strip().lower() in UNLIMITED:
+        return None
+    try:
+        return _positive(memory.parse_size(rate))
+    except memory.MemoryBudgetError:
+        raise RateLimitError(f'could not parse bandwidth {rate}')
+
+
+def _positive(rate: float | None) -> float | None:
+    return rate if rate else None
+
+
+class Transfer:
+    """
+    Bytes streamed by one download, see `Bandwidth.stream`
+    """
+
+    def __init__(self) -> None:
+        self.bytes = 0
+        self.seconds = 0.0
+        self.waited = 0.0
+        # the byte rate the transfer was shaped to, None if it was never limited
+        self.target: float | None = None
+
+    @property
+    def achieved(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        target = f'{self.target:.0f}' if self.target else 'unlimited'
+        return f'{self.bytes} bytes in {self.seconds:.3f}s, {self.achieved:.0f} bytes/s (target {target})'
+
+
+class Bandwidth:
+    """
+    Shape the bytes per second of downloads, with a cap shared by every download streamed through
+    this object and a cap per download, either of which may follow a time-of-day schedule
+    """
+
+    def __init__(self, rate: 'str | float | Schedule | None' = None,
+                 per_download: 'str | float | Schedule | None' = None):
+        """
+        :param rate: Bytes per second of all downloads together, unlimited if None
+        :param per_download: Bytes per second of each download, unlimited if None
+        """
+        self.schedule = Schedule.parse(rate)
+        self.per_download = Schedule.parse(per_download)
+        self._bucket: TokenBucket | None = None
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.waited = 0.0
+        self.transfers = 0
+        # time with at least one download streaming, to compute the throughput of all of them
+        self._active = 0
+        self._active_since = 0.0
+        self._active_seconds = 0.0
+
+    def stream(self, chunks: Iterable[bytes], transfer: Transfer | None = None) -> Iterator[bytes]:
+        """
+        Yield chunks no faster than the current rates allow
+
+        :param transfer: Collects the bytes, time and target rate of this download
+        """
+        transfer = transfer or Transfer()
+        own: TokenBucket | None = None
+        with self._lock:
+            if not self._active:
+                self._active_since = time.monotonic()
+            self._active += 1
+            self.transfers += 1
+        started = time.monotonic()
+        try:
+            for chunk in chunks:
+                per_download = self.per_download.rate()
+                if per_download:
+                    if own is None:
+                        own = TokenBucket(per_download)
+                    elif own.rate != per_download:
+                        own.set_rate(per_download)
+                waited = _take(own if per_download else None, len(chunk))
+                waited += _take(self._shared(), len(chunk))
+                rates = [rate for rate in (per_download, self.schedule.rate()) if rate]
+                if rates:
+                    transfer.target = min(rates)
+                transfer.bytes += len(chunk)
+                transfer.waited += waited
+                with self._lock:
+                    self.bytes += len(chunk)
+                    self.waited += waited
+                yield chunk
+        finally:
+            transfer.seconds = time.monotonic() - started
+            with self._lock:
+                self._active -= 1
+                if not self._active:
+                    self._active_seconds += time.monotonic() - self._active_since
+
+    def _shared(self) -> TokenBucket | None:
+        rate = self.schedule.rate()
+        with self._lock:
+            if not rate:
+                return None
+            if self._bucket is None:
+                self._bucket = TokenBucket(rate)
+            elif self._bucket.rate != rate:
+                logger.info(f'bandwidth changed to {rate:.0f} bytes/s')
+                self._bucket.set_rate(rate)
+            return self._bucket
+
+    def metrics(self) -> dict[str, float | int | None]:
+        """
+        Bytes streamed, the throughput achieved while any download was streaming, and the current
+        target rate
+        """
+        with self._lock:
+            seconds = self._active_seconds
+            if self._active:
+                seconds += time.monotonic() - self._active_since
+            return {
+                'bytes': self.bytes,
+                'transfers': self.transfers,
+                'seconds': round(seconds, 3),
+                'waited': round(self.waited, 3),
+                'achieved': round(self.bytes / seconds, 1) if seconds else 0.0,
+                'target': self.schedule.rate(),
+                'per_download': self.per_download.rate(),
+            }
+
+
+def _take(bucket: TokenBucket | None, nbytes: int) -> float:
+    """
+    Take tokens for a number of bytes, in pieces no larger than the bucket so that large chunks
+    wait as long as their size requires
+    """
+    waited = 0.0
+    remaining: float = nbytes
+    while bucket and remaining > 0:
+        tokens = min(remaining, bucket.capacity)
+        waited += bucket.acquire(tokens)
+        remaining -= tokens
+    return waited
+
+
+_bandwidth: Bandwidth | None = None
+
+
+def bandwidth() -> Bandwidth | None:
+    """
+    Get the process-wide bandwidth, if one is configured
+    """
+    return _bandwidth
+
+
+def configure_bandwidth(rate: 'str | float | Schedule | None',
+                        per_download: 'str | float | Schedule | None' = None) -> Bandwidth | None:
+    """
+    Shape every download of this process, e.g. configure_bandwidth('06:00-22:00=2M', per_download='512K'),
+    or stop doing so if both rates are None
+    """
+    global _bandwidth
+    _bandwidth = Bandwidth(rate, per_download) if rate or per_download else None
+    return _bandwidth
@@ -0,0 +1,164 @@
+"""
+Salvage the intact members of a truncated or corrupt archive
+
+Beiwe archives are streamed, so a dropped connection leaves an archive without its central
+directory (which `zipfile` needs) even though most members arrived intact. The members can still be
+found by scanning for their local file headers. Every member whose content matches the CRC-32 and
+size in its local header (or data descriptor) is copied into a new, valid archive. The archive
+registry is the last member, so it is usually lost. When it survived, only the entries for salvaged
+members are kept.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import zipfile
+import zlib
+from collections.abc import Iterator
+
+import mano.archive
+import mano.fileio as fileio
+import mano.memory as memory
+
+logger = logging.getLogger(__name__)
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_SIGNATURE = b'PK\x03\x04'
+DESCRIPTOR = struct.Struct('<3L')
+DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+# general purpose flags
+FLAG_ENCRYPTED = 0x1
+FLAG_DESCRIPTOR = 0x8
+FLAG_UTF8 = 0x800
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class SalvageError(Exception):
+    pass
+
+
+class Member:
+    """
+    An intact member found by scanning local file headers
+    """
+
+    def __init__(self, filename: str, date_time: tuple[int, int, int, int, int, int], content: bytes):
+        self.filename = filename
+        self.date_time = date_time
+        self.content = content
+
+
+def scan(buf: bytes | mmap.mmap) -> Iterator[Member]:
+    """
+    Scan a damaged archive for local file headers and yield every member that is intact
+    """
+    pos = buf.find(LOCAL_SIGNATURE)
+    while pos >= 0:
+        member, end = _member(buf, pos)
+        if member:
+            yield member
+        # continue after an intact member, otherwise look for the next header right after this one
+        pos = buf.find(LOCAL_SIGNATURE, end if member else pos + len(LOCAL_SIGNATURE))
+
+
+def _member(buf: bytes | mmap.mmap, pos: int) -> tuple[Member | None, int]:
+    """
+    Read the member whose local header starts at `pos`
+
+    :returns: The member (None if it is damaged or unsupported), and the offset after it
+    """
+    if pos + LOCAL_HEADER.size > len(buf):
+        return None, pos
+    (_, _, _, flags, method, mod_time, mod_date, crc, compress_size, file_size,
+     name_length, extra_length) = LOCAL_HEADER.unpack_from(buf, pos)
+    start = pos + LOCAL_HEADER.size + name_length + extra_length
+    if start > len(buf):
+        return None, pos
+    raw_name = bytes(buf[pos + LOCAL_HEADER.size:pos + LOCAL_HEADER.size + name_length])
+    filename = raw_name.decode('utf-8' if flags & FLAG_UTF8 else 'cp437')
+    date_time = ((mod_date >> 9) + 1980, (mod_date >> 5) & 0xF, mod_date & 0x1F,
+                 mod_time >> 11, (mod_time >> 5) & 0x3F, (mod_time & 0x1F) * 2)
+    if filename.endswith('/'):
+        return None, start
+    if flags & FLAG_ENCRYPTED or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        logger.warning(f'cannot salvage member {filename} (flags={flags:#x}, method={method})')
+        return None, start
+    try:
+        if flags & FLAG_DESCRIPTOR:
+            # sizes and CRC follow the data, which only deflated members make possible to find
+            if method != zipfile.ZIP_DEFLATED:
+                return None, start
+            content, end = _inflate(buf, start)
+            if buf[end:end + 4] == DESCRIPTOR_SIGNATURE:
+                end += 4
+            if end + DESCRIPTOR.size > len(buf):
+                return None, start
+            crc, compress_size, file_size = DESCRIPTOR.unpack_from(buf, end)
+            end += DESCRIPTOR.size
+        else:
+            end = start + compress_size
+            if end > len(buf):
+                logger.debug(f'member {filename} is truncated')
+                return None, start
+            raw = buf[start:end]
+            content = zlib.decompress(raw, -zlib.MAX_WBITS) if method == zipfile.ZIP_DEFLATED else bytes(raw)
+    except zlib.error as e:
+        logger.debug(f'member {filename} is corrupt: {e}')
+        return None, start
+    if len(content) != file_size or zlib.crc32(content) != crc:
+        logger.debug(f'member {filename} does not match its checksum')
+        return None, start
+    return Member(filename, date_time, content), end
+
+
+def _inflate(buf: bytes | mmap.mmap, start: int) -> tuple[bytes, int]:
+    """
+    Inflate a deflate stream of unknown length
+
+    :returns: Content and the offset after the stream
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    chunks = []
+    offset = start
+    while not decompressor.eof:
+        if offset >= len(buf):
+            raise zlib.error('truncated deflate stream')
+        chunk = buf[offset:offset + CHUNK_SIZE]
+        chunks.append(decompressor.decompress(chunk))
+        offset += len(chunk)
+    return b''.join(chunks), offset - len(decompressor.unused_data)
+
+
+def salvage(path: str) -> zipfile.ZipFile:
+    """
+    Copy the intact members of a damaged archive into a new archive
+
+    :param path: Damaged archive file
+    :returns: Archive of the intact members, with a registry member only if the registry survived
+    """
+    spool = memory.spool(max_size=fileio.SPOOL_SIZE)
+    registry = None
+    names = set()
+    with open(path, 'rb') as fo:
+        if os.fstat(fo.fileno()).st_size == 0:
+            raise SalvageError(f'nothing to salvage in empty file {path}')
+        with mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                zipfile.ZipFile(spool, 'w', zipfile.ZIP_STORED) as salvaged:  # type: ignore[arg-type]
+            for member in scan(mm):
+                if member.filename == 'registry':
+                    registry = json.loads(member.content.decode('utf-8'))
+                    continue
+                # members were verified, storing them avoids compressing them again
+                salvaged.writestr(zipfile.ZipInfo(member.filename, member.date_time), member.content)
+                names.add(mano.archive.normalize(member.filename))
+            if registry is not None:
+                # keep only the entries of salvaged members, e.g. CHUNKED_DATA/<study>/<user>/gps/<time>.csv
+                registry = {key: value for key, value in registry.items()
+                            if mano.archive.normalize('/'.join(key.split('/')[2:])) in names}
+                salvaged.writestr('registry', json.dumps(registry))
+    logger.info(f'salvaged {len(names)} members from {path}')
+    spool.seek(0)
+    return zipfile.ZipFile(spool)  # type: ignore[arg-type]
@@ -0,0 +1,136 @@
+"""
+Download statistics recorded per output directory, for planning backfills (see `mano.planner`)
+
+Each backfill window records the bytes it transferred per data stream, the number of participant
+days it requested per data stream (from the first hour the window has data for) and how long it
+took to download and save, in `<output_dir>/.stats`. Only the most recent MAX_SAMPLES (bytes,
+seconds) samples are kept for the latency model, the per data stream totals are kept forever.
+"""
+import json
+import locale
+import os
+import zipfile
+from datetime import datetime
+
+import mano.fileio as fileio
+from mano.coverage import parse_target
+from mano.locking import FileLock
+
+STATS_FILE = '.stats'
+MAX_SAMPLES = 512
+
+
+class StatsError(Exception):
+    pass
+
+
+def stats_file(output_dir: str) -> str:
+    return os.path.join(output_dir, STATS_FILE)
+
+
+def load(output_dir: str) -> dict:
+    """
+    Load the statistics of an output directory, e.g.
+    {'requests': 2, 'samples': [[bytes, seconds], ...], 'streams': {'gps': {'days': 10.0, 'bytes': ...}}}
+    """
+    filename = stats_file(output_dir)
+    if not os.path.exists(filename):
+        return {'requests': 0, 'samples': [], 'streams': {}}
+    with open(filename) as fo:
+        try:
+            return json.load(fo)
+        except ValueError as e:
+            raise StatsError(f'could not parse stats file {filename}: {e}')
+
+
+def record(output_dir: str, archive: zipfile.ZipFile | None, data_streams: list[str], time_start: str,
+           time_end: str, seconds: float):
+    """
+    Record one download of a participant's [time_start, time_end) window
+
+    :param archive: The downloaded archive, None if there was no data
+    :param data_streams: The requested data streams
+    :param seconds: Time it took to download and save the archive
+    """
+    transferred: dict[str, list[int]] = {data_stream: [0, 0] for data_stream in data_streams}
+    total = 0
+    first: datetime | None = None
+    for info in archive.infolist() if archive else []:
+        total += info.compress_size
+        parts = info.filename.split('/')
+        if info.is_dir() or len(parts) < 3:
+            continue
+        sizes = transferred.setdefault(parts[1], [0, 0])
+        sizes[0] += info.compress_size
+        sizes[1] += info.file_size
+        parsed = parse_target(info.filename)
+        if parsed and (first is None or parsed[1] < first):
+            first = parsed[1]
+    # only the days from the participant's first data on, the days before it (e.g. before the
+    # participant enrolled) would make every rate too small
+    days = 0.0
+    if first is not None:
+        start = max(datetime.fromisoformat(time_start), first)
+        days = max((datetime.fromisoformat(time_end) - start).total_seconds() / 86400, 0.0)
+
+    if not os.path.exists(output_dir):
+        fileio.makedirs(output_dir)
+    with FileLock(stats_file(output_dir) + '.lock'):
+        stats = load(output_dir)
+        stats['requests'] += 1
+        stats['samples'] = (stats['samples'] + [[total, round(seconds, 3)]])[-MAX_SAMPLES:]
+        for data_stream, (size, member_size) in transferred.items():
+            totals = stats['streams'].setdefault(data_stream, {'days': 0, 'bytes': 0, 'member_bytes': 0})
+            totals['days'] += days
+            totals['bytes'] += size
+            totals['member_bytes'] += member_size
+        content = json.dumps(stats, sort_keys=True)
+        fileio.atomic_write(stats_file(output_dir), content.encode(locale.getpreferredencoding()))
+
+
+def merge(all_stats: list[dict]) -> dict:
+    """
+    Pool the statistics of several output directories
+    """
+    merged: dict = {'requests': 0, 'samples': [], 'streams': {}}
+    for stats in all_stats:
+        merged['requests'] += stats['requests']
+        merged['samples'] += stats['samples']
+        for data_stream, totals in stats['streams'].items():
+            pooled = merged['streams'].setdefault(data_stream, {'days': 0, 'bytes': 0, 'member_bytes': 0})
+            for key in pooled:
+                pooled[key] += totals[key]
+    return merged
+
+
+def rates(stats: dict) -> dict[str, float]:
+    """
+    Bytes transferred per participant day, by data stream
+    """
+    return {data_stream: totals['bytes'] / totals['days']
+            for data_stream, totals in stats['streams'].items() if totals['days'] > 0}
+
+
+def latency(stats: dict) -> tuple[float, float] | None:
+    """
+    Fit the time of a request as a fixed overhead plus a time per byte (least squares)
+
+    :returns: (overhead seconds, seconds per byte), or None without samples
+    """
+    samples = stats['samples']
+    if not samples:
+        return None
+    n = len(samples)
+    mean_bytes = sum(size for size, _ in samples) / n
+    mean_seconds = sum(seconds for _, seconds in samples) / n
+    variance = sum((size - mean_bytes) ** 2 for size, _ in samples)
+    if variance > 0:
+        per_byte = sum((size - mean_bytes) * (seconds - mean_seconds) for size, seconds in samples) / variance
+        if per_byte > 0:
+            return max(mean_seconds - per_byte * mean_bytes, 0.0), per_byte
+        # larger requests were not slower
+        return mean_seconds, 0.0
+    # every request was the same size
+    if mean_bytes > 0:
+        return 0.0, mean_seconds / mean_bytes
+    return mean_seconds, 0.0
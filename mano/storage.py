@@ -0,0 +1,439 @@
+"""
+Storage backends for data stream files written by `mano.sync.save`
+
+A target is the relative path of a saved file, e.g. `<user_id>/gps/2018-06-15 16_00_00.csv`, which
+`DirectoryStorage` writes to that exact location under its root directory (the classic layout),
+`DedupStorage` links to a content-addressed blob so identical content is stored once, and
+`BundleStorage` appends to a bundle file shared by many targets.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile as tf
+from collections.abc import Generator, Iterator
+from contextlib import contextmanager
+from typing import IO, cast
+
+import mano.fileio as fileio
+import mano.manifest as manifest
+import mano.memory as memory
+from mano.locking import FileLock
+
+# ioctl that clones the extents of one file into another on Linux (btrfs, xfs and others)
+FICLONE = 0x40049409
+
+logger = logging.getLogger(__name__)
+
+# saved file names start with the timestamp of the hour they cover e.g., 2018-06-15 16_00_00.csv
+TIMESTAMP_EXPR = re.compile(r'^(\d{4})-(\d{2})-(\d{2}) \d{2}_\d{2}_\d{2}')
+
+
+class StorageError(Exception):
+    pass
+
+
+class Storage:
+    """
+    Base class for storage backends
+    """
+
+    @contextmanager
+    def writer(self, target: str) -> Generator[IO[bytes], None, None]:
+        """
+        Yield a writable binary file object for a target. The content is committed, replacing any
+        previous content for the same target, only if the block exits without an exception.
+        """
+        raise NotImplementedError
+        yield
+
+    def open(self, target: str) -> IO[bytes]:
+        """
+        Open a target for reading
+        """
+        raise NotImplementedError
+
+    def exists(self, target: str) -> bool:
+        raise NotImplementedError
+
+    def names(self, prefix: str = '') -> Iterator[str]:
+        """
+        Iterate over saved targets starting with a prefix e.g., `<user_id>/gps/`
+        """
+        raise NotImplementedError
+
+    def export(self, output_dir: str) -> int:
+        """
+        Copy every target into the classic directory layout under `output_dir`
+        """
+        destination = DirectoryStorage(output_dir)
+        num_exported = 0
+        for target in self.names():
+            with self.open(target) as src, destination.writer(target) as dst:
+                shutil.copyfileobj(src, dst)
+            num_exported += 1
+        return num_exported
+
+
+class DirectoryStorage(Storage):
+    """
+    One file per target under a root directory (the classic layout)
+    """
+
+    def __init__(self, root: str, permissions: int = 0o0644):
+        self.root = os.path.expanduser(root)
+        self.permissions = permissions
+
+    def path(self, target: str) -> str:
+        return os.path.join(self.root, target)
+
+    @contextmanager
+    def writer(self, target: str) -> Generator[IO[bytes], None, None]:
+        target_abs = self.path(target)
+        target_dir = os.path.dirname(target_abs)
+        if not os.path.exists(target_dir):
+            fileio.makedirs(target_dir, umask=0o5022)
+        with fileio.atomic_writer(target_abs, permissions=self.permissions) as fo:
+            yield fo
+
+    def open(self, target: str) -> IO[bytes]:
+        return open(self.path(target), 'rb')
+
+    def exists(self, target: str) -> bool:
+        return os.path.exists(self.path(target))
+
+    def names(self, prefix: str = '') -> Iterator[str]:
+        top = os.path.join(self.root, os.path.dirname(prefix))
+        for dirpath, dirnames, filenames in os.walk(top):
+            # skip hidden state directories and files e.g., .registry and temporary files
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.startswith('.'):
+                    continue
+                target = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                if target.startswith(prefix):
+                    yield target
+
+
+class DedupStorage(DirectoryStorage):
+    """
+    One file per target under a root directory, like `DirectoryStorage`, where each file is a hard
+    link (or a reflink, where the file system supports it) to a content-addressed blob in
+    `<root>/.blobs`. Blobs are named after the CRC-32, size and SHA-256 of their content, so identical
+    content is stored once no matter how often it is saved. Blobs are read-only because every target
+    with the same content shares them. `gc` removes blobs that no target refers to any more, under a
+    lock on the store that writers and links hold too.
+    """
+    BLOBS_DIR = '.blobs'
+    LOCK_FILE = '.lock'
+    LINKS = ('hardlink', 'reflink')
+
+    def __init__(self, root: str, link: str = 'hardlink', permissions: int = 0o0444):
+        """
+        :param link: 'hardlink', or 'reflink' to clone blobs into independent files where supported,
+                     falling back to hard links elsewhere
+        """
+        if link not in self.LINKS:
+            raise StorageError(f'invalid link type "{link}", expecting one of {self.LINKS}')
+        super().__init__(root, permissions=permissions)
+        self.link_type = link
+        self.blobs_dir = os.path.join(self.root, self.BLOBS_DIR)
+        # number of targets written with new content, and linked to content that was already stored
+        self.written = 0
+        self.deduplicated = 0
+        self.deduplicated_bytes = 0
+
+    def blob(self, crc: int, size: int, digest: str) -> str:
+        """
+        Get the blob path for content with a CRC-32, size and SHA-256 hex digest
+        """
+        return os.path.join(self.blobs_dir, f'{crc:08x}', f'{size}-{digest}')
+
+    def candidates(self, crc: int, size: int) -> bool:
+        """
+        Check if a blob with this CRC-32 and size may exist, e.g. to hash an archive member only if its
+        content may be stored already
+        """
+        blob_dir = os.path.join(self.blobs_dir, f'{crc:08x}')
+        return os.path.isdir(blob_dir) and any(name.startswith(f'{size}-') for name in os.listdir(blob_dir))
+
+    def link(self, target: str, crc: int, size: int, digest: str) -> bool:
+        """
+        Link a target to a stored blob without writing its content
+
+        :returns: False if no blob has this content
+        """
+        blob = self.blob(crc, size, digest)
+        with self._lock():
+            if not os.path.exists(blob):
+                return False
+            self._link(blob, target)
+        self.deduplicated += 1
+        self.deduplicated_bytes += size
+        return True
+
+    @contextmanager
+    def writer(self, target: str) -> Generator[IO[bytes], None, None]:
+        tmp_dir = os.path.join(self.blobs_dir, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        with tf.NamedTemporaryFile(dir=tmp_dir, prefix='.', delete=False) as tmp:
+            try:
+                sha256 = hashlib.sha256()
+                hashing = manifest.ChecksumWriter(tmp, sha256=sha256)
+                yield cast(IO[bytes], hashing)
+            except BaseException:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+        blob = self.blob(hashing.crc, hashing.size, sha256.hexdigest())
+        # a new blob has no other link until the target is linked, gc must not see it in between
+        with self._lock():
+            if os.path.exists(blob):
+                os.remove(tmp.name)
+                self.deduplicated += 1
+                self.deduplicated_bytes += hashing.size
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.chmod(tmp.name, self.permissions)
+                os.replace(tmp.name, blob)
+                self.written += 1
+            self._link(blob, target)
+
+    def _lock(self) -> FileLock:
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        return FileLock(os.path.join(self.blobs_dir, self.LOCK_FILE))
+
+    def _link(self, blob: str, target: str):
+        target_abs = self.path(target)
+        target_dir = os.path.dirname(target_abs)
+        if not os.path.exists(target_dir):
+            fileio.makedirs(target_dir, umask=0o5022)
+        # link to a temporary name first, so an existing target is replaced atomically
+        tmp = os.path.join(target_dir, f'.{os.path.basename(target_abs)}.{os.getpid()}.link')
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        if self.link_type != 'reflink' or not _reflink(blob, tmp):
+            os.link(blob, tmp)
+        os.replace(tmp, target_abs)
+        # renaming a link over another link to the same blob does nothing
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+    def gc(self, dry_run: bool = False) -> dict[str, int]:
+        """
+        Remove blobs that no target refers to any more, i.e. blobs without other hard links that no
+        saved file has the content of (targets that are reflinks are only known from the manifests,
+        see `mano.manifest`, and are hashed to match them to their blob)
+
+        :returns: {'blobs', 'removed', 'removed_bytes'}
+        """
+        result = {'blobs': 0, 'removed': 0, 'removed_bytes': 0}
+        with self._lock():
+            # blobs without other hard links, by CRC-32 and size
+            unlinked: dict[tuple[int, int], dict[str, str]] = {}
+            for dirpath, dirnames, filenames in os.walk(self.blobs_dir):
+                dirnames[:] = [d for d in dirnames if d != 'tmp']
+                for filename in filenames:
+                    if filename.startswith('.'):
+                        continue
+                    result['blobs'] += 1
+                    blob = os.path.join(dirpath, filename)
+                    if os.stat(blob).st_nlink > 1:
+                        continue
+                    blob_size, _, digest = filename.partition('-')
+                    unlinked.setdefault((int(os.path.basename(dirpath), 16), int(blob_size)), {})[digest] = blob
+            for key, target in self._manifest_targets(unlinked):
+                with open(self.path(target), 'rb') as fo:
+                    sha256 = hashlib.sha256()
+                    for chunk in iter(lambda: fo.read(1024 * 1024), b''):
+                        sha256.update(chunk)
+                unlinked[key].pop(sha256.hexdigest(), None)
+            for blobs in unlinked.values():
+                for blob in blobs.values():
+                    size = os.path.getsize(blob)
+                    logger.debug(f'removing unreferenced blob {blob}')
+                    if not dry_run:
+                        os.remove(blob)
+                    result['removed'] += 1
+                    result['removed_bytes'] += size
+        return result
+
+    def _manifest_targets(self, unlinked: dict[tuple[int, int], dict[str, str]]
+                          ) -> Iterator[tuple[tuple[int, int], str]]:
+        """
+        Iterate over the (CRC-32, size) and target of saved files in the manifests that are not hard
+        links and may have the content of a blob without other hard links
+        """
+        if not unlinked:
+            return
+        seen: set[str] = set()
+        for user_id in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            manifest = os.path.join(self.root, user_id, '.manifest')
+            if user_id.startswith('.') or not os.path.exists(manifest):
+                continue
+            with open(manifest, encoding='utf-8') as fo:
+                for line in fo:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    key = (entry['crc'], entry['size'])
+                    # members of kept archives are not saved in the store
+                    if entry.get('archived') or key not in unlinked or entry['target'] in seen:
+                        continue
+                    seen.add(entry['target'])
+                    path = self.path(entry['target'])
+                    if os.path.isfile(path) and os.stat(path).st_nlink == 1:
+                        yield key, entry['target']
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """
+    Clone a file into a new file sharing its extents, if the platform and file system support it
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            logger.debug(f'cannot reflink {src}: {e}')
+            cloned = False
+        else:
+            cloned = True
+    if not cloned:
+        os.remove(dst)
+    else:
+        os.chmod(dst, os.stat(src).st_mode)
+    return cloned
+
+
+class BundleStorage(Storage):
+    """
+    Append targets to one bundle file per user, data stream and day (or month), which avoids creating
+    one file per data stream hour. Each bundle `<user_id>/<data_stream>/<period>.bundle` has an
+    append-only index `<period>.bundle.idx` with one `<offset> <length> <target>` line per target.
+    Rewriting a target appends new content, the last index entry wins.
+    """
+    BUNDLE_EXT = '.bundle'
+    INDEX_EXT = '.idx'
+    LOCK_EXT = '.lock'
+    PERIODS = ('day', 'month')
+
+    def __init__(self, root: str, period: str = 'day'):
+        if period not in self.PERIODS:
+            raise StorageError(f'invalid bundle period "{period}", expecting one of {self.PERIODS}')
+        self.root = os.path.expanduser(root)
+        self.period = period
+        # index, bytes of the index file read, and the modification time and size it had, by bundle
+        self._indexes: dict[str, tuple[dict[str, tuple[int, int]], int, int, int]] = {}
+
+    def bundle(self, target: str) -> str:
+        """
+        Get the bundle file path for a target
+        """
+        parts = target.split('/')
+        if len(parts) < 3:
+            raise StorageError(f'expecting a target like <user_id>/<data_stream>/<file>: {target}')
+        match = TIMESTAMP_EXPR.match(parts[-1])
+        if not match:
+            period = 'undated'
+        elif self.period == 'day':
+            period = '-'.join(match.groups())
+        else:
+            period = '-'.join(match.groups()[:2])
+        return os.path.join(self.root, parts[0], parts[1], period + self.BUNDLE_EXT)
+
+    @contextmanager
+    def writer(self, target: str) -> Generator[IO[bytes], None, None]:
+        # spool the content so that a failed write never leaves a partial member in the bundle
+        with memory.spool(max_size=fileio.SPOOL_SIZE) as spool:
+            yield spool
+            spool.seek(0)
+            self._append(target, spool)
+
+    def _append(self, target: str, content: IO[bytes]):
+        bundle = self.bundle(target)
+        os.makedirs(os.path.dirname(bundle), exist_ok=True)
+        # appends from several processes would otherwise interleave
+        with FileLock(bundle + self.LOCK_EXT):
+            with open(bundle, 'ab') as fo:
+                offset = fo.seek(0, io.SEEK_END)
+                shutil.copyfileobj(content, fo)
+                length = fo.tell() - offset
+                fo.flush()
+                os.fsync(fo.fileno())
+            # the index entry is written after the content, a crash in between only leaves unreachable bytes
+            with open(bundle + self.INDEX_EXT, 'a', encoding='utf-8') as fo:
+                fo.write(f'{offset} {length} {target}\n')
+
+    def _index(self, bundle: str) -> dict[str, tuple[int, int]]:
+        """
+        Get the index of a bundle. The cached index is checked against the size and modification time
+        of the index file on every access, entries appended by other processes are read incrementally.
+        """
+        index_file = bundle + self.INDEX_EXT
+        try:
+            st = os.stat(index_file)
+        except FileNotFoundError:
+            self._indexes.pop(bundle, None)
+            return {}
+        cached = self._indexes.get(bundle)
+        if cached is not None:
+            index, consumed, mtime, size = cached
+            if (st.st_mtime_ns, st.st_size) == (mtime, size):
+                return index
+            if st.st_size < consumed:
+                # the index file was replaced, read it again
+                cached = None
+        if cached is None:
+            index, consumed = {}, 0
+        with open(index_file, 'rb') as fo:
+            fo.seek(consumed)
+            for line in fo:
+                # ignore a torn final line, it is read again once it is complete
+                if not line.endswith(b'\n'):
+                    break
+                consumed += len(line)
+                offset, length, target = line.decode('utf-8').rstrip('\n').split(' ', 2)
+                index[target] = (int(offset), int(length))
+        self._indexes[bundle] = (index, consumed, st.st_mtime_ns, st.st_size)
+        return index
+
+    def open(self, target: str) -> IO[bytes]:
+        bundle = self.bundle(target)
+        try:
+            offset, length = self._index(bundle)[target]
+        except KeyError:
+            raise FileNotFoundError(f'target not found in bundle {bundle}: {target}')
+        with open(bundle, 'rb') as fo:
+            fo.seek(offset)
+            content = fo.read(length)
+        if len(content) != length:
+            raise StorageError(f'bundle {bundle} is truncated, cannot read {target}')
+        return io.BytesIO(content)
+
+    def exists(self, target: str) -> bool:
+        return target in self._index(self.bundle(target))
+
+    def names(self, prefix: str = '') -> Iterator[str]:
+        top = os.path.join(self.root, os.path.dirname(prefix))
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.endswith(self.BUNDLE_EXT):
+                    continue
+                index = self._index(os.path.join(dirpath, filename))
+                yield from sorted(target for target in index if target.startswith(prefix))
+
+    def reload(self):
+        """
+        Forget cached indexes. Appends of other processes are picked up without it, this only frees
+        memory.
+        """
+        self._indexes.clear()
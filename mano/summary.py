@@ -0,0 +1,164 @@
+"""
+Incremental summary of saved data per user, data stream and day
+
+`mano.sync.save` records the size of every saved file under the hour it covers, in one file per
+month `<output_dir>/<user_id>/.summary/<YYYY-MM>.json`, so an update only reads and writes the months
+of the saved window. File counts, bytes and the first and last hour with data per day are derived
+from the recorded sizes, which also makes saving the same file again idempotent. Queries read the
+summary files only and never touch the data files.
+"""
+import json
+import locale
+import os
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+
+import mano.coverage as coverage
+import mano.fileio as fileio
+import mano.manifest as manifest
+
+SUMMARY_DIR = '.summary'
+DAY_FORMAT = coverage.DAY_FORMAT
+MONTH_FORMAT = '%Y-%m'
+FIELDS = ('user_id', 'data_stream', 'day', 'files', 'bytes', 'member_bytes', 'first', 'last')
+
+
+class SummaryError(Exception):
+    pass
+
+
+def summary_dir(output_dir: str, user_id: str) -> str:
+    return os.path.join(output_dir, user_id, SUMMARY_DIR)
+
+
+def update(output_dir: str, user_id: str, entries: Iterable[dict]):
+    """
+    Record saved files (manifest entries with target, size and member_size). The caller must hold
+    the user lock.
+    """
+    # month -> data stream -> day -> [saved bytes, member bytes] per hour
+    months: dict[str, dict[str, dict[str, list]]] = {}
+    for entry in entries:
+        parsed = coverage.parse_target(entry['target'])
+        if not parsed:
+            continue
+        data_stream, hour = parsed
+        month = hour.strftime(MONTH_FORMAT)
+        if month not in months:
+            months[month] = _load_month(output_dir, user_id, month)
+        days = months[month].setdefault(data_stream, {})
+        hours = days.setdefault(hour.strftime(DAY_FORMAT), [None] * 24)
+        hours[hour.hour] = [entry['size'], entry['member_size']]
+    if not months:
+        return
+    directory = summary_dir(output_dir, user_id)
+    if not os.path.exists(directory):
+        fileio.makedirs(directory)
+    for month, streams in months.items():
+        content = json.dumps(streams, sort_keys=True)
+        fileio.atomic_write(os.path.join(directory, f'{month}.json'), content.encode(locale.getpreferredencoding()))
+
+
+def rebuild(output_dir: str, user_id: str) -> int:
+    """
+    Rebuild the summary of a user from the manifest, e.g. for files saved before summaries were kept
+
+    :returns: Number of files summarized
+    """
+    # deferred import, mano.sync imports this module
+    from mano.sync import _user_lock
+    directory = summary_dir(output_dir, user_id)
+    entries = list(manifest.load(output_dir, user_id).values())
+    with _user_lock(os.path.join(output_dir, user_id)):
+        if os.path.exists(directory):
+            for filename in os.listdir(directory):
+                if filename.endswith('.json'):
+                    os.remove(os.path.join(directory, filename))
+        update(output_dir, user_id, entries)
+    return len(entries)
+
+
+def _load_month(output_dir: str, user_id: str, month: str) -> dict[str, dict[str, list]]:
+    filename = os.path.join(summary_dir(output_dir, user_id), f'{month}.json')
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as fo:
+        try:
+            return json.load(fo)
+        except ValueError as e:
+            raise SummaryError(f'could not parse summary file {filename}: {e}')
+
+
+def _months(start: datetime | None, end: datetime | None, available: list[str]) -> list[str]:
+    first = start.strftime(MONTH_FORMAT) if start else None
+    last = end.strftime(MONTH_FORMAT) if end else None
+    return [month for month in available if (not first or month >= first) and (not last or month <= last)]
+
+
+def query(
+        output_dir: str,
+        user_ids: list[str] | None = None,
+        data_streams: list[str] | None = None,
+        start: datetime | None = None,
+        end: datetime | None = None,
+    ) -> Iterator[dict]:
+    """
+    Iterate over summary rows, one per user, data stream and day with saved files in [start, end)
+
+    :param user_ids: Users to include, every user directory if None
+    :param data_streams: Data streams to include, all if None
+    :returns: Generator of rows with the keys in FIELDS, `first` and `last` are the first and last
+              hours (0-23) of the day with saved files
+    """
+    if user_ids is None:
+        user_ids = sorted(entry.name for entry in os.scandir(output_dir)
+                          if entry.is_dir() and not entry.name.startswith('.'))
+    for user_id in user_ids:
+        directory = summary_dir(output_dir, user_id)
+        if not os.path.isdir(directory):
+            continue
+        available = sorted(filename[:-len('.json')] for filename in os.listdir(directory)
+                           if filename.endswith('.json'))
+        rows = []
+        for month in _months(start, end, available):
+            for data_stream, days in _load_month(output_dir, user_id, month).items():
+                if data_streams and data_stream not in data_streams:
+                    continue
+                for day, hours in days.items():
+                    date = datetime.strptime(day, DAY_FORMAT)
+                    if (start and date < start.replace(hour=0, minute=0, second=0, microsecond=0)) or \
+                            (end and date >= end):
+                        continue
+                    saved = [hour for hour, sizes in enumerate(hours) if sizes is not None]
+                    if not saved:
+                        continue
+                    rows.append({
+                        'user_id': user_id,
+                        'data_stream': data_stream,
+                        'day': day,
+                        'files': len(saved),
+                        'bytes': sum(hours[hour][0] for hour in saved),
+                        'member_bytes': sum(hours[hour][1] for hour in saved),
+                        'first': saved[0],
+                        'last': saved[-1],
+                    })
+        yield from sorted(rows, key=lambda row: (row['data_stream'], row['day']))
+
+
+def totals(rows: Iterable[dict]) -> list[dict]:
+    """
+    Aggregate summary rows per user and data stream, with the first and last day with saved files
+    """
+    aggregated: dict[tuple[str, str], dict] = {}
+    for row in rows:
+        key = (row['user_id'], row['data_stream'])
+        total = aggregated.setdefault(key, {'user_id': key[0], 'data_stream': key[1], 'days': 0, 'files': 0,
+                                            'bytes': 0, 'member_bytes': 0, 'first': row['day'],
+                                            'last': row['day']})
+        total['days'] += 1
+        total['files'] += row['files']
+        total['bytes'] += row['bytes']
+        total['member_bytes'] += row['member_bytes']
+        total['first'] = min(total['first'], row['day'])
+        total['last'] = max(total['last'], row['day'])
+    return [aggregated[key] for key in sorted(aggregated)]
@@ -1,21 +1,54 @@
+import base64
+import errno
+import functools
+import hashlib
 import io
 import itertools
 import json
 import locale
 import logging
+import mmap
 import os
 import re
+import shutil
+import socket
+import stat
+import struct
 import sys
 import tempfile as tf
+import threading
 import time
 import zipfile
+import zlib
+from collections import deque
+from collections.abc import Generator
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from typing import IO, NoReturn, cast
 
 import cryptease as crypt
 import dateutil.parser
 import requests
 
 import mano
+import mano.archive
+import mano.client as client
+import mano.compression as compression
+import mano.coverage as coverage
+import mano.feed as feed
+import mano.fileio as fileio
+import mano.hedging as hedging
+import mano.manifest as manifest
+import mano.memory as memory
+import mano.profiling as profiling
+import mano.ratelimit as ratelimit
+import mano.salvage
+import mano.stats as stats
+import mano.summary as summary
+from mano.fileio import WriteError as WriteError
+from mano.locking import FileLock
+from mano.pipeline import HookContext, Pipeline
+from mano.storage import DedupStorage, DirectoryStorage, Storage
 
 
 BACKFILL_WINDOW = 5
@@ -23,6 +56,24 @@ BACKFILL_INTERVAL_SLEEP = 3
 # this is the earliest possible date for data out of any Beiwe study
 BACKFILL_START_DATE = '2015-9-01T00:00:00'
 LOCK_EXT = '.lock'
+# lock file guarding per-user state, and directory of backfill window claims, under <output_dir>/<user_id>
+USER_LOCK = '.mano-lock'
+CLAIMS_DIR = '.claims'
+# claims older than this many seconds are considered abandoned
+CLAIM_TIMEOUT = 6 * 60 * 60
+# gap fills join missing hours up to this many hours apart into one request
+GAPFILL_MERGE = 24
+# state of a recent-first backfill under <output_dir>/<user_id>, see `_backfill_recent_first`
+REVERSE_CHECKPOINT = '.backfill-reverse'
+# recent-first backfills request the data after the forward frontier once it is this many seconds old
+FRESHNESS_INTERVAL = 60 * 60
+# copy stored archive members from archives on disk with copy_file_range or sendfile, see `_copy_stored`
+COPY_STORED = True
+# errors of copy_file_range and sendfile for files and file systems they do not support
+COPY_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)
+# zip local file header (see section 4.3.7 of the zip APPNOTE)
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_LOCAL_SIGNATURE = b'PK\x03\x04'
 
 logger = logging.getLogger(__name__)
 
@@ -37,15 +88,21 @@ class DownloadError(Exception):
     pass
 
 
-class ParseError(Exception):
-    pass
+class PartialDownloadError(DownloadError):
+    """
+    A damaged archive was downloaded, `archive` holds its salvaged members (see `mano.salvage`)
+    """
 
+    def __init__(self, msg: str, archive: zipfile.ZipFile):
+        super().__init__(msg)
+        self.archive = archive
 
-class SaveError(Exception):
+
+class ParseError(Exception):
     pass
 
 
-class WriteError(Exception):
+class SaveError(Exception):
     pass
 
 
@@ -58,80 +115,334 @@ def backfill(
         data_streams: list[str] | None = None,
         lock: list[str] | None = None,
         passphrase: str | None = None,
+        compress: dict[str, str] | None = None,
+        storage: Storage | None = None,
+        fill_gaps: bool = False,
+        archive_dir: str | None = None,
+        salvage: bool = False,
+        pipeline: Pipeline | None = None,
+        profile: profiling.Profiler | str | None = None,
+        recent_first: bool = False,
     ) -> None:
     """
     Backfill a user (participant)
+
+    :param fill_gaps: Once the backfill is complete, request the hours that have no saved data
+                      according to the coverage index instead of returning immediately
+    :param archive_dir: Keep downloaded archives in this directory without extracting them, see
+                        `mano.archive.ArchiveTree` to read or materialize them later
+    :param salvage: Save the intact members of a damaged download and request only the hours of the
+                    window that are still missing, instead of failing
+    :param pipeline: Hooks to run on the content of each saved file (see `mano.pipeline`)
+    :param profile: Profile each window into this directory (see `mano.profiling`), defaults to the
+                    MANO_PROFILE environment variable
+    :param recent_first: Request the newest window first and work backward to the resume point, while
+                         keeping up with new data (see `_backfill_recent_first`)
     """
-    encoding = locale.getpreferredencoding()
+    profiler = profiling.get(profile)
+    streams_to_fill = data_streams
     if not data_streams:
         data_streams = mano.DATA_STREAMS
     if not os.path.exists(output_dir):
-        _makedirs(output_dir, umask=0o077)
+        fileio.makedirs(output_dir, umask=0o077)
+    user_dir = os.path.join(output_dir, user_id)
+    if not os.path.exists(user_dir):
+        fileio.makedirs(user_dir)
+    if recent_first and _backfill_recent_first(Keyring, study_id, user_id, output_dir, start_date, data_streams,
+                                               lock, passphrase, compress, storage, archive_dir, salvage,
+                                               pipeline, profiler):
+        return
 
     # backfill continuously until this function finally returns
     while True:
-        # read backfill state from file
-        user_dir = os.path.join(output_dir, user_id)
-        if not os.path.exists(user_dir):
-            _makedirs(user_dir)
-        backfill_file = os.path.join(user_dir, '.backfill')
-        logger.info(f'reading backfill file {backfill_file}')
-        with open(backfill_file, 'a+') as fo:
-            fo.seek(0)
-            timestamp = fo.read().strip()
-        if timestamp:
-            logger.debug(f'backfill file contains string: {timestamp}')
+        # claim the next window that no other process is working on
+        window = _claim_window(user_dir, start_date)
 
         # return immediately if backfill state file contains string COMPLETE
-        if timestamp == 'COMPLETE':
-            logger.debug('no backfill is necessary')
+        if window is None and _read_checkpoint(user_dir, start_date) == 'COMPLETE':
+            if fill_gaps:
+                logger.debug('backfill is complete, filling gaps')
+                gapfill(Keyring, study_id, user_id, output_dir, start_date=start_date,
+                        data_streams=streams_to_fill, lock=lock, passphrase=passphrase, compress=compress,
+                        storage=storage, pipeline=pipeline, archive_dir=archive_dir, salvage=salvage,
+                        profile=profiler)
+            else:
+                logger.debug('no backfill is necessary')
+            return
+        # every remaining window is being worked on by other processes
+        if window is None:
+            logger.info('remaining backfill windows are claimed by other processes')
             return
 
-        # if there is no backfill state, default to start_date
-        if not timestamp:
-            timestamp = start_date
-            logger.debug(f'no backfill timestamp found, using: {timestamp}')
-
-        # get download window and next resume point
-        start, stop, resume = _window(timestamp, BACKFILL_WINDOW)
+        start, stop, resume = window
         logger.info(f'processing window is [{start}, {stop}]')
 
-        # download window of data
-        archive = download(
-            Keyring,
-            study_id,
-            [user_id],
-            data_streams,
-            progress=3*1024,
-            time_start=start,
-            time_end=stop
-        )
-
-        # save data
-        num_saved = save(Keyring, archive, user_id, output_dir, lock, passphrase)
-        logger.info(f'saved {num_saved} files')
+        try:
+            _fetch_window(Keyring, study_id, user_id, output_dir, start, stop, data_streams, lock, passphrase,
+                          compress, storage, archive_dir, salvage, pipeline, profiler)
+        except BaseException:
+            _release_window(user_dir, start)
+            raise
 
-        # wite the new resume point to the backfill file
+        # mark the window done, which moves the resume point in the backfill file forward once all
+        # earlier windows are done as well
+        _finish_window(user_dir, start, start_date, resume)
         if resume:
-            _atomic_write(backfill_file, resume.encode(encoding))
             logger.debug('waiting for next backfill interval')
             time.sleep(BACKFILL_INTERVAL_SLEEP)
         else:
-            _atomic_write(backfill_file, 'COMPLETE'.encode(encoding))
             logger.info('backfill is complete')
 
 
+def _fetch_window(Keyring: dict[str, str], study_id: str, user_id: str, output_dir: str, start: str, stop: str,
+                  data_streams: list[str], lock: list[str] | None, passphrase: str | None,
+                  compress: dict[str, str] | None, storage: Storage | None, archive_dir: str | None, salvage: bool,
+                  pipeline: Pipeline | None, profiler: profiling.Profiler | None):
+    """
+    Download and save one backfill window
+    """
+    # download window of data
+    started = time.monotonic()
+    with profiling.window(profiler, f'backfill_{user_id}_{start}'):
+        try:
+            archive = download(
+                Keyring,
+                study_id,
+                [user_id],
+                data_streams,
+                progress=3*1024,
+                time_start=start,
+                time_end=stop,
+                archive_dir=archive_dir,
+                salvage=salvage,
+                profile=profiler,
+            )
+        except PartialDownloadError as e:
+            logger.warning(f'{e}, requesting the rest of the window')
+            num_saved = save(Keyring, e.archive, user_id, output_dir, lock, passphrase,
+                             compress=compress, storage=storage, pipeline=pipeline, profile=profiler)
+            # the coverage index now knows which hours of the window arrived intact
+            num_saved += gapfill(Keyring, study_id, user_id, output_dir, start_date=start,
+                                 end_date=stop, data_streams=data_streams, lock=lock,
+                                 passphrase=passphrase, compress=compress, storage=storage,
+                                 pipeline=pipeline, within_coverage=False, archive_dir=archive_dir,
+                                 salvage=salvage, profile=profiler)
+            logger.info(f'saved {num_saved} files')
+            return
+        # save data, or only record what a kept archive contains
+        if archive_dir:
+            num_kept = _register_archive(archive, user_id, output_dir)
+            logger.info(f'kept archive with {num_kept} files')
+        else:
+            num_saved = save(Keyring, archive, user_id, output_dir, lock, passphrase,
+                             compress=compress, storage=storage, pipeline=pipeline, profile=profiler)
+            logger.info(f'saved {num_saved} files')
+        # bytes and time per window, to plan future backfills (see `mano.planner`)
+        stats.record(output_dir, archive, data_streams, start, stop, time.monotonic() - started)
+
+
+def _backfill_recent_first(Keyring: dict[str, str], study_id: str, user_id: str, output_dir: str,
+                           start_date: str, data_streams: list[str], lock: list[str] | None,
+                           passphrase: str | None, compress: dict[str, str] | None, storage: Storage | None,
+                           archive_dir: str | None, salvage: bool, pipeline: Pipeline | None,
+                           profiler: profiling.Profiler | None) -> bool:
+    """
+    Backfill a user newest window first. The `.backfill-reverse` file of the user has two frontiers
+    that start at the time the recent-first backfill began: the backward frontier moves back one
+    window at a time to the floor (the resume point of the backfill file at that time), and the
+    forward frontier is moved up to the present by freshness pulls in between historical windows.
+    Once the backward frontier reaches the floor, the backfill file is set to the forward frontier so
+    an ordinary backfill continues from there.
+
+    :returns: False if there is nothing to backfill recent-first because the backfill is COMPLETE
+    """
+    user_dir = os.path.join(output_dir, user_id)
+    with _user_lock(user_dir):
+        if _reverse_state(user_dir, start_date) is None:
+            return False
+
+    while True:
+        # keep up with new data first
+        fresh = _claim_fresh_window(user_dir)
+        if fresh:
+            start, stop, _ = fresh
+            logger.info(f'processing fresh window [{start}, {stop}]')
+            try:
+                _fetch_window(Keyring, study_id, user_id, output_dir, start, stop, data_streams, lock, passphrase,
+                              compress, storage, archive_dir, salvage, pipeline, profiler)
+            except BaseException:
+                _release_window(user_dir, start, '.fresh')
+                raise
+            _finish_fresh_window(user_dir, start, stop)
+
+        # then the newest historical window that is left
+        window = _claim_reverse_window(user_dir)
+        if window:
+            start, stop, _ = window
+            logger.info(f'processing window is [{start}, {stop}], newest first')
+            try:
+                _fetch_window(Keyring, study_id, user_id, output_dir, start, stop, data_streams, lock, passphrase,
+                              compress, storage, archive_dir, salvage, pipeline, profiler)
+            except BaseException:
+                _release_window(user_dir, start, '.rclaim')
+                raise
+            _finish_reverse_window(user_dir, start)
+
+        if not fresh and not window:
+            with _user_lock(user_dir):
+                state = _read_reverse_state(user_dir)
+            if state and state['backward'] == state['floor']:
+                logger.info('backfill is complete')
+            else:
+                logger.info('remaining backfill windows are claimed by other processes')
+            return True
+        if (fresh and fresh[2]) or (window and window[2]):
+            logger.debug('waiting for next backfill interval')
+            time.sleep(BACKFILL_INTERVAL_SLEEP)
+
+
+def gapfill(
+        Keyring: dict[str, str],
+        study_id: str,
+        user_id: str,
+        output_dir: str,
+        start_date: str = BACKFILL_START_DATE,
+        end_date: str | None = None,
+        data_streams: list[str] | None = None,
+        lock: list[str] | None = None,
+        passphrase: str | None = None,
+        compress: dict[str, str] | None = None,
+        storage: Storage | None = None,
+        rebuild: bool = False,
+        pipeline: Pipeline | None = None,
+        within_coverage: bool = True,
+        recheck: bool = False,
+        archive_dir: str | None = None,
+        salvage: bool = False,
+        profile: profiling.Profiler | str | None = None,
+    ) -> int:
+    """
+    Download only the hours with no saved data for a user (participant), for example after files
+    were uploaded late to the server or deleted locally. Missing hours are found in the coverage
+    index, grouped into windows no longer than BACKFILL_WINDOW days (joining holes up to
+    GAPFILL_MERGE hours apart), and each window requests only the data streams that are missing
+    within it. Hours that were requested before and came back without data are not requested again.
+
+    :param data_streams: Data streams to check, defaults to those that already have coverage
+    :param rebuild: Rebuild the coverage index from the saved files first (notices deleted files)
+    :param pipeline: Hooks to run on the content of each saved file (see `mano.pipeline`)
+    :param within_coverage: Only look for gaps between the first and last covered hour of the user,
+                            the hours before the first data (e.g. before enrollment) are not gaps
+    :param recheck: Request the hours that came back without data before as well, e.g. after data
+                    was uploaded late to the server
+    :param archive_dir: Keep downloaded archives in this directory instead of saving their members
+                        (see `mano.archive`)
+    :param salvage: Save the intact members of damaged archives, the rest of the gap is requested by
+                    the next gap fill
+    :param profile: Profile each window into this directory (see `mano.profiling`)
+    :returns: Number of saved (or kept) files
+    """
+    profiler = profiling.get(profile)
+    if rebuild:
+        with _user_lock(os.path.join(output_dir, user_id)):
+            cov = coverage.rebuild(output_dir, user_id, storage)
+    else:
+        cov = coverage.load(output_dir, user_id)
+    if not data_streams:
+        data_streams = cov.data_streams() or mano.DATA_STREAMS
+
+    start = dateutil.parser.parse(start_date)
+    end = dateutil.parser.parse(end_date) if end_date else datetime.today()
+    if within_coverage:
+        span = cov.span()
+        if not span:
+            logger.info(f'no saved data for user {user_id}, nothing to fill')
+            return 0
+        start, end = max(start, span[0]), min(end, span[1])
+    checked = None if recheck else coverage.load_checked(output_dir, user_id)
+    windows = coverage.gaps(cov, data_streams, start, end, timedelta(days=BACKFILL_WINDOW), checked=checked,
+                            merge=timedelta(hours=GAPFILL_MERGE))
+    logger.info(f'found {len(windows)} windows with missing coverage for user {user_id}')
+
+    # only tell the server about files that are still covered, so deleted files are sent again
+    registry = dict()
+    local_registry_file = os.path.join(output_dir, user_id, '.registry')
+    if os.path.exists(local_registry_file):
+        with open(local_registry_file) as fo:
+            for key, value in json.load(fo).items():
+                parsed = coverage.parse_registry_key(key)
+                if parsed and cov.covered(parsed[1], parsed[2]):
+                    registry[key] = value
+
+    user_dir = os.path.join(output_dir, user_id)
+    if windows and not os.path.exists(user_dir):
+        fileio.makedirs(user_dir)
+    num_saved = 0
+    for win_start, win_stop, win_streams in windows:
+        logger.info(f'filling gap [{win_start}, {win_stop}] for data streams {win_streams}')
+        with profiling.window(profiler, f'gapfill_{user_id}_{win_start.isoformat()}'):
+            try:
+                archive = download(
+                    Keyring,
+                    study_id,
+                    [user_id],
+                    win_streams,
+                    time_start=win_start,
+                    time_end=win_stop,
+                    registry=registry,
+                    archive_dir=archive_dir,
+                    salvage=salvage,
+                    profile=profiler,
+                )
+            except PartialDownloadError as e:
+                # the hours that are still missing may have data, they are not checked
+                logger.warning(f'{e}, the rest of the gap is requested by the next gap fill')
+                num_saved += save(Keyring, e.archive, user_id, output_dir, lock, passphrase, compress=compress,
+                                  storage=storage, pipeline=pipeline, profile=profiler)
+                continue
+            if archive_dir:
+                num_saved += _register_archive(archive, user_id, output_dir)
+            else:
+                num_saved += save(Keyring, archive, user_id, output_dir, lock, passphrase, compress=compress,
+                                  storage=storage, pipeline=pipeline, profile=profiler)
+        # the hours that are still missing have no data on the server
+        with _user_lock(user_dir):
+            num_checked = coverage.check(output_dir, user_id, win_streams, win_start, win_stop)
+        logger.debug(f'{num_checked} hours of [{win_start}, {win_stop}] came back without data')
+    return num_saved
+
+
 def download(Keyring: dict[str, str], study_id: str, user_ids: list[str],
              data_streams: list[str] | None = None,
              time_start: str | datetime | None = None,
              time_end: str | datetime | None = None,
              registry: dict[str, str] | None = None,
-             progress: int = 0) -> zipfile.ZipFile | None:
+             progress: int = 0,
+             archive_dir: str | None = None,
+             content_addressed: bool = True,
+             salvage: bool = False,
+             budget: memory.MemoryBudget | None = None,
+             profile: profiling.Profiler | str | None = None,
+             bandwidth: ratelimit.Bandwidth | None = None,
+             hedge: hedging.Hedger | None = None) -> zipfile.ZipFile | None:
     """
     Request data archive from Beiwe API
 
     :param progress: Progress indicator (in bytes)
     :type progress: int
+    :param archive_dir: Keep the archive on disk in this directory instead of in memory, and return
+                        it memory mapped (see `mano.archive`)
+    :param content_addressed: Name kept archives after the SHA-256 of their content instead of after
+                              the request
+    :param salvage: If the archive is damaged, raise a PartialDownloadError holding its intact
+                    members instead of a DownloadError
+    :param budget: Memory budget the response buffer reserves against, spilling to a temporary file
+                   when it is exhausted (see `mano.memory`), defaults to the process-wide budget
+    :param profile: Time the request, buffer and unzip phases (see `mano.profiling`)
+    :param bandwidth: Stream the response no faster than this bandwidth allows (see
+                      `mano.ratelimit.Bandwidth`), defaults to the process-wide bandwidth
+    :param hedge: Send the request again if it takes longer than most requests before it (see
+                  `mano.hedging`), defaults to the process-wide hedger
     :returns: Zip archive object
     :rtype: zipfile.ZipFile
     """
@@ -174,7 +485,7 @@ def download(Keyring: dict[str, str], study_id: str, user_ids: list[str],
         'data_streams': data_streams,
         'time_start': time_start.strftime(mano.TIME_FORMAT),
         'time_end': time_end.strftime(mano.TIME_FORMAT),
-        'registry': registry
+        'registry': json.dumps(registry) if registry else registry
     }
 
     # logs
@@ -186,7 +497,14 @@ def download(Keyring: dict[str, str], study_id: str, user_ids: list[str],
     logger.debug(f'time_end={time_end.strftime(mano.TIME_FORMAT)}')
 
     # submit download request
-    resp = requests.post(url, data=payload, stream=True)
+    profiler = profiling.get(profile)
+    if not hedge:
+        hedge = hedging.get()
+    with profiling.phase(profiler, 'request'):
+        if hedge:
+            resp = hedge.request(functools.partial(client.post, url, data=payload, stream=True))
+        else:
+            resp = client.post(url, data=payload, stream=True)
     if resp.status_code == requests.codes.NOT_FOUND:
         return None
     elif resp.status_code != requests.codes.OK:
@@ -199,36 +517,92 @@ def download(Keyring: dict[str, str], study_id: str, user_ids: list[str],
     meter = 0
 
     chunk_size = 1024 * 64
-    content = io.BytesIO()  # temporary storage for response content, required to use ZipFile
+    content: IO[bytes]
+    if archive_dir:
+        if not os.path.exists(archive_dir):
+            fileio.makedirs(archive_dir, umask=0o077)
+        content = tf.NamedTemporaryFile(dir=archive_dir, prefix='.', suffix='.tmp', delete=False)
+    else:
+        # temporary storage for response content, required to use ZipFile. The buffer releases its
+        # memory when the returned archive is garbage collected.
+        content = memory.spool(budget)
+    digest = hashlib.sha256()
+    if not bandwidth:
+        bandwidth = ratelimit.bandwidth()
+    chunks = resp.iter_content(chunk_size=chunk_size)
+    transfer = ratelimit.Transfer()
+    if bandwidth:
+        chunks = bandwidth.stream(chunks, transfer)
 
     # chunk_size may not be respected, at least in more recent versions of requests.
-    for chunk in resp.iter_content(chunk_size=chunk_size):
-        if progress and meter >= progress:
-            sys.stdout.write(next(spinner))
-            sys.stdout.flush()
-            # sys.stdout.write('\b')  # this code was here already, but it seems... clearly wrong?
-            meter = 0
-        content.write(chunk)
-        meter += chunk_size
+    with profiling.phase(profiler, 'buffer'):
+        for chunk in chunks:
+            if progress and meter >= progress:
+                sys.stdout.write(next(spinner))
+                sys.stdout.flush()
+                # sys.stdout.write('\b')  # this code was here already, but it seems... clearly wrong?
+                meter = 0
+            content.write(chunk)
+            if archive_dir:
+                digest.update(chunk)
+            meter += chunk_size
 
     # shut down progress indicator
     if progress:
         sys.stdout.write('done.\n')
         sys.stdout.flush()
+    if bandwidth:
+        logger.info(f'downloaded {transfer}')
+
+    # keep the archive on disk
+    if archive_dir:
+        content.close()
+        name = None
+        if not content_addressed:
+            name = '_'.join([study_id, '+'.join(user_ids), time_start.strftime(mano.archive.NAME_TIME_FORMAT),
+                             time_end.strftime(mano.archive.NAME_TIME_FORMAT)])
+        try:
+            zipfile.ZipFile(content.name).close()
+        except zipfile.BadZipfile:
+            # a damaged download never replaces a kept archive and is not indexed by an archive tree
+            bad_name = (name or digest.hexdigest()) + mano.archive.ARCHIVE_EXT + mano.archive.BAD_EXT
+            bad = os.path.join(archive_dir, bad_name)
+            os.replace(content.name, bad)
+            _bad_archive(bad, salvage)
+        path = mano.archive.keep(content, archive_dir, name=name, digest=digest.hexdigest())
+        with profiling.phase(profiler, 'unzip'):
+            return mano.archive.open_archive(path)
 
     # load reponse content into a zipfile object
     try:
-        zf = zipfile.ZipFile(content)
+        with profiling.phase(profiler, 'unzip'):
+            zf = zipfile.ZipFile(content)
     except zipfile.BadZipfile:
         with tf.NamedTemporaryFile(dir='.', prefix='beiwe', suffix='.zip', delete=False) as fo:
             content.seek(0)
-            fo.write(content.read())
+            shutil.copyfileobj(content, fo)
             fo.flush()
             os.fsync(fo.fileno())
-        raise DownloadError(f'bad zip file written to {fo.name}')
+        _bad_archive(fo.name, salvage)
     return zf
 
 
+def _bad_archive(path: str, salvage: bool) -> NoReturn:
+    """
+    Raise an error for a damaged archive, with its intact members if they should be salvaged. The
+    damaged file is removed once its members are salvaged, and kept for inspection otherwise.
+    """
+    if not salvage:
+        raise DownloadError(f'bad zip file written to {path}')
+    try:
+        archive = mano.salvage.salvage(path)
+    except mano.salvage.SalvageError as e:
+        raise DownloadError(f'bad zip file written to {path}') from e
+    # the salvaged members are held by the new archive
+    os.remove(path)
+    raise PartialDownloadError(f'bad zip file downloaded, salvaged {len(archive.namelist())} members', archive)
+
+
 def _window(timestamp: str, window: int | float) -> tuple[str, str, str | None]:
     """
     Generate a backfill window (start, stop, and resume)
@@ -256,110 +630,794 @@ def _window(timestamp: str, window: int | float) -> tuple[str, str, str | None]:
     return win_start_str, win_stop_str, resume_str
 
 
+def _claim_file(user_dir: str, start: str, suffix: str) -> str:
+    # colons are not allowed in file names on every platform
+    return os.path.join(user_dir, CLAIMS_DIR, start.replace(':', '_') + suffix)
+
+
+def _read_checkpoint(user_dir: str, start_date: str) -> str:
+    backfill_file = os.path.join(user_dir, '.backfill')
+    logger.info(f'reading backfill file {backfill_file}')
+    with open(backfill_file, 'a+') as fo:
+        fo.seek(0)
+        timestamp = fo.read().strip()
+    if timestamp:
+        logger.debug(f'backfill file contains string: {timestamp}')
+    else:
+        # if there is no backfill state, default to start_date
+        timestamp = start_date
+        logger.debug(f'no backfill timestamp found, using: {timestamp}')
+    return timestamp
+
+
+def _advance_checkpoint(user_dir: str, start_date: str) -> str:
+    """
+    Move the resume point in the backfill file past every consecutive finished window. The caller
+    must hold the user lock.
+    """
+    encoding = locale.getpreferredencoding()
+    timestamp = _read_checkpoint(user_dir, start_date)
+    advanced: str | None = timestamp
+    while advanced and advanced != 'COMPLETE':
+        # windows are named after their formatted start, the start date may be written differently
+        done_file = _claim_file(user_dir, _window(advanced, BACKFILL_WINDOW)[0], '.done')
+        if not os.path.exists(done_file):
+            break
+        # the resume point of the window as it was claimed, recomputing it would stretch the last
+        # window up to the present
+        with open(done_file) as fo:
+            resume = fo.read().strip()
+        os.remove(done_file)
+        advanced = resume or _window(advanced, BACKFILL_WINDOW)[2] or 'COMPLETE'
+    if advanced != timestamp:
+        assert advanced is not None
+        fileio.atomic_write(os.path.join(user_dir, '.backfill'), advanced.encode(encoding))
+        timestamp = advanced
+    return timestamp
+
+
+def _claim_window(user_dir: str, start_date: str) -> tuple[str, str, str | None] | None:
+    """
+    Claim the first backfill window after the resume point that is neither finished nor claimed by
+    another live process. Claims are marker files in `<user_dir>/.claims`, so several processes can
+    work on different windows of the same user.
+
+    :returns: The claimed (start, stop, resume) window, or None if the backfill is complete or every
+              remaining window is claimed
+    """
+    with _user_lock(user_dir):
+        timestamp = _advance_checkpoint(user_dir, start_date)
+        if timestamp == 'COMPLETE':
+            return None
+        next_timestamp: str | None = timestamp
+        while next_timestamp:
+            window = _window(next_timestamp, BACKFILL_WINDOW)
+            start = window[0]
+            claim_file = _claim_file(user_dir, start, '.claim')
+            if not os.path.exists(_claim_file(user_dir, start, '.done')) and not _claimed(claim_file):
+                _claim(claim_file)
+                return window
+            next_timestamp = window[2]
+    return None
+
+
+def _claim(claim_file: str):
+    claims_dir = os.path.dirname(claim_file)
+    if not os.path.exists(claims_dir):
+        fileio.makedirs(claims_dir)
+    claim = {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}
+    fileio.atomic_write(claim_file, json.dumps(claim).encode(locale.getpreferredencoding()))
+
+
+def _claimed(claim_file: str) -> bool:
+    """
+    Check if a claim marker belongs to a live process. Claims of dead processes on this host and
+    claims older than CLAIM_TIMEOUT seconds are stale.
+    """
+    if not os.path.exists(claim_file):
+        return False
+    try:
+        with open(claim_file) as fo:
+            claim = json.load(fo)
+    except ValueError:
+        return False
+    if time.time() - claim['time'] > CLAIM_TIMEOUT:
+        return False
+    if claim['host'] == socket.gethostname() and not _pid_alive(claim['pid']):
+        return False
+    return True
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        pass
+    return True
+
+
+def _release_window(user_dir: str, start: str, suffix: str = '.claim'):
+    """
+    Give up a claimed window so another process can work on it
+    """
+    with _user_lock(user_dir):
+        claim_file = _claim_file(user_dir, start, suffix)
+        if os.path.exists(claim_file):
+            os.remove(claim_file)
+
+
+def _finish_window(user_dir: str, start: str, start_date: str, resume: str | None):
+    """
+    Mark a claimed window as finished and move the resume point forward if possible
+
+    :param resume: Resume point of the claimed window, None if it was the last window
+    """
+    with _user_lock(user_dir):
+        marker = resume or 'COMPLETE'
+        fileio.atomic_write(_claim_file(user_dir, start, '.done'), marker.encode(locale.getpreferredencoding()))
+        claim_file = _claim_file(user_dir, start, '.claim')
+        if os.path.exists(claim_file):
+            os.remove(claim_file)
+        _advance_checkpoint(user_dir, start_date)
+
+
+def _reverse_window(timestamp: str, floor: str, window: int | float) -> tuple[str, str, str | None]:
+    """
+    Generate a recent-first backfill window (start, stop, and next) that ends at `timestamp`, without
+    going back past `floor`. The next window ends at the start of this one, or is None once the floor
+    is reached.
+    """
+    win_stop = dateutil.parser.parse(timestamp)
+    win_floor = dateutil.parser.parse(floor)
+    win_start = win_stop - timedelta(days=window)
+    if win_start <= win_floor:
+        win_start = win_floor
+    win_start_str = win_start.strftime(mano.TIME_FORMAT)
+    next_str = win_start_str if win_start > win_floor else None
+    return win_start_str, win_stop.strftime(mano.TIME_FORMAT), next_str
+
+
+def _read_reverse_state(user_dir: str) -> dict[str, str] | None:
+    reverse_file = os.path.join(user_dir, REVERSE_CHECKPOINT)
+    if not os.path.exists(reverse_file):
+        return None
+    with open(reverse_file) as fo:
+        return json.load(fo)
+
+
+def _write_reverse_state(user_dir: str, state: dict[str, str]):
+    encoding = locale.getpreferredencoding()
+    fileio.atomic_write(os.path.join(user_dir, REVERSE_CHECKPOINT), json.dumps(state).encode(encoding))
+    # an ordinary backfill continues from the forward frontier once the history is complete
+    if state['backward'] == state['floor']:
+        fileio.atomic_write(os.path.join(user_dir, '.backfill'), state['forward'].encode(encoding))
+
+
+def _reverse_state(user_dir: str, start_date: str) -> dict[str, str] | None:
+    """
+    Read the recent-first backfill state, or start one from the resume point of the backfill file.
+    The caller must hold the user lock.
+
+    :returns: {'floor', 'backward', 'forward'}, or None if the backfill is COMPLETE
+    """
+    state = _read_reverse_state(user_dir)
+    if state is not None:
+        return state
+    timestamp = _advance_checkpoint(user_dir, start_date)
+    if timestamp == 'COMPLETE':
+        return None
+    now = datetime.today().strftime(mano.TIME_FORMAT)
+    floor = _window(timestamp, BACKFILL_WINDOW)[0]
+    state = {'floor': floor, 'backward': max(now, floor), 'forward': now}
+    logger.info(f'starting recent-first backfill from {now} back to {floor}')
+    _write_reverse_state(user_dir, state)
+    return state
+
+
+def _advance_reverse(user_dir: str) -> dict[str, str]:
+    """
+    Move the backward frontier past every consecutive finished window. The caller must hold the user
+    lock.
+    """
+    state = _read_reverse_state(user_dir)
+    assert state is not None
+    backward: str | None = state['backward']
+    while backward and backward != state['floor']:
+        start, _, backward = _reverse_window(backward, state['floor'], BACKFILL_WINDOW)
+        done_file = _claim_file(user_dir, start, '.rdone')
+        if not os.path.exists(done_file):
+            break
+        os.remove(done_file)
+        state['backward'] = start
+        _write_reverse_state(user_dir, state)
+    return state
+
+
+def _claim_reverse_window(user_dir: str) -> tuple[str, str, str | None] | None:
+    """
+    Claim the newest historical window of a recent-first backfill that is neither finished nor claimed
+    by another live process
+
+    :returns: The claimed (start, stop, next) window, or None
+    """
+    with _user_lock(user_dir):
+        state = _advance_reverse(user_dir)
+        timestamp: str | None = state['backward']
+        while timestamp and timestamp != state['floor']:
+            window = _reverse_window(timestamp, state['floor'], BACKFILL_WINDOW)
+            start = window[0]
+            claim_file = _claim_file(user_dir, start, '.rclaim')
+            if not os.path.exists(_claim_file(user_dir, start, '.rdone')) and not _claimed(claim_file):
+                _claim(claim_file)
+                return window
+            timestamp = window[2]
+    return None
+
+
+def _finish_reverse_window(user_dir: str, start: str):
+    """
+    Mark a claimed historical window as finished and move the backward frontier if possible
+    """
+    with _user_lock(user_dir):
+        fileio.atomic_write(_claim_file(user_dir, start, '.rdone'), b'')
+        claim_file = _claim_file(user_dir, start, '.rclaim')
+        if os.path.exists(claim_file):
+            os.remove(claim_file)
+        _advance_reverse(user_dir)
+
+
+def _claim_fresh_window(user_dir: str) -> tuple[str, str, str | None] | None:
+    """
+    Claim the window after the forward frontier of a recent-first backfill, if the frontier is more
+    than FRESHNESS_INTERVAL seconds old and no other live process is pulling it
+
+    :returns: The claimed (start, stop, resume) window, or None
+    """
+    with _user_lock(user_dir):
+        state = _read_reverse_state(user_dir)
+        assert state is not None
+        forward = dateutil.parser.parse(state['forward'])
+        if (datetime.today() - forward).total_seconds() < FRESHNESS_INTERVAL:
+            return None
+        window = _window(state['forward'], BACKFILL_WINDOW)
+        claim_file = _claim_file(user_dir, window[0], '.fresh')
+        if _claimed(claim_file):
+            return None
+        _claim(claim_file)
+        return window
+
+
+def _finish_fresh_window(user_dir: str, start: str, stop: str):
+    """
+    Move the forward frontier of a recent-first backfill to the end of a pulled window
+    """
+    with _user_lock(user_dir):
+        claim_file = _claim_file(user_dir, start, '.fresh')
+        if os.path.exists(claim_file):
+            os.remove(claim_file)
+        state = _read_reverse_state(user_dir)
+        assert state is not None
+        state['forward'] = max(state['forward'], stop)
+        _write_reverse_state(user_dir, state)
+
+
+def _user_lock(user_dir: str) -> FileLock:
+    """
+    Lock that guards the backfill file, claims, registry and indexes of a user
+    """
+    return FileLock(os.path.join(user_dir, USER_LOCK))
+
+
 def save(Keyring: dict[str, str], archive: zipfile.ZipFile | None, user_id: str, output_dir: str,
-         lock: list[str] | None = None, passphrase: str | None = None) -> int:
+         lock: list[str] | None = None, passphrase: str | None = None,
+         compress: dict[str, str] | None = None, storage: Storage | None = None,
+         pipeline: Pipeline | None = None, budget: memory.MemoryBudget | None = None,
+         profile: profiling.Profiler | str | None = None) -> int:
     """
     The order of operations here is important to ensure the ability to reach a state of consistency:
         1. Save the file
         2. Update the local registry
+
+    :param compress: Mapping of data stream to codec name (see `mano.compression`), e.g.
+                     {'accelerometer': 'gzip'}. Compressed files get the codec extension appended.
+    :param storage: Storage backend for data stream files (see `mano.storage`), defaults to the
+                    classic directory layout under `output_dir`. The local registry is always
+                    kept under `output_dir`.
+    :param pipeline: Hooks to run on the content of each saved file (see `mano.pipeline`). Hooks may
+                     still be running when save returns, close the pipeline to wait for them.
+    :param budget: Memory budget that member content read for hooks and spooled for encryption
+                   reserves against (see `mano.memory`), defaults to the process-wide budget
+    :param profile: Profile the save into this directory (see `mano.profiling`), defaults to the
+                    MANO_PROFILE environment variable. Within a profiled backfill window the save is
+                    part of the window's profile.
     """
-    num_saved = 0
     if not archive:
-        return num_saved
-    encoding = locale.getpreferredencoding()
+        return 0
+    profiler = profiling.get(profile)
+    with profiling.window(profiler, f'save_{user_id}'):
+        return _save(Keyring, archive, user_id, output_dir, lock, passphrase, compress, storage, pipeline, budget,
+                     profiler)
+
+
+def _save(Keyring: dict[str, str], archive: zipfile.ZipFile, user_id: str, output_dir: str,
+          lock: list[str] | None, passphrase: str | None, compress: dict[str, str] | None,
+          storage: Storage | None, pipeline: Pipeline | None, budget: memory.MemoryBudget | None,
+          profiler: profiling.Profiler | None) -> int:
+    num_saved = 0
+    # one salt and key per save, derived with the first locked file. Every file still gets its own IV,
+    # and `unlock` derives the key once for all files of a save.
+    key = None
     if not lock:
         lock = list()
     else:
         if not passphrase:
             raise SaveError('if you wish to lock a data type, you need a passphrase')
+    codecs = {data_stream: compression.get(name) for data_stream, name in (compress or {}).items()}
+    if not storage:
+        storage = DirectoryStorage(output_dir)
+    if not budget:
+        budget = memory.get()
 
     lock_ext = LOCK_EXT.lstrip('.')
     # open registry file in downloaded archive
     logger.debug('reading registry file from beiwe archive')
-    with archive.open('registry', 'r') as fo:
-        registry = json.loads(fo.read().decode('utf-8'))
+    try:
+        with profiling.phase(profiler, 'unzip'), archive.open('registry', 'r') as fo:
+            registry = json.loads(fo.read().decode('utf-8'))
+    except KeyError:
+        # archives salvaged from a damaged download may have lost their registry
+        logger.debug('archive has no registry, saving every member')
+        registry = None
 
     # if archive registry contains any entries, process them
-    if registry:
+    saved = list()
+    entries = list()
+    if registry or registry is None:
         # iterate over archive members
-        for member in archive.namelist():
-            # skip over the registry file
-            if member == 'registry':
+        for info in archive.infolist():
+            member = info.filename
+            # skip over the registry file and directory entries
+            if member == 'registry' or info.is_dir():
                 continue
 
-            # debugging get information about the current archive member
-            # info = archive.getinfo(member)
-
-            # parse the data type determine if it should be encrypted
-            encrypt = _parse_datatype(member, user_id) in lock
-            logger.debug(f'processing archive member: {member} (lock={encrypt})')
+            # parse the data type determine if it should be encrypted or compressed
+            data_stream = _parse_datatype(member, user_id)
+            encrypt = data_stream in lock
+            codec = codecs.get(data_stream)
+            logger.debug(f'processing archive member: {member} (lock={encrypt}, codec={codec and codec.name})')
             # create target name
             target = member
-            # add lock extension to target name if necessary
+            # add codec and lock extensions to target name if necessary
+            if codec:
+                target = f'{target}{codec.extension}'
             if encrypt:
                 target = f'{target}.{lock_ext}'
+            # hooks of plain files stream the saved file. Compressed and locked files are written from
+            # the member content when hooks need it, so it is decompressed once, and it is held in memory
+            # reserved against the budget until the hooks are done with it.
+            hooked = pipeline is not None and pipeline.wants(data_stream)
+            reserved = budget.reserve(info.file_size) if hooked and (encrypt or codec) else None
+            try:
+                with profiling.phase(profiler, 'unzip'):
+                    member_content = archive.read(info) if reserved is not None else None
+
+                if not encrypt and not codec and _link_duplicate(storage, archive, info, target, profiler):
+                    # the same content is stored already, see `mano.storage.DedupStorage`
+                    size, crc = info.file_size, info.CRC
+                else:
+                    # write content to persistent storage, compressing and encrypting it if necessary, while
+                    # computing the size and CRC of the written bytes for the manifest
+                    with profiling.phase(profiler, 'encrypt' if encrypt else 'write'), storage.writer(target) as raw:
+                        checksum = manifest.ChecksumWriter(raw)
+                        fo = cast(IO[bytes], checksum)
+                        if encrypt:
+                            if key is None:
+                                key = crypt.kdf(passphrase)
+                            if codec:
+                                # compress before encrypting, encrypted content does not compress
+                                with memory.spool(budget, max_size=fileio.SPOOL_SIZE) as spool:
+                                    _write_member(archive, info, spool, codec, member_content)
+                                    spool.seek(0)
+                                    _encrypt(spool, key, fo)
+                            elif member_content is not None:
+                                _encrypt(io.BytesIO(member_content), key, fo)
+                            else:
+                                with archive.open(info) as content:
+                                    _encrypt(content, key, fo)
+                        elif codec:
+                            _write_member(archive, info, fo, codec, member_content)
+                        else:
+                            # the kernel copies stored members of archives on disk
+                            copied = _copy_stored(archive, info, raw)
+                            if copied is not None:
+                                checksum.size, checksum.crc = info.file_size, copied
+                            else:
+                                with archive.open(info) as content:
+                                    shutil.copyfileobj(content, fo)
+                    size, crc = checksum.size, checksum.crc
+                future = None
+                if pipeline and hooked:
+                    context = HookContext(user_id, data_stream, member, target, output_dir)
+                    if member_content is not None:
+                        future = pipeline.submit(context, member_content)
+                    else:
+                        future = pipeline.submit(context, functools.partial(storage.open, target))
+            except BaseException:
+                if reserved is not None:
+                    budget.release(reserved)
+                raise
+            if reserved is not None:
+                if future:
+                    future.add_done_callback(functools.partial(_release_reserved, budget, reserved))
+                else:
+                    budget.release(reserved)
+            saved.append(target)
+            entries.append({
+                'target': target,
+                'member': member,
+                'size': size,
+                'crc': crc,
+                'member_size': info.file_size,
+                'member_crc': info.CRC,
+            })
+            num_saved += 1
 
-            # detect if target exists, create the directory
-            target_abs = os.path.join(output_dir, target)
-            target_dir = os.path.dirname(target_abs)
-            if os.path.exists(target_abs):
-                os.remove(target_abs)
-            if not os.path.exists(target_dir):
-                _makedirs(target_dir, umask=0o5022)
+        with profiling.phase(profiler, 'registry'):
+            _update_registry(output_dir, user_id, registry or {}, saved, entries)
 
-            # read archive member content and encrypt it if necessary
-            content = archive.open(member)
+    # return the number of saved files
+    return num_saved
 
-            if encrypt:
-                key = crypt.kdf(passphrase)
-                crypt.encrypt(content, key, filename=target_abs, permissions=0o0644)
-            else:
-                # write content to persistent storage
-                _atomic_write(target_abs, content.read())
-            num_saved += 1
 
-        # update local registry file to avoid re-downloading these files
-        local_registry_file = os.path.join(output_dir, user_id, '.registry')
+def _link_duplicate(storage: Storage, archive: zipfile.ZipFile, info: zipfile.ZipInfo, target: str,
+                    profiler: profiling.Profiler | None = None) -> bool:
+    """
+    Link a target to stored content identical to an archive member, if the storage deduplicates
+    content. The member is only hashed if a blob with its CRC and size exists.
+    """
+    if not isinstance(storage, DedupStorage) or not storage.candidates(info.CRC, info.file_size):
+        return False
+    with profiling.phase(profiler, 'write'):
+        digest = hashlib.sha256()
+        with archive.open(info) as fo:
+            for chunk in iter(lambda: fo.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return storage.link(target, info.CRC, info.file_size, digest.hexdigest())
+
+
+def _release_reserved(budget: memory.MemoryBudget, nbytes: int, future: Future):
+    budget.release(nbytes)
+
+
+def _register_archive(archive: zipfile.ZipFile | None, user_id: str, output_dir: str) -> int:
+    """
+    Record the members of a kept archive in the local registry, coverage index, manifest, summary
+    and change feed without extracting them, so they are not downloaded again. Their manifest
+    entries are marked `archived` with the path of the archive.
+
+    :returns: Number of members
+    """
+    if not archive:
+        return 0
+    with archive.open('registry', 'r') as fo:
+        registry = json.loads(fo.read().decode('utf-8'))
+    infos = [info for info in archive.infolist() if info.filename != 'registry' and not info.is_dir()]
+    members = [info.filename for info in infos]
+    entries = [{'target': info.filename, 'member': info.filename, 'size': info.file_size, 'crc': info.CRC,
+                'member_size': info.file_size, 'member_crc': info.CRC, 'archived': archive.filename or True}
+               for info in infos]
+    if registry:
+        _update_registry(output_dir, user_id, registry, members, entries)
+    return len(members)
+
+
+def _update_registry(output_dir: str, user_id: str, registry: dict[str, str], saved: list[str],
+                     entries: list[dict]):
+    """
+    Merge an archive registry into the local registry and record the saved targets in the coverage
+    index, manifest and summary, and in the change feed of the output directory
+    """
+    encoding = locale.getpreferredencoding()
+    # update local registry file to avoid re-downloading these files, other processes may be
+    # saving files for the same user so the read-modify-write happens under the user lock
+    user_dir = os.path.join(output_dir, user_id)
+    if not os.path.exists(user_dir):
+        fileio.makedirs(user_dir)
+    with _user_lock(user_dir):
+        local_registry_file = os.path.join(user_dir, '.registry')
         local_registry = dict()
         if os.path.exists(local_registry_file):
-            with open(local_registry_file) as fo:
-                local_registry = json.load(fo)
+            with open(local_registry_file) as registry_fo:
+                local_registry = json.load(registry_fo)
 
         local_registry.update(registry)
         local_registry_str = json.dumps(local_registry, indent=2)
-        _atomic_write(local_registry_file, local_registry_str.encode(encoding))
+        fileio.atomic_write(local_registry_file, local_registry_str.encode(encoding))
 
-    # return the number of saved files
-    return num_saved
+        # record the hours covered by the saved files, and their sizes and checksums
+        coverage.update(output_dir, user_id, saved)
+        manifest.append(output_dir, user_id, entries)
+        summary.update(output_dir, user_id, entries)
+        # committed files only show up in the feed after the registry knows them
+        feed.append(output_dir, [feed.record(user_id, entry, LOCK_EXT) for entry in entries])
 
 
-def _makedirs(path: str, umask: int | None = None, exist_ok: bool = True):
+def open_saved(filename: str, storage: Storage | None = None, passphrase: str | None = None) -> IO[bytes]:
     """
-    Create directories recursively with a temporary umask
+    Open a file written by `save` for reading, transparently decompressing it if it was saved with
+    a codec (detected by file extension). Locked files are decrypted into memory.
+
+    :param filename: File path, or target (e.g. `<user_id>/gps/<file>`) if `storage` is given
+    :param storage: Storage backend the file was saved to
+    :param passphrase: Passphrase used to lock the file
+    """
+    return _open_saved(filename, storage, _KeyCache(passphrase) if passphrase else None)
+
+
+def _open_saved(filename: str, storage: Storage | None, keys: '_KeyCache | None') -> IO[bytes]:
+    fo: IO[bytes] = storage.open(filename) if storage else open(filename, 'rb')
+    if filename.endswith(LOCK_EXT):
+        if not keys:
+            fo.close()
+            raise SaveError(f'cannot open locked file without a passphrase: {filename}')
+        with fo:
+            fo = io.BytesIO(_decrypt(fo, keys))
+        filename = filename[:-len(LOCK_EXT)]
+    codec = compression.for_filename(filename)
+    if not codec:
+        return fo
+    return codec.decompressor(fo)
+
+
+def list_saved(output_dir: str, user_id: str, data_stream: str, time_start: str | datetime | None = None,
+               time_end: str | datetime | None = None, storage: Storage | None = None) -> list[str]:
     """
-    old_umask = None
-    if umask is not None:
-        old_umask = os.umask(umask)
+    List the targets saved for a user and data stream, optionally within [time_start, time_end)
+    based on the hour each file covers
+
+    :returns: Sorted list of targets e.g., `<user_id>/gps/2018-06-15 16_00_00.csv.lock`
+    """
+    if isinstance(time_start, str):
+        time_start = dateutil.parser.parse(time_start)
+    if isinstance(time_end, str):
+        time_end = dateutil.parser.parse(time_end)
+    if not storage:
+        storage = DirectoryStorage(output_dir)
+    targets = list()
+    for target in storage.names(f'{user_id}/{data_stream}/'):
+        parsed = coverage.parse_target(target)
+        if not parsed:
+            continue
+        hour = parsed[1]
+        if (time_start and hour < time_start.replace(minute=0, second=0, microsecond=0)) or \
+                (time_end and hour >= time_end):
+            continue
+        targets.append(target)
+    return sorted(targets)
+
+
+def unlock(
+        output_dir: str,
+        user_id: str,
+        data_stream: str,
+        passphrase: str,
+        time_start: str | datetime | None = None,
+        time_end: str | datetime | None = None,
+        storage: Storage | None = None,
+        destination: str | None = None,
+        max_workers: int = 4,
+    ) -> Generator[tuple[str, bytes | str], None, None]:
+    """
+    Decrypt (and decompress) the files saved for a user and data stream in parallel. Keys are
+    derived once per salt instead of once per file. Results are yielded in target order as they
+    become available, while the next files are decrypted in the background.
+
+    Plaintext is never written to `output_dir`. By default it is kept in memory and each result
+    is a (target, content) tuple. If `destination` is given (use a tmpfs such as /dev/shm to keep
+    plaintext off persistent storage) files are written there in the classic layout without the
+    lock and codec extensions, and each result is a (target, path) tuple.
+
+    :param max_workers: Number of files decrypted at the same time
+    """
+    if not storage:
+        storage = DirectoryStorage(output_dir)
+    targets = list_saved(output_dir, user_id, data_stream, time_start, time_end, storage=storage)
+    keys = _KeyCache(passphrase)
+
+    def work(target: str) -> bytes | str:
+        with _open_saved(target, storage, keys) as fo:
+            content = fo.read()
+        if not destination:
+            return content
+        plain = target[:-len(LOCK_EXT)] if target.endswith(LOCK_EXT) else target
+        codec = compression.for_filename(plain)
+        if codec:
+            plain = plain[:-len(codec.extension)]
+        path = os.path.join(destination, plain)
+        if not os.path.exists(os.path.dirname(path)):
+            fileio.makedirs(os.path.dirname(path), umask=0o077)
+        fileio.atomic_write(path, content, permissions=0o0600)
+        return path
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # keep a bounded number of files in flight, so memory use does not grow with the range
+        pending: deque = deque()
+        for target in targets:
+            pending.append((target, executor.submit(work, target)))
+            if len(pending) >= 2 * max_workers:
+                done_target, future = pending.popleft()
+                yield done_target, future.result()
+        while pending:
+            done_target, future = pending.popleft()
+            yield done_target, future.result()
+
+
+class _KeyCache:
+    """
+    Keys derived from one passphrase, by salt
+    """
+
+    def __init__(self, passphrase: str):
+        self.passphrase = passphrase
+        self._keys: dict[str, object] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, header: dict):
+        salt = header['kdf']['params']['salt']
+        with self._lock:
+            salt_lock = self._locks.setdefault(salt, threading.Lock())
+        # one lock per salt, so each salt is derived once while different salts are derived in parallel
+        with salt_lock:
+            if salt not in self._keys:
+                self._keys[salt] = crypt.kdf(self.passphrase, base64.b64decode(salt))
+            return self._keys[salt]
+
+
+def _decrypt(fo: IO[bytes], keys: _KeyCache, chunk_size: int = 1024 * 1024) -> bytes:
+    """
+    Decrypt a locked file into memory
+    """
+    header, _ = crypt.read_header(fo)
+    key = keys.get(header)
+    return b''.join(crypt.decrypt(fo, key, chunk_size=chunk_size))
+
+
+def _encrypt(content: IO[bytes], key, fileobj: IO[bytes], chunk_size: int = 1024 * 1024):
+    """
+    Encrypt content into a file object
+    """
+    for chunk in crypt.encrypt(content, key, chunk_size=chunk_size):
+        fileobj.write(chunk)
+
+
+def _write_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo, fileobj: IO[bytes],
+                  codec: compression.Codec, content: bytes | None = None):
+    """
+    Write an archive member to a file object using a codec. When the codec can frame the member's
+    raw compressed bytes (e.g., deflate into gzip), they are copied through without decompressing.
+
+    :param content: Member content if it was read already, so it is not decompressed again
+    """
+    frame = codec.frame(info)
+    if frame:
+        header, trailer = frame
+        fileobj.write(header)
+        for chunk in _raw_member(archive, info):
+            fileobj.write(chunk)
+        fileobj.write(trailer)
+        return
+    with (io.BytesIO(content) if content is not None else archive.open(info)) as src, \
+            codec.compressor(fileobj) as dst:
+        shutil.copyfileobj(src, dst)
+
+
+def _copy_stored(archive: zipfile.ZipFile, info: zipfile.ZipInfo, fileobj: IO[bytes]) -> int | None:
+    """
+    Copy a stored (uncompressed) member of an archive on disk into a file on disk with
+    `os.copy_file_range` or `os.sendfile`, so the kernel copies its bytes without passing them
+    through Python buffers, then verify the CRC of the copy by reading the target back
+
+    :returns: CRC of the copied bytes, or None if the member is compressed, either file is not on
+              disk or the target cannot be read back, in which case nothing was copied
+    """
+    if not COPY_STORED or info.compress_type != zipfile.ZIP_STORED or not info.file_size or archive.fp is None:
+        return None
     try:
-        os.makedirs(path, exist_ok=exist_ok)
-    finally:
-        if old_umask is not None:
-            os.umask(old_umask)
+        src = archive.fp.fileno()
+        dst = fileobj.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    if not fileobj.readable() or not stat.S_ISREG(os.fstat(dst).st_mode):
+        return None
+    fileobj.flush()
+    offset = _member_offset(archive, info)
+    start = os.lseek(dst, 0, os.SEEK_CUR)
+    methods = [_copy_file_range, _sendfile, _pread_write]
+    remaining = info.compress_size
+    while remaining > 0:
+        try:
+            copied = methods[0](src, dst, offset, remaining)
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED or len(methods) == 1:
+                raise
+            logger.debug(f'{methods[0].__name__} is not supported for {info.filename}: {e}')
+            methods.pop(0)
+            continue
+        if not copied:
+            raise zipfile.BadZipFile(f'truncated member {info.filename}')
+        offset += copied
+        remaining -= copied
+    crc = _crc(dst, start, info.file_size)
+    if crc != info.CRC:
+        raise zipfile.BadZipFile(f'Bad CRC-32 for file {info.filename!r}')
+    # the file object does not know the kernel moved the file position
+    if fileobj.seekable():
+        fileobj.seek(0, io.SEEK_END)
+    return crc
+
+
+def _copy_file_range(src: int, dst: int, offset: int, count: int) -> int:
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    return os.copy_file_range(src, dst, count, offset)
+
+
+def _sendfile(src: int, dst: int, offset: int, count: int) -> int:
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, 'sendfile is not available')
+    return os.sendfile(dst, src, offset, count)
+
+
+def _pread_write(src: int, dst: int, offset: int, count: int) -> int:
+    chunk = os.pread(src, min(count, 1024 * 1024), offset)
+    return os.write(dst, chunk) if chunk else 0
+
+
+def _crc(fd: int, offset: int, size: int) -> int:
+    """
+    Compute the CRC-32 of a range of a file through a memory map of it
+    """
+    with mmap.mmap(fd, offset + size, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        with view[offset:] as member:
+            return zlib.crc32(member)
+
+
+def _member_offset(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> int:
+    """
+    Get the offset of the first byte of an archive member's (compressed) data by reading its
+    local file header
+    """
+    assert archive.fp is not None
+    archive.fp.seek(info.header_offset)
+    header = archive.fp.read(ZIP_LOCAL_HEADER.size)
+    if len(header) != ZIP_LOCAL_HEADER.size or header[:4] != ZIP_LOCAL_SIGNATURE:
+        raise zipfile.BadZipFile(f'bad local file header for member {info.filename}')
+    *_, name_length, extra_length = ZIP_LOCAL_HEADER.unpack(header)
+    return info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
 
 
-def _atomic_write(filename: str, content: bytes, overwrite: bool = True, permissions: int = 0o0644):
+def _raw_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo,
+                chunk_size: int = 1024 * 1024) -> Generator[bytes, None, None]:
     """
-    Write a file by first saving the content to a temporary file first, then
-    renaming the file. Overwrites silently by default o_o
+    Read the raw (still compressed) bytes of an archive member in chunks
     """
-    filename = os.path.expanduser(filename)
-    if not overwrite and os.path.exists(filename):
-        raise WriteError(f"file already exists: {filename}")
-    dirname = os.path.dirname(filename)
-    with tf.NamedTemporaryFile(dir=dirname, prefix='.', delete=False) as tmp:
-        tmp.write(content)
-    os.chmod(tmp.name, permissions)
-    os.rename(tmp.name, filename)
+    assert archive.fp is not None
+    offset = _member_offset(archive, info)
+    remaining = info.compress_size
+    while remaining > 0:
+        # seek every time, the underlying file object may be shared with other readers
+        archive.fp.seek(offset)
+        chunk = archive.fp.read(min(chunk_size, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f'truncated member {info.filename}')
+        offset += len(chunk)
+        remaining -= len(chunk)
+        yield chunk
 
 
 def _parse_datatype(member: str, user_id: str):
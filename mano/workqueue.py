@@ -0,0 +1,545 @@
+"""
+Durable work queue for distributing backfill windows across worker processes and hosts
+
+A work item is a (study, user, time window) download. Workers lease items for a limited time and
+renew the lease with heartbeats while they work. If a worker crashes its lease expires and the item
+is handed to another worker, up to `max_attempts` times, after which it is marked dead.
+
+Two implementations are provided: `SQLiteQueue` for workers on one host (SQLite must not be used on
+network filesystems), and `FileQueue` for workers on many hosts sharing a POSIX filesystem, which
+keeps one JSON file per item in a state directory and serializes changes with a lock file. Both hand
+out items in the order they were queued.
+
+Backfill windows are identified by their start, so queueing the backfill of a user again does not
+add overlapping items. Workers claim a backfill window the same way `mano.sync.backfill` does and
+move the user's backfill file forward once it is saved, so queued windows and backfills of the same
+user never save the same window at the same time.
+"""
+import hashlib
+import json
+import locale
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Generator, Iterator
+from contextlib import contextmanager
+
+import dateutil.parser
+
+import mano
+import mano.fileio as fileio
+import mano.stats as stats
+import mano.sync as sync
+from mano.cache import MetadataCache
+from mano.locking import FileLock
+from mano.storage import Storage
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+DEAD = 'dead'
+STATES = (PENDING, LEASED, DONE, DEAD)
+# seconds between checks of a backfill window claimed by another process
+CLAIM_POLL = 10
+
+logger = logging.getLogger(__name__)
+
+
+class QueueError(Exception):
+    pass
+
+
+class LeaseLost(QueueError):
+    pass
+
+
+class WorkItem:
+    """
+    A download window for one user
+    """
+
+    def __init__(self, study_id: str, user_id: str, time_start: str, time_end: str,
+                 data_streams: list[str] | None = None, study_name: str | None = None,
+                 id: str | None = None, attempts: int = 0, owner: str | None = None,
+                 expires: float = 0.0, error: str | None = None, start_date: str | None = None,
+                 resume: str | None = None):
+        self.study_id = study_id
+        self.user_id = user_id
+        self.time_start = time_start
+        self.time_end = time_end
+        self.data_streams = data_streams
+        # saved under <output_dir>/<study_name>, or the study ID if there is no name
+        self.study_name = study_name
+        # start date of the backfill this window belongs to, None for other downloads e.g., repairs
+        self.start_date = start_date
+        # resume point of a backfill window, or COMPLETE for the last one
+        self.resume = resume
+        # the same window for the same user is only ever queued once, backfill windows are identified
+        # by their start since the last one ends at the time it was queued
+        if start_date:
+            key = f'{study_id}/{user_id}/{time_start}/{data_streams}'
+        else:
+            key = f'{study_id}/{user_id}/{time_start}/{time_end}/{data_streams}'
+        self.id = id or hashlib.sha1(key.encode()).hexdigest()
+        self.attempts = attempts
+        self.owner = owner
+        self.expires = expires
+        self.error = error
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return f'WorkItem({self.study_id}/{self.user_id} [{self.time_start}, {self.time_end}])'
+
+
+class WorkQueue:
+    """
+    Base class for durable work queues
+    """
+
+    def __init__(self, lease: float = 300, max_attempts: int = 5):
+        """
+        :param lease: Seconds a lease lasts without a heartbeat
+        :param max_attempts: Number of leases after which a failing item is marked dead
+        """
+        self.lease_time = lease
+        self.max_attempts = max_attempts
+
+    def put(self, item: WorkItem) -> bool:
+        """
+        Add an item, unless an item with the same ID was already added
+
+        :returns: True if the item was added
+        """
+        raise NotImplementedError
+
+    def lease(self, owner: str) -> WorkItem | None:
+        """
+        Lease the next pending item (or an item whose lease expired)
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, item: WorkItem):
+        """
+        Renew the lease on an item, raises LeaseLost if it was reclaimed by another worker
+        """
+        raise NotImplementedError
+
+    def complete(self, item: WorkItem):
+        raise NotImplementedError
+
+    def fail(self, item: WorkItem, error: str):
+        """
+        Release an item for retry, or mark it dead once it has been attempted `max_attempts` times
+        """
+        raise NotImplementedError
+
+    def counts(self) -> dict[str, int]:
+        """
+        Count the items in each state
+        """
+        raise NotImplementedError
+
+
+class SQLiteQueue(WorkQueue):
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS items (
+            id TEXT PRIMARY KEY,
+            seq INTEGER,
+            state TEXT NOT NULL,
+            item TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            expires REAL NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS items_state ON items (state, seq);
+    '''
+
+    def __init__(self, path: str, lease: float = 300, max_attempts: int = 5):
+        super().__init__(lease, max_attempts)
+        self.path = os.path.expanduser(path)
+        with self._connect() as db:
+            db.executescript(self.SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Generator[sqlite3.Connection, None, None]:
+        # a connection per operation keeps the queue usable from any thread, statements autocommit
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            yield db
+        finally:
+            db.close()
+
+    def put(self, item: WorkItem) -> bool:
+        with self._connect() as db:
+            cursor = db.execute(
+                'INSERT OR IGNORE INTO items (id, seq, state, item) '
+                'VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM items), ?, ?)',
+                (item.id, PENDING, json.dumps(item.to_dict())))
+            return cursor.rowcount == 1
+
+    def lease(self, owner: str) -> WorkItem | None:
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            # items whose lease expired too many times are dead
+            db.execute('UPDATE items SET state = ?, owner = NULL WHERE state = ? AND expires < ? AND attempts >= ?',
+                       (DEAD, LEASED, now, self.max_attempts))
+            row = db.execute(
+                'SELECT id, item, attempts FROM items WHERE state = ? OR (state = ? AND expires < ?) '
+                'ORDER BY seq LIMIT 1', (PENDING, LEASED, now)).fetchone()
+            if not row:
+                db.execute('COMMIT')
+                return None
+            id, content, attempts = row
+            expires = now + self.lease_time
+            db.execute('UPDATE items SET state = ?, owner = ?, expires = ?, attempts = ? WHERE id = ?',
+                       (LEASED, owner, expires, attempts + 1, id))
+            db.execute('COMMIT')
+        item = WorkItem(**json.loads(content))
+        item.attempts, item.owner, item.expires = attempts + 1, owner, expires
+        return item
+
+    def heartbeat(self, item: WorkItem):
+        expires = time.time() + self.lease_time
+        with self._connect() as db:
+            cursor = db.execute('UPDATE items SET expires = ? WHERE id = ? AND state = ? AND owner = ?',
+                                (expires, item.id, LEASED, item.owner))
+        if cursor.rowcount != 1:
+            raise LeaseLost(f'lease on {item} was lost')
+        item.expires = expires
+
+    def complete(self, item: WorkItem):
+        self._release(item, DONE)
+
+    def fail(self, item: WorkItem, error: str):
+        item.error = error
+        self._release(item, DEAD if item.attempts >= self.max_attempts else PENDING)
+
+    def _release(self, item: WorkItem, state: str):
+        with self._connect() as db:
+            cursor = db.execute(
+                'UPDATE items SET state = ?, owner = NULL, expires = 0, item = ? WHERE id = ? AND state = ? '
+                'AND owner = ?', (state, json.dumps(item.to_dict()), item.id, LEASED, item.owner))
+        if cursor.rowcount != 1:
+            raise LeaseLost(f'lease on {item} was lost')
+
+    def counts(self) -> dict[str, int]:
+        with self._connect() as db:
+            rows = db.execute('SELECT state, COUNT(*) FROM items GROUP BY state').fetchall()
+        return {state: 0 for state in STATES} | dict(rows)
+
+
+class FileQueue(WorkQueue):
+    """
+    Queue kept in `<directory>/<state>/<item id>.json` on a shared POSIX filesystem. Items move
+    between state directories with atomic renames while holding `<directory>/.lock`. The
+    modification time of an item file is the time it was queued, which orders pending items.
+    """
+
+    def __init__(self, directory: str, lease: float = 300, max_attempts: int = 5):
+        super().__init__(lease, max_attempts)
+        self.directory = os.path.expanduser(directory)
+        for state in STATES:
+            os.makedirs(os.path.join(self.directory, state), exist_ok=True)
+        self._lock = os.path.join(self.directory, '.lock')
+
+    def _path(self, state: str, id: str) -> str:
+        return os.path.join(self.directory, state, f'{id}.json')
+
+    def _read(self, path: str) -> WorkItem:
+        with open(path) as fo:
+            return WorkItem(**json.load(fo))
+
+    def _write(self, path: str, item: WorkItem):
+        # keep the time the item was queued
+        queued = os.stat(path).st_mtime_ns if os.path.exists(path) else time.time_ns()
+        content = json.dumps(item.to_dict())
+        fileio.atomic_write(path, content.encode(locale.getpreferredencoding()))
+        os.utime(path, ns=(queued, queued))
+
+    def _ids(self, state: str) -> Iterator[str]:
+        with os.scandir(os.path.join(self.directory, state)) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and not entry.name.startswith('.'):
+                    yield entry.name[:-len('.json')]
+
+    def _oldest(self, state: str) -> str | None:
+        """
+        Get the ID of the item that was queued first
+        """
+        oldest = None
+        with os.scandir(os.path.join(self.directory, state)) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and not entry.name.startswith('.'):
+                    key = (entry.stat().st_mtime_ns, entry.name)
+                    if oldest is None or key < oldest:
+                        oldest = key
+        return oldest[1][:-len('.json')] if oldest else None
+
+    def put(self, item: WorkItem) -> bool:
+        with FileLock(self._lock):
+            if any(os.path.exists(self._path(state, item.id)) for state in STATES):
+                return False
+            self._write(self._path(PENDING, item.id), item)
+        return True
+
+    def lease(self, owner: str) -> WorkItem | None:
+        now = time.time()
+        with FileLock(self._lock):
+            # reclaim expired leases first, there is at most one leased item per worker
+            for id in list(self._ids(LEASED)):
+                path = self._path(LEASED, id)
+                item = self._read(path)
+                if item.expires < now:
+                    logger.warning(f'lease on {item} held by {item.owner} expired')
+                    item.owner, item.expires = None, 0.0
+                    state = DEAD if item.attempts >= self.max_attempts else PENDING
+                    self._write(path, item)
+                    os.rename(path, self._path(state, id))
+            oldest = self._oldest(PENDING)
+            if oldest is None:
+                return None
+            path = self._path(PENDING, oldest)
+            item = self._read(path)
+            item.attempts += 1
+            item.owner, item.expires = owner, now + self.lease_time
+            self._write(path, item)
+            os.rename(path, self._path(LEASED, oldest))
+        return item
+
+    def _check_owner(self, item: WorkItem) -> str:
+        path = self._path(LEASED, item.id)
+        if not os.path.exists(path) or self._read(path).owner != item.owner:
+            raise LeaseLost(f'lease on {item} was lost')
+        return path
+
+    def heartbeat(self, item: WorkItem):
+        with FileLock(self._lock):
+            path = self._check_owner(item)
+            item.expires = time.time() + self.lease_time
+            self._write(path, item)
+
+    def complete(self, item: WorkItem):
+        self._release(item, DONE)
+
+    def fail(self, item: WorkItem, error: str):
+        item.error = error
+        self._release(item, DEAD if item.attempts >= self.max_attempts else PENDING)
+
+    def _release(self, item: WorkItem, state: str):
+        with FileLock(self._lock):
+            path = self._check_owner(item)
+            owner = item.owner
+            item.owner, item.expires = None, 0.0
+            self._write(path, item)
+            os.rename(path, self._path(state, item.id))
+            item.owner = owner
+
+    def counts(self) -> dict[str, int]:
+        return {state: sum(1 for _ in self._ids(state)) for state in STATES}
+
+
+def open_queue(url: str, lease: float = 300, max_attempts: int = 5) -> WorkQueue:
+    """
+    Open a queue from a URL, either `sqlite:///path/to/queue.db` or `file:///path/to/directory`.
+    A plain path is treated as SQLite if it ends with `.db` or `.sqlite`, otherwise as a directory.
+    """
+    if url.startswith('sqlite://'):
+        return SQLiteQueue(url[len('sqlite://'):], lease, max_attempts)
+    if url.startswith('file://'):
+        return FileQueue(url[len('file://'):], lease, max_attempts)
+    if url.endswith(('.db', '.sqlite')):
+        return SQLiteQueue(url, lease, max_attempts)
+    return FileQueue(url, lease, max_attempts)
+
+
+def enqueue_backfill(
+        queue: WorkQueue,
+        Keyring: dict[str, str],
+        study_id: str,
+        user_ids: list[str] | None = None,
+        start_date: str = sync.BACKFILL_START_DATE,
+        data_streams: list[str] | None = None,
+        study_name: str | None = None,
+        cache: MetadataCache | None = None,
+        output_dir: str | None = None,
+    ) -> int:
+    """
+    Queue the backfill windows of a study from `start_date` up to the present, for the given users
+    or every user in the study
+
+    :param cache: Metadata cache for the user list
+    :param output_dir: Folder the workers save into, users start from the resume point of their
+                       backfill file there and completed backfills are skipped
+    :returns: Number of items added
+    """
+    if user_ids is None:
+        user_ids = list(mano.users(Keyring, study_id, cache=cache))
+    num_added = 0
+    for user_id in user_ids:
+        timestamp: str | None = start_date
+        if output_dir:
+            backfill_file = os.path.join(output_dir, study_name or study_id, user_id, '.backfill')
+            if os.path.exists(backfill_file):
+                with open(backfill_file) as fo:
+                    timestamp = fo.read().strip() or start_date
+            if timestamp == 'COMPLETE':
+                continue
+        while timestamp:
+            start, stop, timestamp = sync._window(timestamp, sync.BACKFILL_WINDOW)
+            item = WorkItem(study_id, user_id, start, stop, data_streams, study_name, start_date=start_date,
+                            resume=timestamp or 'COMPLETE')
+            num_added += queue.put(item)
+    logger.info(f'queued {num_added} windows for study {study_id}')
+    return num_added
+
+
+class Worker:
+    """
+    Pull items from a queue and download and save them into `<output_dir>/<study_name>/<user_id>`
+    """
+
+    def __init__(self, queue: WorkQueue, Keyring: dict[str, str], output_dir: str,
+                 lock: list[str] | None = None, passphrase: str | None = None,
+                 compress: dict[str, str] | None = None, storage: Callable[[str], Storage] | None = None,
+                 owner: str | None = None):
+        """
+        :param lock: Data streams to encrypt with `passphrase`
+        :param compress: Codecs by data stream, see `mano.compression`
+        :param storage: Storage backend for a study folder e.g., `DedupStorage`, the directory layout if None
+        """
+        self.queue = queue
+        self.Keyring = Keyring
+        self.output_dir = output_dir
+        self.lock = lock
+        self.passphrase = passphrase
+        self.compress = compress
+        # storage backends are rooted at the folder of each study
+        self.storage = storage
+        self._storages: dict[str, Storage] = {}
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+    def process(self, item: WorkItem) -> int:
+        """
+        Download and save one item, renewing its lease in the background
+        """
+        output_dir = os.path.join(self.output_dir, item.study_name or item.study_id)
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.queue.lease_time / 3):
+                try:
+                    self.queue.heartbeat(item)
+                except LeaseLost:
+                    logger.warning(f'lost lease on {item}, another worker may be processing it')
+                    lost.set()
+                    return
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        user_dir = os.path.join(output_dir, item.user_id)
+        try:
+            if item.start_date and not self._claim(item, user_dir, lost):
+                logger.info(f'{item} was already saved')
+                return 0
+            try:
+                started = time.monotonic()
+                archive = sync.download(self.Keyring, item.study_id, [item.user_id], item.data_streams,
+                                        time_start=item.time_start, time_end=item.time_end)
+                num_saved = sync.save(self.Keyring, archive, item.user_id, output_dir, self.lock, self.passphrase,
+                                      compress=self.compress, storage=self._storage(output_dir))
+                stats.record(output_dir, archive, item.data_streams or mano.DATA_STREAMS, item.time_start,
+                             item.time_end, time.monotonic() - started)
+            except BaseException:
+                if item.start_date:
+                    sync._release_window(user_dir, item.time_start)
+                raise
+            if item.start_date:
+                resume = item.resume or sync._window(item.time_start, sync.BACKFILL_WINDOW)[2]
+                sync._finish_window(user_dir, item.time_start, item.start_date, resume)
+            return num_saved
+        finally:
+            stop.set()
+            thread.join()
+            if lost.is_set():
+                raise LeaseLost(f'lease on {item} was lost')
+
+    def _storage(self, study_dir: str) -> Storage | None:
+        if not self.storage:
+            return None
+        if study_dir not in self._storages:
+            self._storages[study_dir] = self.storage(study_dir)
+        return self._storages[study_dir]
+
+    def _claim(self, item: WorkItem, user_dir: str, lost: threading.Event) -> bool:
+        """
+        Claim a backfill window like `mano.sync.backfill` does, waiting while another process works on it
+
+        :returns: False if the window was already saved
+        """
+        assert item.start_date is not None
+        if not os.path.exists(user_dir):
+            fileio.makedirs(user_dir)
+        claim_file = sync._claim_file(user_dir, item.time_start, '.claim')
+        while True:
+            with sync._user_lock(user_dir):
+                checkpoint = sync._advance_checkpoint(user_dir, item.start_date)
+                if (checkpoint == 'COMPLETE'
+                        or dateutil.parser.parse(item.time_start) < dateutil.parser.parse(checkpoint)
+                        or os.path.exists(sync._claim_file(user_dir, item.time_start, '.done'))):
+                    return False
+                if not sync._claimed(claim_file):
+                    sync._claim(claim_file)
+                    return True
+            logger.info(f'{item} is claimed by another process, waiting')
+            if lost.wait(CLAIM_POLL):
+                raise LeaseLost(f'lease on {item} was lost')
+
+    def run(self, stop: threading.Event | None = None, idle: float = 0, poll: float = 10) -> int:
+        """
+        Process items until the queue is drained (or until `stop` is set)
+
+        :param idle: Keep polling an empty queue for this many seconds before returning
+        :param poll: Seconds between polls of an empty queue
+        :returns: Number of items completed
+        """
+        stop = stop or threading.Event()
+        num_completed = 0
+        idle_since = None
+        while not stop.is_set():
+            item = self.queue.lease(self.owner)
+            if item is None:
+                idle_since = idle_since or time.monotonic()
+                if time.monotonic() - idle_since >= idle:
+                    break
+                stop.wait(poll)
+                continue
+            idle_since = None
+            logger.info(f'processing {item} (attempt {item.attempts})')
+            try:
+                num_saved = self.process(item)
+            except LeaseLost:
+                continue
+            except Exception as e:
+                logger.exception(f'failed to process {item}: {e}')
+                try:
+                    self.queue.fail(item, f'{type(e).__name__}: {e}')
+                except LeaseLost:
+                    pass
+                continue
+            try:
+                self.queue.complete(item)
+            except LeaseLost:
+                logger.warning(f'lease on {item} expired before it was completed')
+                continue
+            logger.info(f'completed {item}, saved {num_saved} files')
+            num_completed += 1
+        return num_completed
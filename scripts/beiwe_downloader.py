@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import logging
 import os
 
 import mano
+import mano.deployments
+import mano.hedging
+import mano.planner
+import mano.ratelimit
 import mano.sync as msync
 
 
@@ -16,17 +21,63 @@ def main():
     parser = argparse.ArgumentParser('beiwe downloader script')
     parser.add_argument('--output-base', default='.')
     parser.add_argument('--backfill-start', default='2022-02-15T00:00:00')
-    parser.add_argument('--keyring-section', default='beiwe.onnela')
+    parser.add_argument('--keyring-section', action='append', dest='keyring_sections',
+                        help='deployment to download (repeatable), defaults to beiwe.onnela')
+    parser.add_argument('--all-deployments', action='store_true', help='download every deployment in the keyring')
+    parser.add_argument('--workers', type=int, default=2, help='users downloaded at the same time per deployment')
+    parser.add_argument('--rate', type=float, default=None, help='requests per second per deployment')
+    parser.add_argument('--plan', action='store_true', help='estimate the backfill without downloading any data')
+    parser.add_argument('--concurrency', type=int, default=1, help='concurrency to estimate the duration for')
+    parser.add_argument('--profile', default=None, help='write profiles of every backfill window to this directory')
+    parser.add_argument('--bandwidth', default=None,
+                        help='bytes per second of all downloads e.g., 22:00-06:00=unlimited,06:00-22:00=2M')
+    parser.add_argument('--hedge', type=float, default=None, metavar='PERCENTILE',
+                        help='request a window again when it is slower than this percentile of earlier windows')
+    parser.add_argument('--recent-first', action='store_true',
+                        help='download the newest data first and work backward to --backfill-start')
     args = parser.parse_args()
+    if args.bandwidth:
+        mano.ratelimit.configure_bandwidth(args.bandwidth)
+    if args.hedge:
+        mano.hedging.configure(args.hedge)
 
-    Keyring = mano.keyring(args.keyring_section)
+    # several deployments are downloaded in parallel into <output-base>/<deployment>/<study name>
+    multiple = args.all_deployments or (args.keyring_sections and len(args.keyring_sections) > 1)
+
+    if args.plan:
+        if multiple:
+            Keyrings = mano.keyrings()
+            totals = {}
+            for name in args.keyring_sections or sorted(Keyrings):
+                plan = mano.planner.plan(Keyrings[name], os.path.join(args.output_base, name),
+                                         start_date=args.backfill_start, concurrency=args.concurrency)
+                totals[name] = plan.totals()
+            print(json.dumps(totals, indent=2))
+            return
+        Keyring = mano.keyring(args.keyring_sections[0] if args.keyring_sections else 'beiwe.onnela')
+        plan = mano.planner.plan(Keyring, args.output_base, start_date=args.backfill_start,
+                                 concurrency=args.concurrency)
+        print(json.dumps(plan.totals(), indent=2))
+        return
+
+    if multiple:
+        Keyrings = mano.keyrings()
+        report = mano.deployments.sync_deployments(Keyrings, args.output_base, deployments=args.keyring_sections,
+                                                   start_date=args.backfill_start, workers=args.workers,
+                                                   rate=args.rate, recent_first=args.recent_first,
+                                                   profile=args.profile)
+        print(json.dumps(report, indent=2))
+        return
+
+    Keyring = mano.keyring(args.keyring_sections[0] if args.keyring_sections else 'beiwe.onnela')
 
     for study in mano.studies(Keyring):
         study_name, study_id = study
         for user_id in mano.users(Keyring, study_id):
             logger.info('downloading study=%s, user=%s', study_name, user_id)
             output_folder = os.path.join(args.output_base, study_name)
-            msync.backfill(Keyring, study_id, user_id, output_folder, start_date=args.backfill_start)
+            msync.backfill(Keyring, study_id, user_id, output_folder, start_date=args.backfill_start,
+                           profile=args.profile, recent_first=args.recent_first)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Measure the throughput of mano.sync.save for a kept archive of stored (uncompressed) members, opened
+like mano.sync.download opens it, with and without copying members in the kernel (see
+mano.sync.COPY_STORED)
+"""
+import argparse
+import os
+import tempfile
+import time
+import zipfile
+
+import mano.archive
+import mano.sync as msync
+
+USER_ID = 'benchmark'
+
+
+def build_archive(path: str, members: int, size: int):
+    content = os.urandom(size)
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr('registry', '{"benchmark": "benchmark"}')
+        for i in range(members):
+            zf.writestr(f'{USER_ID}/gps/2018-06-{1 + i // 24:02d} {i % 24:02d}_00_00.csv', content)
+
+
+def run(archive_path: str, output_dir: str, copy_stored: bool) -> float:
+    msync.COPY_STORED = copy_stored
+    with mano.archive.open_archive(archive_path) as archive:
+        started = time.perf_counter()
+        msync.save({}, archive, USER_ID, output_dir)
+        return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser('benchmark mano.sync.save')
+    parser.add_argument('--members', type=int, default=48)
+    parser.add_argument('--size', type=int, default=8 * 1024 * 1024, help='bytes per member')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    total = args.members * args.size
+    with tempfile.TemporaryDirectory() as tmp:
+        archive_path = os.path.join(tmp, 'archive.zip')
+        build_archive(archive_path, args.members, args.size)
+        for copy_stored in (False, True):
+            seconds = min(run(archive_path, os.path.join(tmp, f'output-{copy_stored}-{i}'), copy_stored)
+                          for i in range(args.repeat))
+            label = 'kernel copy' if copy_stored else 'python copy'
+            print(f'{label}: {total / seconds / 1024 ** 2:.1f} MiB/s ({seconds:.3f}s for {total} bytes)')
+
+
+if __name__ == '__main__':
+    main()
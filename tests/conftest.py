@@ -1,7 +1,9 @@
 """
 Pytest configuration and shared fixtures for mano tests.
 """
+import io
 import os
+import zipfile
 
 import pytest
 import responses
@@ -103,3 +105,15 @@ def mock_studies_response():
 def mock_users_response():
     """Mock API response for get-users/v1 endpoint"""
     return '["tgsidhm", "lholbc5", "yxzxtwr"]'
+
+
+@pytest.fixture
+def mock_archive(mock_zip_data):
+    """The original download as a ZipFile object, as returned by mano.sync.download"""
+    return zipfile.ZipFile(io.BytesIO(mock_zip_data))
+
+
+@pytest.fixture
+def mock_user_id():
+    """The participant ID contained in the original download"""
+    return '6y6s1w4g'
@@ -0,0 +1,93 @@
+"""
+Tests for the lazy archive mode
+"""
+import os
+import zipfile
+
+import pytest
+import responses
+
+import mano.archive
+import mano.coverage
+import mano.feed
+import mano.fsck
+import mano.manifest
+import mano.sync
+
+GPS_MEMBER = '6y6s1w4g/gps/2018-06-16 11_00_00.csv'
+
+
+def _download(keyring, archive_dir, **kwargs):
+    return mano.sync.download(keyring, 'STUDY_ID', ['6y6s1w4g'], ['gps'], time_start='2018-06-15T00:00:00',
+                              time_end='2018-06-17T00:00:00', archive_dir=str(archive_dir), **kwargs)
+
+
+def test_download_keeps_archive(mock_download_api, mock_zip_data, keyring, tmp_path):
+    archive = _download(keyring, tmp_path)
+    assert isinstance(archive, zipfile.ZipFile)
+    assert archive.read(GPS_MEMBER)
+    # content addressed, downloading the same archive again keeps one copy
+    _download(keyring, tmp_path)
+    assert os.listdir(tmp_path) == [mano.archive.hashlib.sha256(mock_zip_data).hexdigest() + '.zip']
+
+    _download(keyring, tmp_path, content_addressed=False)
+    assert 'STUDY_ID_6y6s1w4g_2018-06-15T00_00_00_2018-06-17T00_00_00.zip' in os.listdir(tmp_path)
+
+
+def test_bad_download_is_set_aside(mock_zip_data, keyring, tmp_path):
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data[:-100])
+        _download(keyring, tmp_path, content_addressed=False)
+        with pytest.raises(mano.sync.DownloadError):
+            _download(keyring, tmp_path, content_addressed=False)
+    # the damaged download did not replace the archive kept for the same request
+    name = 'STUDY_ID_6y6s1w4g_2018-06-15T00_00_00_2018-06-17T00_00_00.zip'
+    assert sorted(os.listdir(tmp_path)) == [name, name + mano.archive.BAD_EXT]
+    assert (tmp_path / name).read_bytes() == mock_zip_data
+    # and an archive that cannot be opened does not break the tree
+    (tmp_path / 'damaged.zip').write_bytes(mock_zip_data[:-100])
+    with mano.archive.ArchiveTree(str(tmp_path)) as tree:
+        assert tree.archives() == [str(tmp_path / name)]
+        assert tree.read(GPS_MEMBER)
+
+
+def test_tree_resolves_paths(mock_download_api, mock_archive, keyring, tmp_path):
+    _download(keyring, tmp_path)
+    with mano.archive.ArchiveTree(str(tmp_path)) as tree:
+        paths = list(tree.paths('6y6s1w4g/gps/2018-06-16'))
+        assert len(paths) == 21
+        assert paths[11] == '6y6s1w4g/gps/2018-06-16 11_00_00'
+        assert tree.member('6y6s1w4g/gps/2018-06-16T11:00:00') == GPS_MEMBER
+        assert tree.read('6y6s1w4g/gps/2018-06-16T11:00:00') == mock_archive.read(GPS_MEMBER)
+        assert tree.read(GPS_MEMBER) == mock_archive.read(GPS_MEMBER)
+        with pytest.raises(FileNotFoundError):
+            tree.resolve('6y6s1w4g/gps/2019-01-01T00:00:00')
+
+
+def test_backfill_keeps_archives_then_materialize(keyring, mock_zip_data, mock_archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 10000)
+    monkeypatch.setattr(mano.sync.time, 'sleep', lambda seconds: None)
+    output_dir = tmp_path / 'output'
+    archive_dir = tmp_path / 'archives'
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        mano.sync.backfill(keyring, 'STUDY_ID', '6y6s1w4g', str(output_dir), start_date='2018-06-15T00:00:00',
+                           archive_dir=str(archive_dir))
+
+    # nothing is extracted, but the registry and coverage index know about the kept files
+    assert not os.path.exists(output_dir / '6y6s1w4g' / 'gps')
+    assert os.path.exists(output_dir / '6y6s1w4g' / '.registry')
+    assert mano.coverage.load(str(output_dir), '6y6s1w4g').hours('gps') == 29
+    # and so do the manifest and change feed, and verify finds them in their archive
+    entry = mano.manifest.load(str(output_dir), '6y6s1w4g')[GPS_MEMBER]
+    assert entry['archived'].startswith(str(archive_dir))
+    assert entry['crc'] == mock_archive.getinfo(GPS_MEMBER).CRC
+    assert len(list(mano.feed.read(str(output_dir)))) == 30
+    report = mano.fsck.verify(str(output_dir), workers=1)
+    assert report.ok and report.checked == 30
+
+    with mano.archive.ArchiveTree(str(archive_dir)) as tree:
+        assert tree.materialize(str(output_dir), '6y6s1w4g') == 30
+    with open(output_dir / GPS_MEMBER, 'rb') as fo:
+        assert fo.read() == mock_archive.read(GPS_MEMBER)
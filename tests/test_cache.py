@@ -0,0 +1,100 @@
+"""
+Tests for the persistent metadata cache
+"""
+import os
+
+import pytest
+import requests
+import responses
+
+import mano
+from mano.cache import MetadataCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MetadataCache(str(tmp_path / 'cache'))
+
+
+@responses.activate
+def test_etag_revalidation(keyring, mock_studies_response, cache):
+    url = keyring['URL'] + '/get-studies/v1'
+    responses.post(url, body=mock_studies_response, headers={'ETag': '"v1"'})
+    first = list(mano.studies(keyring, cache=cache))
+    assert ('Project A', '123lrVdb0g6tf3PeJr5ZtZC8') in first
+
+    responses.replace(responses.POST, url, status=304)
+    assert list(mano.studies(keyring, cache=cache)) == first
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+@responses.activate
+def test_content_hash_skips_parsing(keyring, mock_users_response, cache, monkeypatch):
+    url = keyring['URL'] + '/get-users/v1'
+    responses.post(url, body=mock_users_response)
+    assert list(mano.users(keyring, 'STUDY_ID', cache=cache)) == ['tgsidhm', 'lholbc5', 'yxzxtwr']
+    assert 'If-None-Match' not in responses.calls[0].request.headers
+
+    # an unchanged response is never parsed again
+    monkeypatch.setattr(mano.mano, '_parse_users', lambda resp: pytest.fail('response was parsed'))
+    assert list(mano.users(keyring, 'STUDY_ID', cache=cache)) == ['tgsidhm', 'lholbc5', 'yxzxtwr']
+    assert cache.hits == 1
+    monkeypatch.undo()
+
+    # a changed response is
+    responses.replace(responses.POST, url, body='["tgsidhm"]')
+    assert list(mano.users(keyring, 'STUDY_ID', cache=cache)) == ['tgsidhm']
+    # other studies have their own entry
+    assert list(mano.users(keyring, 'OTHER_STUDY', cache=cache)) == ['tgsidhm']
+    assert cache.misses == 3
+
+
+@responses.activate
+def test_responses_are_streamed(keyring, mock_users_response, cache, monkeypatch):
+    url = keyring['URL'] + '/get-users/v1'
+    responses.post(url, body=mock_users_response)
+    monkeypatch.setattr(requests.Response, 'content', property(lambda self: pytest.fail('content was read')))
+    assert list(mano.users(keyring, 'STUDY_ID', cache=cache)) == ['tgsidhm', 'lholbc5', 'yxzxtwr']
+    assert list(mano.users(keyring, 'STUDY_ID', cache=cache)) == ['tgsidhm', 'lholbc5', 'yxzxtwr']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+@responses.activate
+def test_errors_are_not_cached(keyring, cache):
+    url = keyring['URL'] + '/get-users/v1'
+    responses.post(url, status=500)
+    with pytest.raises(mano.APIError):
+        list(mano.users(keyring, 'STUDY_ID', cache=cache))
+    assert not os.path.exists(cache.cache_dir)
+
+
+def test_evict_least_recently_used(cache):
+    keys = [cache.key('POST', 'https://example.org', {'study_id': str(i)}) for i in range(4)]
+    for i, key in enumerate(keys):
+        cache.put(key, {'value': 'x' * 100})
+        os.utime(cache.path(key), (i, i))
+    cache.touch(keys[0])
+    size = os.path.getsize(cache.path(keys[0]))
+    cache.max_size = 2 * size
+    assert cache.evict() == 2
+    assert [cache.get(key) is not None for key in keys] == [True, False, False, True]
+
+
+def test_put_keeps_a_running_size(cache, monkeypatch):
+    walks = []
+    walk = os.walk
+    monkeypatch.setattr(os, 'walk', lambda *args: walks.append(args) or walk(*args))
+    keys = [cache.key('POST', 'https://example.org', {'study_id': str(i)}) for i in range(4)]
+    for key in keys:
+        cache.put(key, {'value': 'x' * 100})
+    # the cache directory is walked once, to learn its size
+    assert len(walks) == 1
+    cache.put(keys[0], {'value': 'x' * 100})
+    assert len(walks) == 1
+
+    # and again once the running total is over the limit
+    cache.max_size = 2 * os.path.getsize(cache.path(keys[0]))
+    cache.put(keys[0], {'value': 'x' * 100})
+    assert len(walks) == 2
+    assert sum(cache.get(key) is not None for key in keys) == 2
@@ -0,0 +1,62 @@
+"""
+Tests for the columnar reader
+"""
+import os
+
+import pytest
+
+import mano.sync
+
+np = pytest.importorskip('numpy')
+columnar = pytest.importorskip('mano.columnar')
+
+PASSPHRASE = 'correct horse battery staple'
+
+
+def test_parse_csv():
+    content = (b'timestamp,UTC time,accuracy,x\r\n'
+               b'1529147114051,2018-06-16T11:05:14.051,unknown,0.5\r\n'
+               b'1529147134058,2018-06-16T11:05:34.058,high,-1\r\n')
+    array = columnar.parse_csv(content)
+    assert array.dtype.names == ('timestamp', 'UTC time', 'accuracy', 'x')
+    assert array['timestamp'].dtype == np.int64
+    assert array['UTC time'][1] == np.datetime64('2018-06-16T11:05:34.058')
+    assert list(array['accuracy']) == ['unknown', 'high']
+    assert list(array['x']) == [0.5, -1.0]
+    assert len(columnar.parse_csv(b'timestamp,x\n')) == 0
+    with pytest.raises(columnar.ColumnarError):
+        columnar.parse_csv(b'a,b\n1,2\n3\n')
+
+
+def test_load_writes_and_uses_sidecars(keyring, mock_archive, mock_user_id, tmp_path, monkeypatch):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), compress={'gps': 'gzip'})
+    columns = columnar.load(str(tmp_path), mock_user_id, 'gps')
+    assert len(columns['timestamp']) == 4831
+    assert columns['latitude'].dtype == np.float64
+    gps_dir = tmp_path / mock_user_id / 'gps'
+    assert len([name for name in os.listdir(gps_dir) if name.endswith('.npy')]) == 29
+
+    # the second load never parses a CSV file
+    monkeypatch.setattr(columnar, 'parse_csv', lambda content: pytest.fail('parsed a CSV file'))
+    target, array = next(columnar.load_files(str(tmp_path), mock_user_id, 'gps'))
+    assert isinstance(array, np.memmap)
+    again = columnar.load(str(tmp_path), mock_user_id, 'gps')
+    assert np.array_equal(again['timestamp'], columns['timestamp'])
+    monkeypatch.undo()
+
+    # a rewritten file gets a new sidecar
+    path = tmp_path / target
+    os.utime(path, ns=(0, 0))
+    columnar.load(str(tmp_path), mock_user_id, 'gps', time_end='2018-06-15T17:00:00')
+    assert len([name for name in os.listdir(gps_dir) if name.startswith(f'.{os.path.basename(target)}.')]) == 1
+    assert len([name for name in os.listdir(gps_dir) if name.endswith('.npy')]) == 29
+
+
+def test_load_time_range_locked(keyring, mock_archive, mock_user_id, tmp_path):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), lock=['gps'], passphrase=PASSPHRASE)
+    columns = columnar.load(str(tmp_path), mock_user_id, 'gps', time_start='2018-06-16T11:30:00',
+                            time_end='2018-06-16T12:00:00', passphrase=PASSPHRASE)
+    assert len(columns['timestamp']) == 199
+    assert columns['UTC time'].min() >= np.datetime64('2018-06-16T11:30:00')
+    # locked files never get a sidecar
+    assert not [name for name in os.listdir(tmp_path / mock_user_id / 'gps') if name.endswith('.npy')]
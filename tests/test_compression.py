@@ -0,0 +1,93 @@
+"""
+Tests for storage codecs used by mano.sync.save
+"""
+import gzip
+import io
+import lzma
+import os
+import zipfile
+
+import pytest
+
+import mano.compression
+import mano.sync
+
+
+GPS_MEMBER = '6y6s1w4g/gps/2018-06-16 11_00_00.csv'
+
+
+def test_save_skips_directory_entries(keyring, mock_archive, mock_user_id, tmp_path):
+    num_saved = mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path))
+    assert num_saved == 30
+    with open(tmp_path / GPS_MEMBER, 'rb') as fo:
+        assert fo.read() == mock_archive.read(GPS_MEMBER)
+
+
+def test_save_gzip_passthrough(keyring, mock_archive, mock_user_id, tmp_path, monkeypatch):
+    # deflated members must be framed as gzip without being recompressed
+    def fail(*args, **kwargs):
+        raise AssertionError('member was recompressed')
+    monkeypatch.setattr(mano.compression.GzipCodec, 'compressor', fail)
+
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), compress={'gps': 'gzip'})
+    filename = tmp_path / (GPS_MEMBER + '.gz')
+    with open(filename, 'rb') as fo:
+        assert gzip.decompress(fo.read()) == mock_archive.read(GPS_MEMBER)
+    with mano.sync.open_saved(str(filename)) as fo:
+        assert fo.read() == mock_archive.read(GPS_MEMBER)
+    # streams without a codec are saved as is
+    assert os.path.exists(tmp_path / '6y6s1w4g/identifiers/2018-06-15 16_00_00.csv')
+
+
+def test_save_gzip_stored_member(keyring, mock_user_id, tmp_path):
+    content = b'timestamp,UTC time,latitude\n1,2,3\n'
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr('registry', '{"a": "b"}')
+        zf.writestr(f'{mock_user_id}/gps/2018-06-16 11_00_00.csv', content)
+    archive = zipfile.ZipFile(buf)
+
+    mano.sync.save(keyring, archive, mock_user_id, str(tmp_path), compress={'gps': 'gzip'})
+    with mano.sync.open_saved(str(tmp_path / (GPS_MEMBER + '.gz'))) as fo:
+        assert fo.read() == content
+
+
+def test_save_lzma(keyring, mock_archive, mock_user_id, tmp_path):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), compress={'gps': 'lzma'})
+    filename = tmp_path / (GPS_MEMBER + '.xz')
+    with open(filename, 'rb') as fo:
+        assert lzma.decompress(fo.read()) == mock_archive.read(GPS_MEMBER)
+
+
+def test_register_custom_codec(keyring, mock_archive, mock_user_id, tmp_path, monkeypatch):
+    class Identity(mano.compression.Codec):
+        name = 'identity'
+        extension = '.id'
+
+        def compressor(self, fileobj):
+            return _Unclosable(fileobj)
+
+        def decompressor(self, fileobj):
+            return fileobj
+
+    monkeypatch.setattr(mano.compression, 'CODECS', dict(mano.compression.CODECS))
+    mano.compression.register(Identity())
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), compress={'gps': 'identity'})
+    with mano.sync.open_saved(str(tmp_path / (GPS_MEMBER + '.id'))) as fo:
+        assert fo.read() == mock_archive.read(GPS_MEMBER)
+
+
+def test_unknown_codec(keyring, mock_archive, mock_user_id, tmp_path):
+    with pytest.raises(mano.compression.CodecError, match='unknown codec'):
+        mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), compress={'gps': 'zstd'})
+
+
+class _Unclosable(io.RawIOBase):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.fileobj.write(b)
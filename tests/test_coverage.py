@@ -0,0 +1,130 @@
+"""
+Tests for the coverage index and gap-targeted backfill
+"""
+import io
+import json
+import os
+import urllib.parse
+import zipfile
+from datetime import datetime, timedelta
+
+import responses
+
+import mano.coverage
+import mano.sync
+
+
+def test_save_updates_coverage(keyring, mock_archive, mock_user_id, tmp_path):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path))
+    cov = mano.coverage.load(str(tmp_path), mock_user_id)
+    assert cov.data_streams() == ['gps', 'identifiers']
+    assert cov.hours('gps') == 29
+    assert cov.covered('gps', datetime(2018, 6, 15, 16))
+    assert not cov.covered('gps', datetime(2018, 6, 15, 15))
+
+
+def test_missing_and_gaps():
+    cov = mano.coverage.Coverage()
+    for hour in (0, 1, 5):
+        cov.add('gps', datetime(2018, 6, 15, hour))
+    cov.add('accelerometer', datetime(2018, 6, 15, 3))
+    start, end = datetime(2018, 6, 15), datetime(2018, 6, 15, 8)
+
+    assert cov.missing('gps', start, end) == [
+        (datetime(2018, 6, 15, 2), datetime(2018, 6, 15, 5)),
+        (datetime(2018, 6, 15, 6), end),
+    ]
+    windows = mano.coverage.gaps(cov, ['gps', 'accelerometer'], start, end, timedelta(hours=3))
+    assert windows == [
+        (datetime(2018, 6, 15, 0), datetime(2018, 6, 15, 3), ['accelerometer', 'gps']),
+        (datetime(2018, 6, 15, 3), datetime(2018, 6, 15, 6), ['accelerometer', 'gps']),
+        (datetime(2018, 6, 15, 6), end, ['accelerometer', 'gps']),
+    ]
+    assert mano.coverage.gaps(cov, ['gps'], start, end, timedelta(days=5)) == [
+        (datetime(2018, 6, 15, 2), datetime(2018, 6, 15, 5), ['gps']),
+        (datetime(2018, 6, 15, 6), end, ['gps']),
+    ]
+
+
+def test_span_and_merged_gaps():
+    cov = mano.coverage.Coverage()
+    assert cov.span() is None
+    for hour in (2, 3, 7, 20):
+        cov.add('gps', datetime(2018, 6, 15, hour))
+    cov.add('accelerometer', datetime(2018, 6, 16, 1))
+    assert cov.span() == (datetime(2018, 6, 15, 2), datetime(2018, 6, 16, 2))
+
+    start, end = cov.span()
+    # holes a few hours apart become one window, checked hours are not missing
+    checked = mano.coverage.Coverage()
+    for hour in range(21, 24):
+        checked.add('gps', datetime(2018, 6, 15, hour))
+    windows = mano.coverage.gaps(cov, ['gps'], start, end, timedelta(days=5), checked=checked,
+                                 merge=timedelta(hours=3))
+    assert windows == [(datetime(2018, 6, 15, 4), datetime(2018, 6, 15, 20), ['gps']),
+                       (datetime(2018, 6, 16), end, ['gps'])]
+
+
+def test_missing_skips_whole_days():
+    cov = mano.coverage.Coverage({'gps': {'2018-06-16': mano.coverage.FULL_DAY}})
+    start, end = datetime(2018, 6, 15), datetime(2018, 6, 18)
+    assert cov.missing('gps', start, end) == [
+        (datetime(2018, 6, 15), datetime(2018, 6, 16)),
+        (datetime(2018, 6, 17), end),
+    ]
+
+
+def test_parse_registry_key():
+    key = 'CHUNKED_DATA/fiaKUCTtfqH5oQ4tz8V6LWiF/6y6s1w4g/gps/2018-06-15T16:00:00.csv'
+    assert mano.coverage.parse_registry_key(key) == ('6y6s1w4g', 'gps', datetime(2018, 6, 15, 16))
+
+
+def test_gapfill_requests_missing_windows(keyring, mock_archive, mock_zip_data, mock_user_id, tmp_path):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path))
+    # simulate a deleted file
+    os.remove(tmp_path / mock_user_id / 'gps' / '2018-06-16 00_00_00.csv')
+
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data, status=200)
+        num_saved = mano.sync.gapfill(keyring, 'STUDY_ID', mock_user_id, str(tmp_path),
+                                      start_date='2018-06-15T16:00:00', end_date='2018-06-16T20:00:00',
+                                      data_streams=['gps'], rebuild=True)
+        assert len(rsps.calls) == 1
+        body = urllib.parse.parse_qs(rsps.calls[0].request.body)
+        assert body['data_streams'] == ['gps']
+        assert body['time_start'] == ['2018-06-16T00:00:00']
+        assert body['time_end'] == ['2018-06-16T01:00:00']
+        # the deleted file is not in the registry sent to the server
+        registry = json.loads(body['registry'][0])
+        assert len(registry) == 29
+        assert not any('2018-06-16T00:00:00' in key for key in registry)
+
+    assert num_saved == 30
+    assert os.path.exists(tmp_path / mock_user_id / 'gps' / '2018-06-16 00_00_00.csv')
+
+
+def test_gapfill_does_not_request_empty_hours_again(keyring, mock_archive, mock_user_id, tmp_path):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path))
+    os.remove(tmp_path / mock_user_id / 'gps' / '2018-06-15 18_00_00.csv')
+    os.remove(tmp_path / mock_user_id / 'gps' / '2018-06-16 05_00_00.csv')
+    # the server has no data for the deleted hours anymore
+    empty = io.BytesIO()
+    with zipfile.ZipFile(empty, 'w') as zf:
+        zf.writestr('registry', '{"a": "b"}')
+
+    def fill(**kwargs):
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as rsps:
+            rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=empty.getvalue(), status=200)
+            mano.sync.gapfill(keyring, 'STUDY_ID', mock_user_id, str(tmp_path), data_streams=['gps'], **kwargs)
+            return [urllib.parse.parse_qs(call.request.body) for call in rsps.calls]
+
+    # only the span of saved data is checked (not since BACKFILL_START_DATE), in one request
+    bodies = fill(rebuild=True)
+    assert [(body['time_start'], body['time_end']) for body in bodies] == [
+        (['2018-06-15T18:00:00'], ['2018-06-16T06:00:00'])]
+    checked = mano.coverage.load_checked(str(tmp_path), mock_user_id)
+    assert checked.covered('gps', datetime(2018, 6, 15, 18))
+    assert not checked.covered('gps', datetime(2018, 6, 15, 19))
+
+    assert fill() == []
+    assert len(fill(recheck=True)) == 1
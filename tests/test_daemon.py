@@ -0,0 +1,111 @@
+"""
+Tests for the continuous sync daemon
+"""
+import json
+import urllib.parse
+
+import responses
+
+import mano.daemon
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_scheduler_active_and_dormant():
+    clock = Clock()
+    scheduler = mano.daemon.Scheduler(active='1h', dormant='1d', activity='3d', clock=clock)
+    active = mano.daemon.Task('STUDY', 'active', 'gps', '/tmp', last_poll=clock.now, last_data=clock.now)
+    dormant = mano.daemon.Task('STUDY', 'dormant', 'gps', '/tmp', last_poll=clock.now,
+                               last_data=clock.now - 10 * 86400)
+    new = mano.daemon.Task('STUDY', 'new', 'gps', '/tmp')
+    for task in (dormant, active, new):
+        scheduler.add(task)
+
+    # new tasks are due immediately, then active ones, then dormant ones
+    assert scheduler.pop() == (clock.now, new)
+    assert scheduler.pop() == (clock.now + 3600, active)
+    assert scheduler.pop() == (clock.now + 86400, dormant)
+    assert scheduler.peek() is None
+
+
+def test_scheduler_staleness_breaks_ties():
+    clock = Clock()
+    scheduler = mano.daemon.Scheduler(clock=clock)
+    fresh = mano.daemon.Task('STUDY', 'fresh', 'gps', '/tmp', last_poll=clock.now - 10)
+    stale = mano.daemon.Task('STUDY', 'stale', 'gps', '/tmp', last_poll=clock.now - 100)
+    scheduler.reschedule(fresh, caught_up=False)
+    scheduler.reschedule(stale, caught_up=False)
+    assert scheduler.pop()[1] is stale
+
+
+def test_daemon_runs_tasks(keyring, mock_zip_data, mock_studies_response, tmp_path):
+    clock = Clock()
+    daemon = mano.daemon.Daemon(keyring, str(tmp_path), study_ids=['123lrVdb0g6tf3PeJr5ZtZC8'],
+                                data_streams=['gps'], start_date='2018-06-15T00:00:00', clock=clock)
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-studies/v1', body=mock_studies_response)
+        rsps.add(responses.POST, keyring['URL'] + '/get-users/v1', body='["6y6s1w4g"]')
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        daemon.run(max_tasks=1)
+
+    task = daemon.scheduler.tasks['123lrVdb0g6tf3PeJr5ZtZC8/6y6s1w4g/gps']
+    assert task.frontier == '2018-06-20T00:00:00'
+    assert task.last_data == clock.now
+    assert (tmp_path / 'Project A' / '6y6s1w4g' / 'gps' / '2018-06-15 16_00_00.csv').exists()
+    # not caught up yet, so the task is due again right away
+    assert daemon.scheduler.peek() == clock.now
+
+    # state survives a restart
+    restarted = mano.daemon.Daemon(keyring, str(tmp_path), clock=clock)
+    assert restarted._state[task.key]['frontier'] == '2018-06-20T00:00:00'
+
+
+def test_scheduler_remove():
+    clock = Clock()
+    scheduler = mano.daemon.Scheduler(clock=clock)
+    kept = mano.daemon.Task('STUDY', 'kept', 'gps', '/tmp', last_poll=clock.now - 10)
+    removed = mano.daemon.Task('STUDY', 'removed', 'gps', '/tmp', last_poll=clock.now - 100)
+    scheduler.add(kept)
+    scheduler.add(removed)
+    assert scheduler.remove(removed.key) is removed
+    assert len(scheduler) == 1
+    assert scheduler.pop()[1] is kept
+    assert scheduler.peek() is None
+    # a task removed while it runs is not put back
+    scheduler.reschedule(removed)
+    assert scheduler.peek() is None
+
+
+def test_daemon_sends_registry_of_window(keyring, mock_zip_data, mock_studies_response, tmp_path):
+    clock = Clock()
+    user_dir = tmp_path / 'Project A' / '6y6s1w4g'
+    user_dir.mkdir(parents=True)
+    prefix = 'CHUNKED_DATA/123lrVdb0g6tf3PeJr5ZtZC8/6y6s1w4g'
+    (user_dir / '.registry').write_text(json.dumps({
+        f'{prefix}/gps/2018-06-15T16:00:00.csv': 'a',
+        f'{prefix}/gps/2018-07-15T16:00:00.csv': 'b',
+        f'{prefix}/accelerometer/2018-06-15T16:00:00.csv': 'c',
+    }))
+    daemon = mano.daemon.Daemon(keyring, str(tmp_path), study_ids=['123lrVdb0g6tf3PeJr5ZtZC8'],
+                                data_streams=['gps'], start_date='2018-06-15T00:00:00', clock=clock)
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-studies/v1', body=mock_studies_response)
+        rsps.add(responses.POST, keyring['URL'] + '/get-users/v1', body='["6y6s1w4g"]')
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        daemon.run(max_tasks=1)
+        body = urllib.parse.parse_qs(rsps.calls[-1].request.body)
+    assert json.loads(body['registry'][0]) == {f'{prefix}/gps/2018-06-15T16:00:00.csv': 'a'}
+
+    # users that are gone from the server are no longer synced
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-studies/v1', body=mock_studies_response)
+        rsps.add(responses.POST, keyring['URL'] + '/get-users/v1', body='[]')
+        daemon.discover()
+    assert len(daemon.scheduler) == 0
+    assert daemon.scheduler.peek() is None
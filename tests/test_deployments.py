@@ -0,0 +1,80 @@
+"""
+Tests for syncing several deployments at the same time
+"""
+import io
+import json
+import os
+import time
+
+import cryptease as crypt
+import pytest
+import responses
+
+import mano
+import mano.deployments
+import mano.sync
+from mano.ratelimit import RateLimitError, TokenBucket
+
+
+@pytest.fixture
+def keyrings(keyring):
+    return {
+        'beiwe.a': keyring,
+        'beiwe.b': {**keyring, 'URL': 'https://other.beiwe.org'},
+    }
+
+
+def test_keyrings_decrypted_once(keyrings, tmp_path):
+    keyring_file = tmp_path / 'keyring.enc'
+    key = crypt.kdf('secret')
+    with open(keyring_file, 'wb') as fo:
+        for chunk in crypt.encrypt(io.BytesIO(json.dumps(keyrings).encode()), key):
+            fo.write(chunk)
+    assert mano.keyrings(str(keyring_file), passphrase='secret') == keyrings
+    assert mano.keyring('beiwe.b', keyring_file=str(keyring_file), passphrase='secret') == keyrings['beiwe.b']
+
+
+def test_sync_deployments(keyrings, mock_zip_data, mock_user_id, tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 10000)
+    monkeypatch.setattr(mano.sync.time, 'sleep', lambda seconds: None)
+    report_file = tmp_path / 'report.json'
+    with responses.RequestsMock() as rsps:
+        url = keyrings['beiwe.a']['URL']
+        rsps.add(responses.POST, url + '/get-studies/v1', body='{"STUDY_A": "Study A"}')
+        rsps.add(responses.POST, url + '/get-users/v1', body=json.dumps([mock_user_id]))
+        rsps.add(responses.POST, url + '/get-data/v1', body=mock_zip_data)
+        # the other deployment is down
+        rsps.add(responses.POST, keyrings['beiwe.b']['URL'] + '/get-studies/v1', status=503)
+        report = mano.deployments.sync_deployments(keyrings, str(tmp_path / 'output'), workers=2, rate=100,
+                                                   report_file=str(report_file), profile=str(tmp_path / 'profile'))
+
+    assert not report['ok']
+    a, b = report['deployments']
+    assert (a['deployment'], a['studies'], a['users'], a['completed'], a['failed'], a['error']) == \
+        ('beiwe.a', 1, 1, 1, [], None)
+    assert a['requests'] == 3
+    assert b['deployment'] == 'beiwe.b'
+    assert 'APIError' in b['error']
+    assert len(os.listdir(tmp_path / 'output' / 'beiwe.a' / 'Study A' / mock_user_id / 'gps')) == 29
+    with open(report_file) as fo:
+        assert json.load(fo) == report
+    # each deployment is profiled into its own folder
+    assert os.listdir(tmp_path / 'profile' / 'beiwe.a')
+
+
+def test_unknown_deployment(keyrings, tmp_path):
+    with pytest.raises(mano.deployments.DeploymentError):
+        mano.deployments.sync_deployments(keyrings, str(tmp_path), deployments=['beiwe.c'])
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=100, capacity=1)
+    started = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - started >= 0.04
+    assert bucket.waited > 0
+    with pytest.raises(RateLimitError):
+        bucket.acquire(timeout=0)
+    with pytest.raises(RateLimitError):
+        TokenBucket(rate=0)
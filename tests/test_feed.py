@@ -0,0 +1,70 @@
+"""
+Tests for the change feed of saved files
+"""
+import pytest
+
+import mano.feed
+import mano.sync
+from mano.feed import Consumer, FeedError
+
+
+def test_save_appends_to_feed(keyring, mock_archive, mock_user_id, tmp_path):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), lock=['identifiers'], passphrase='secret')
+    records = list(mano.feed.read(str(tmp_path)))
+    assert [record['offset'] for record in records] == list(range(30))
+    assert mano.feed.head(str(tmp_path)) == 30
+
+    gps = [record for record in records if record['data_stream'] == 'gps']
+    assert len(gps) == 29
+    saved, = [record for record in gps if record['target'] == f'{mock_user_id}/gps/2018-06-16 11_00_00.csv']
+    assert saved['user_id'] == mock_user_id
+    assert saved['timestamp'] == '2018-06-16T11:00:00'
+    assert not saved['locked']
+    assert saved['size'] == (tmp_path / saved['target']).stat().st_size
+    identifiers, = [record for record in records if record['data_stream'] == 'identifiers']
+    assert identifiers['locked']
+
+
+def test_consumer_cursor(tmp_path):
+    output_dir = str(tmp_path)
+    mano.feed.append(output_dir, [{'target': f'u/gps/{i}'} for i in range(5)])
+    consumer = Consumer(output_dir, 'pipeline')
+    assert [record['offset'] for record in consumer.poll(limit=3)] == [0, 1, 2]
+    consumer.commit(2)
+    assert consumer.lag() == 2
+
+    # a restarted consumer continues after its last commit
+    mano.feed.append(output_dir, [{'target': 'u/gps/5'}])
+    consumer = Consumer(output_dir, 'pipeline')
+    assert [record['offset'] for record in consumer.poll()] == [3, 4, 5]
+    assert Consumer(output_dir, 'other').lag() == 6
+    with pytest.raises(FeedError):
+        Consumer(output_dir, '../escape')
+
+
+def test_segments_rotate_and_prune(tmp_path):
+    output_dir = str(tmp_path)
+    mano.feed.append(output_dir, [{'target': f'u/gps/{i}'} for i in range(5)], segment_records=2)
+    mano.feed.append(output_dir, [{'target': 'u/gps/5'}], segment_records=2)
+    assert [first for first, _ in mano.feed.segments(output_dir)] == [0, 2, 4]
+    assert [record['offset'] for record in mano.feed.read(output_dir, 3)] == [3, 4, 5]
+
+    consumer = Consumer(output_dir, 'pipeline')
+    consumer.commit(2)
+    # the first segment was read, the second is still being read
+    assert mano.feed.prune(output_dir) == 1
+    assert mano.feed.first(output_dir) == 2
+    assert [record['offset'] for record in consumer.poll()] == [3, 4, 5]
+    with pytest.raises(FeedError):
+        list(mano.feed.read(output_dir, 0))
+
+
+def test_torn_record_is_dropped(tmp_path):
+    output_dir = str(tmp_path)
+    mano.feed.append(output_dir, [{'target': 'u/gps/0'}, {'target': 'u/gps/1'}])
+    _, segment = mano.feed.segments(output_dir)[-1]
+    with open(segment, 'a') as fo:
+        fo.write('{"offset": 2, "tar')
+    assert mano.feed.head(output_dir) == 2
+    mano.feed.append(output_dir, [{'target': 'u/gps/2'}])
+    assert [record['target'] for record in mano.feed.read(output_dir)] == ['u/gps/0', 'u/gps/1', 'u/gps/2']
@@ -0,0 +1,30 @@
+"""
+Tests for the shared file writing helpers
+"""
+import os
+
+import pytest
+
+import mano.sync
+from mano.fileio import WriteError, atomic_write, atomic_writer
+
+
+def test_atomic_write(tmp_path):
+    filename = str(tmp_path / 'file')
+    atomic_write(filename, b'one')
+    atomic_write(filename, b'two', permissions=0o0600)
+    assert open(filename, 'rb').read() == b'two'
+    assert os.stat(filename).st_mode & 0o777 == 0o0600
+    # mano.sync raised this error before the helpers moved
+    with pytest.raises(mano.sync.WriteError):
+        atomic_write(filename, b'three', overwrite=False)
+    assert WriteError is mano.sync.WriteError
+
+
+def test_atomic_writer_cleans_up(tmp_path):
+    filename = str(tmp_path / 'file')
+    with pytest.raises(RuntimeError):
+        with atomic_writer(filename) as fo:
+            fo.write(b'partial')
+            raise RuntimeError('failed')
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,94 @@
+"""
+Tests for verifying saved files against the manifest and registry
+"""
+import json
+import os
+
+import pytest
+
+import mano.coverage
+import mano.fsck
+import mano.manifest
+import mano.sync
+import mano.workqueue
+
+GPS_MEMBER = '6y6s1w4g/gps/2018-06-16 11_00_00.csv'
+
+
+@pytest.fixture
+def saved_dir(keyring, mock_archive, mock_user_id, tmp_path):
+    output_dir = tmp_path / 'output'
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(output_dir), compress={'gps': 'gzip'})
+    return output_dir
+
+
+def test_registry_member(mock_user_id):
+    key = f'CHUNKED_DATA/fiaKUCTtfqH5oQ4tz8V6LWiF/{mock_user_id}/gps/2018-06-16T11:00:00.csv'
+    assert mano.fsck.registry_member(key, mock_user_id) == GPS_MEMBER
+    assert mano.fsck.registry_member('CHUNKED_DATA/study/other/gps/2018-06-16T11:00:00.csv', mock_user_id) is None
+
+
+def test_manifest_records_saved_files(saved_dir, mock_user_id):
+    entries = mano.manifest.load(str(saved_dir), mock_user_id)
+    assert len(entries) == 30
+    entry = entries[GPS_MEMBER + '.gz']
+    assert entry['member'] == GPS_MEMBER
+    assert entry['size'] == os.path.getsize(saved_dir / (GPS_MEMBER + '.gz'))
+    assert entry['crc'] == mano.fsck.checksum(str(saved_dir / (GPS_MEMBER + '.gz')))
+
+
+def test_verify_clean(saved_dir):
+    report = mano.fsck.verify(str(saved_dir), workers=2, chunk_size=4)
+    assert report.ok
+    assert report.summary() == {'checked': 30, 'missing': 0, 'truncated': 0, 'corrupt': 0, 'extra': 0,
+                                'unverified': 0}
+
+
+def test_verify_problems(saved_dir, mock_user_id):
+    target = saved_dir / (GPS_MEMBER + '.gz')
+    content = target.read_bytes()
+    target.write_bytes(content[:10])
+    corrupt = saved_dir / '6y6s1w4g/gps/2018-06-16 12_00_00.csv.gz'
+    corrupt.write_bytes(bytes(b ^ 0xff for b in corrupt.read_bytes()))
+    os.remove(saved_dir / '6y6s1w4g/gps/2018-06-16 13_00_00.csv.gz')
+    (saved_dir / '6y6s1w4g/gps/stray.csv').write_bytes(b'stray')
+
+    report = mano.fsck.verify(str(saved_dir), workers=2)
+    assert not report.ok
+    assert report.problems['truncated'] == [GPS_MEMBER + '.gz']
+    assert report.problems['corrupt'] == ['6y6s1w4g/gps/2018-06-16 12_00_00.csv.gz']
+    assert report.problems['missing'] == ['6y6s1w4g/gps/2018-06-16 13_00_00.csv.gz']
+    assert report.problems['extra'] == ['6y6s1w4g/gps/stray.csv']
+
+
+def test_verify_without_manifest(saved_dir, mock_user_id):
+    os.remove(mano.manifest.manifest_file(str(saved_dir), mock_user_id))
+    os.remove(saved_dir / (GPS_MEMBER + '.gz'))
+    report = mano.fsck.verify(str(saved_dir), workers=1)
+    assert report.checked == 0
+    assert len(report.problems['unverified']) == 29
+    assert report.problems['missing'] == [GPS_MEMBER]
+
+
+def test_verify_repair(saved_dir, mock_user_id, tmp_path):
+    target = saved_dir / (GPS_MEMBER + '.gz')
+    target.write_bytes(target.read_bytes()[:10])
+    queue = mano.workqueue.open_queue(str(tmp_path / 'queue.db'))
+
+    report = mano.fsck.verify(str(saved_dir), workers=1, repair=True, queue=queue, study_id='study')
+    assert report.problems['truncated'] == [GPS_MEMBER + '.gz']
+    assert not target.exists()
+    with open(saved_dir / mock_user_id / '.registry') as fo:
+        registry = json.load(fo)
+    assert len(registry) == 29
+    assert not any(key.endswith('2018-06-16T11:00:00.csv') for key in registry)
+    cov = mano.coverage.load(str(saved_dir), mock_user_id)
+    assert cov.hours('gps') == 28
+    assert queue.counts()['pending'] == 1
+    item = queue.lease('test')
+    assert item is not None
+    assert (item.user_id, item.time_start, item.time_end, item.data_streams) == (
+        mock_user_id, '2018-06-16T00:00:00', '2018-06-17T00:00:00', ['gps'])
+
+    # the damaged file is no longer expected
+    assert mano.fsck.verify(str(saved_dir), workers=1).ok
@@ -0,0 +1,129 @@
+"""
+Tests for hedged data requests
+"""
+import threading
+import time
+
+import pytest
+import responses
+
+import mano.sync
+from mano.hedging import Hedger, HedgingError
+
+
+class FakeResponse:
+    def __init__(self, name):
+        self.name = name
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+def _sender(delays):
+    """
+    Send function whose n-th call takes delays[n] seconds
+    """
+    calls = []
+    lock = threading.Lock()
+
+    def send():
+        with lock:
+            n = len(calls)
+            calls.append(n)
+        time.sleep(delays[n])
+        return FakeResponse(n)
+    return send, calls
+
+
+def test_delay_percentile():
+    hedger = Hedger(percentile=90, min_samples=5, min_delay=0)
+    hedger.latencies.extend([1.0, 2.0, 3.0, 4.0])
+    assert hedger.delay() is None
+    hedger.latencies.extend(float(n) for n in range(5, 11))
+    assert hedger.delay() == 9.0
+    assert Hedger(min_samples=1, min_delay=30).delay() is None
+    with pytest.raises(HedgingError):
+        Hedger(percentile=100)
+
+
+def test_hedge_wins_and_loser_is_closed():
+    hedger = Hedger(min_samples=1, min_delay=0.05, max_ratio=1)
+    hedger.latencies.append(0.01)
+    send, calls = _sender([1.0, 0.0])
+    response = hedger.request(send)
+    assert response.name == 1
+    assert calls == [0, 1]
+    metrics = hedger.metrics()
+    assert (metrics['requests'], metrics['hedged'], metrics['hedge_won'], metrics['capped']) == (1, 1, 1, 0)
+    hedger.close()
+
+
+def test_hedges_are_capped():
+    hedger = Hedger(min_samples=1, min_delay=0.01, max_ratio=0)
+    hedger.latencies.append(0.01)
+    send, calls = _sender([0.2])
+    assert hedger.request(send).name == 0
+    assert calls == [0]
+    assert (hedger.hedged, hedger.capped) == (0, 1)
+    hedger.close()
+
+
+def test_delay_starts_when_request_is_sent():
+    hedger = Hedger(min_samples=1, min_delay=0.1, max_ratio=1, max_workers=1)
+    hedger.latencies.append(0.01)
+    # a busy pool holds the request back longer than the delay
+    hedger._pool.submit(time.sleep, 0.3)
+    send, calls = _sender([0.05])
+    assert hedger.request(send).name == 0
+    assert calls == [0]
+    assert hedger.hedged == 0
+    hedger.close()
+
+
+def test_queued_loser_is_cancelled():
+    hedger = Hedger(min_samples=1, min_delay=0.05, max_ratio=1, max_workers=2)
+    hedger.latencies.append(0.01)
+    calls = []
+    blocked = [hedger._pool.submit(time.sleep, 0.5)]
+
+    def send():
+        calls.append(len(calls))
+        # keep the pool busy once the primary is done, so the hedge waits for a worker
+        blocked.append(hedger._pool.submit(time.sleep, 0.5))
+        time.sleep(0.2)
+        return FakeResponse(len(calls) - 1)
+
+    assert hedger.request(send).name == 0
+    assert hedger.hedged == 1
+    for future in blocked:
+        future.result()
+    time.sleep(0.05)
+    assert calls == [0]
+    hedger.close()
+
+
+def test_download_hedged(keyring, mock_zip_data):
+    calls = []
+
+    def callback(request):
+        calls.append(request)
+        # the first request stalls
+        if len(calls) == 1:
+            time.sleep(1.0)
+        return 200, {}, mock_zip_data
+
+    hedger = Hedger(min_samples=1, min_delay=0.1, max_ratio=1)
+    hedger.latencies.append(0.01)
+    with responses.RequestsMock() as rsps:
+        rsps.add_callback(responses.POST, keyring['URL'] + '/get-data/v1', callback=callback)
+        started = time.monotonic()
+        archive = mano.sync.download(keyring, 'STUDY_ID', ['USER_ID'], time_start='2018-06-15T00:00:00',
+                                     time_end='2018-06-17T00:00:00', hedge=hedger)
+        assert time.monotonic() - started < 1.0
+        assert archive is not None
+        # let the stalled request finish before the mock goes away
+        time.sleep(1.0)
+    assert len(calls) == 2
+    assert hedger.metrics()['hedge_won'] == 1
+    hedger.close()
@@ -0,0 +1,138 @@
+"""
+Tests for file locking and concurrent writers on the same participant directory
+"""
+import json
+import multiprocessing
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import mano
+import mano.locking
+import mano.sync
+
+
+def _hold_lock(path, acquired, release):
+    with mano.locking.FileLock(path):
+        acquired.set()
+        release.wait(10)
+
+
+def test_file_lock_excludes_other_processes(tmp_path):
+    path = str(tmp_path / 'lock')
+    acquired, release = multiprocessing.Event(), multiprocessing.Event()
+    process = multiprocessing.Process(target=_hold_lock, args=(path, acquired, release))
+    process.start()
+    try:
+        assert acquired.wait(10)
+        lock = mano.locking.FileLock(path, timeout=0.1)
+        assert not lock.acquire()
+    finally:
+        release.set()
+        process.join()
+    with mano.locking.FileLock(path, timeout=5):
+        pass
+
+
+def test_file_lock_excludes_other_threads(tmp_path):
+    path = str(tmp_path / 'lock')
+    counter = {'value': 0}
+
+    def increment():
+        for _ in range(50):
+            with mano.locking.FileLock(path):
+                value = counter['value']
+                time.sleep(0)
+                counter['value'] = value + 1
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter['value'] == 200
+
+
+def test_claims_hand_out_different_windows(tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 1)
+    user_dir = str(tmp_path)
+    start_date = '2018-06-15T00:00:00'
+
+    first = mano.sync._claim_window(user_dir, start_date)
+    second = mano.sync._claim_window(user_dir, start_date)
+    assert first[0] == '2018-06-15T00:00:00'
+    assert second[0] == '2018-06-16T00:00:00'
+
+    # finishing the second window first does not move the resume point past the first
+    mano.sync._finish_window(user_dir, second[0], start_date, second[2])
+    assert mano.sync._read_checkpoint(user_dir, start_date) == start_date
+    mano.sync._finish_window(user_dir, first[0], start_date, first[2])
+    assert mano.sync._read_checkpoint(user_dir, start_date) == '2018-06-17T00:00:00'
+
+    # a released window is handed out again
+    third = mano.sync._claim_window(user_dir, start_date)
+    mano.sync._release_window(user_dir, third[0])
+    assert mano.sync._claim_window(user_dir, start_date) == third
+
+
+def test_checkpoint_advances_from_any_start_date_format(tmp_path):
+    user_dir = str(tmp_path)
+    # e.g. BACKFILL_START_DATE, which is not zero-padded
+    start_date = '2018-6-1T00:00:00'
+    window = mano.sync._claim_window(user_dir, start_date)
+    mano.sync._finish_window(user_dir, window[0], start_date, window[2])
+    assert mano.sync._read_checkpoint(user_dir, start_date) == '2018-06-06T00:00:00'
+    # the user lock is not mistaken for a locked data stream file
+    assert os.path.exists(os.path.join(user_dir, '.mano-lock'))
+    assert not os.path.exists(os.path.join(user_dir, mano.sync.LOCK_EXT))
+
+
+def test_last_window_finishes_where_it_was_claimed(tmp_path, monkeypatch):
+    user_dir = str(tmp_path)
+    start_date = (datetime.today() - timedelta(days=2)).strftime(mano.TIME_FORMAT)
+    window = mano.sync._claim_window(user_dir, start_date)
+    assert window[2] is None
+
+    # the window takes so long that a window from its start would not reach the present any more
+    later = datetime.today() + timedelta(days=10)
+    monkeypatch.setattr(mano.sync, 'datetime', type('datetime', (datetime,), {'today': staticmethod(lambda: later)}))
+    mano.sync._finish_window(user_dir, window[0], start_date, window[2])
+    assert mano.sync._read_checkpoint(user_dir, start_date) == 'COMPLETE'
+
+
+def test_stale_claims_are_reclaimed(tmp_path, monkeypatch):
+    user_dir = str(tmp_path)
+    start_date = '2018-06-15T00:00:00'
+    window = mano.sync._claim_window(user_dir, start_date)
+    claim_file = mano.sync._claim_file(user_dir, window[0], '.claim')
+    with open(claim_file) as fo:
+        claim = json.load(fo)
+    claim['time'] -= mano.sync.CLAIM_TIMEOUT + 1
+    with open(claim_file, 'w') as fo:
+        json.dump(claim, fo)
+    assert mano.sync._claim_window(user_dir, start_date) == window
+
+
+def test_concurrent_saves_keep_registry_entries(keyring, mock_zip_data, mock_user_id, tmp_path):
+    import io
+    import zipfile
+
+    source = zipfile.ZipFile(io.BytesIO(mock_zip_data))
+    registry = json.loads(source.read('registry'))
+    # split the archive into one archive per registry entry
+    archives = []
+    for key, value in registry.items():
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            zf.writestr('registry', json.dumps({key: value}))
+        archives.append(zipfile.ZipFile(buf))
+
+    threads = [threading.Thread(target=mano.sync.save, args=(keyring, archive, mock_user_id, str(tmp_path)))
+               for archive in archives]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(os.path.join(tmp_path, mock_user_id, '.registry')) as fo:
+        assert json.load(fo) == registry
@@ -0,0 +1,95 @@
+"""
+Tests for the process-wide memory budget
+"""
+import gc
+import threading
+
+import pytest
+
+import mano.memory
+import mano.sync
+from mano.memory import MemoryBudget, MemoryBudgetError, SpillBuffer
+from mano.pipeline import Pipeline
+
+
+def test_buffer_spills_when_budget_is_exhausted():
+    budget = MemoryBudget(100)
+    buffer = SpillBuffer(budget)
+    buffer.write(b'a' * 60)
+    assert budget.reserved == 60
+    assert not buffer.spilled
+    buffer.write(b'b' * 60)
+    assert buffer.spilled
+    assert budget.reserved == 0
+    buffer.seek(0)
+    assert buffer.read() == b'a' * 60 + b'b' * 60
+    assert budget.metrics()['spills'] == 1
+    assert budget.metrics()['spilled_bytes'] == 60
+    buffer.close()
+    assert budget.reserved == 0
+
+
+def test_reserve_spills_buffers_and_blocks():
+    budget = MemoryBudget(100)
+    buffer = SpillBuffer(budget)
+    buffer.write(b'a' * 80)
+    # the buffer moves to disk to make room
+    reserved = budget.reserve(50)
+    assert buffer.spilled
+    assert budget.reserved == 50
+
+    done = threading.Event()
+    thread = threading.Thread(target=lambda: (budget.reserve(70), done.set()))
+    thread.start()
+    assert not done.wait(0.2)
+    assert budget.metrics()['waiting'] == 1
+    budget.release(reserved)
+    assert done.wait(5)
+    thread.join()
+    assert budget.reserved == 70
+    assert budget.waits == 1
+    with pytest.raises(MemoryBudgetError):
+        budget.reserve(70, timeout=0.1)
+    # larger than the whole budget, takes all of it once everything else is released
+    budget.release(70)
+    assert budget.reserve(1000) == 100
+
+
+def test_download_within_budget(keyring, mock_download_api, mock_archive, mock_user_id):
+    budget = MemoryBudget(4096)
+    archive = mano.sync.download(keyring, 'STUDY_ID', [mock_user_id], budget=budget)
+    assert budget.spills == 1
+    assert budget.peak <= 4096
+    assert archive.namelist() == mock_archive.namelist()
+    assert archive.read('registry') == mock_archive.read('registry')
+    del archive
+    gc.collect()
+    assert budget.reserved == 0
+
+
+def test_save_with_hooks_within_budget(keyring, mock_archive, mock_user_id, tmp_path):
+    budget = MemoryBudget(16 * 1024)
+    release = threading.Event()
+    with Pipeline(max_workers=2, max_pending=16) as pipeline:
+        pipeline.register('gps', lambda context, content: release.wait(5))
+        thread = threading.Thread(target=mano.sync.save, args=(keyring, mock_archive, mock_user_id, str(tmp_path)),
+                                  kwargs={'pipeline': pipeline, 'budget': budget, 'compress': {'gps': 'gzip'}})
+        thread.start()
+        # save waits for the hooks to release member content before reading more
+        thread.join(0.5)
+        assert thread.is_alive()
+        assert budget.waits >= 1
+        release.set()
+        thread.join(5)
+    assert not pipeline.failures()
+    assert len(pipeline.results) == 29
+    assert budget.reserved == 0
+    assert budget.peak <= 16 * 1024
+
+
+def test_parse_size():
+    assert mano.memory.parse_size('512') == 512
+    assert mano.memory.parse_size('2K') == 2048
+    assert mano.memory.parse_size('1.5GiB') == 3 * 1024 ** 3 // 2
+    with pytest.raises(MemoryBudgetError):
+        mano.memory.parse_size('lots')
@@ -1,8 +1,11 @@
+import json
 import os
 
+import pytest
 import responses
 
 import mano
+from mano.mano import _JSONStream
 
 DIR = os.path.dirname(__file__)
 
@@ -22,6 +25,30 @@ def test_users(keyring, mock_users_response):
     assert users == expected_users
 
 
+def test_json_stream_split_chunks():
+    body = '{"a": 1234, "b": ["x", {"y": null}], "\u00e9t\u00e9": "caf\u00e9", "c": -1.5e3}'.encode()
+    expected = list(json.loads(body).items())
+    # every possible split point, including inside numbers, strings and multibyte characters
+    for size in (1, 2, 3, 7, len(body)):
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        assert list(_JSONStream(chunks)) == expected
+    assert list(_JSONStream([b' [ ] '])) == []
+    assert list(_JSONStream([b'[1', b'2, 3', b']'])) == [12, 3]
+
+
+def test_json_stream_yields_before_end():
+    def chunks():
+        yield b'["tgsidhm", '
+        raise AssertionError('read past the first item')
+    assert next(iter(_JSONStream(chunks()))) == 'tgsidhm'
+
+
+@pytest.mark.parametrize('body', [b'', b'"users"', b'["a" "b"]', b'{"a" 1}', b'["a", '])
+def test_json_stream_invalid(body):
+    with pytest.raises(json.JSONDecodeError):
+        list(_JSONStream([body]))
+
+
 def test_device_settings():
     # The device_settings function is implemented by programmatically logging
     # into the Beiwe frontend (which any user can do) and scraping the Study
@@ -0,0 +1,120 @@
+"""
+Tests for per-file post-processing hooks
+"""
+import os
+import threading
+import zlib
+
+import pytest
+import responses
+
+import mano.coverage
+import mano.sync
+from mano.pipeline import HookContext, Pipeline, PipelineError
+
+
+def test_hooks_run_per_data_stream(keyring, mock_archive, mock_user_id, tmp_path):
+    checksums = {}
+    targets = []
+
+    def crc(context, stream):
+        checksums[context.member] = zlib.crc32(stream.read())
+        return checksums[context.member]
+
+    with Pipeline(max_workers=2, max_pending=2) as pipeline:
+        pipeline.register('gps', crc)
+        pipeline.register('*', lambda context, content: targets.append(context.target))
+        num_saved = mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), compress={'gps': 'gzip'},
+                                   pipeline=pipeline)
+    assert num_saved == 30
+    assert len(targets) == 30
+    assert all(target.endswith('.gz') for target in targets if '/gps/' in target)
+    assert len(checksums) == 29
+    for member, value in checksums.items():
+        assert value == mock_archive.getinfo(member).CRC
+    assert len(pipeline.results) == 59
+    assert not pipeline.failures()
+
+
+def test_hooks_stream_each_member_once(keyring, mock_archive, mock_user_id, tmp_path, monkeypatch):
+    opened = []
+    open_member = mock_archive.open
+    monkeypatch.setattr(mock_archive, 'open', lambda name, *args, **kwargs: opened.append(
+        getattr(name, 'filename', name)) or open_member(name, *args, **kwargs))
+    contents = {}
+    with Pipeline() as pipeline:
+        pipeline.register('*', lambda context, stream: contents.setdefault(context.member, stream.read()))
+        mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), lock=['gps'], passphrase='secret',
+                       pipeline=pipeline)
+    # locked files are encrypted from the content read for the hooks, plain files are read back
+    assert len(contents) == 30
+    for member, content in contents.items():
+        assert content == open_member(member).read()
+        assert opened.count(member) == 1
+
+
+def test_hooks_see_files_of_filled_gaps(keyring, mock_zip_data, mock_archive, mock_user_id, tmp_path):
+    output_dir = str(tmp_path)
+    mano.sync.save(keyring, mock_archive, mock_user_id, output_dir)
+    missing = f'{mock_user_id}/gps/2018-06-16 11_00_00.csv'
+    os.remove(tmp_path / missing)
+    mano.coverage.rebuild(output_dir, mock_user_id)
+    (tmp_path / mock_user_id / '.backfill').write_text('COMPLETE')
+
+    targets = []
+    with Pipeline() as pipeline:
+        pipeline.register('gps', lambda context, content: targets.append(context.target))
+        with responses.RequestsMock() as rsps:
+            rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+            mano.sync.backfill(keyring, 'STUDY_ID', mock_user_id, output_dir, start_date='2018-06-15T00:00:00',
+                               fill_gaps=True, pipeline=pipeline)
+    assert missing in targets
+    assert (tmp_path / missing).exists()
+
+
+def test_results_are_bounded():
+    with Pipeline(max_results=2) as pipeline:
+        pipeline.register('gps', lambda context, stream: len(stream.read()))
+        for i in range(3):
+            pipeline.submit(HookContext('u', 'gps', f'u/gps/{i}', f'u/gps/{i}', '.'), b'x' * i)
+    assert [result.value for result in pipeline.results] == [1, 2]
+    assert [result.value for result in pipeline.drain()] == [1, 2]
+    assert not pipeline.results
+
+
+def test_failures_are_reported_per_file(keyring, mock_archive, mock_user_id, tmp_path):
+    def fail_at_noon(context, content):
+        if '12_00_00' in context.member:
+            raise ValueError('bad file')
+
+    with Pipeline() as pipeline:
+        pipeline.register('gps', fail_at_noon)
+        num_saved = mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), pipeline=pipeline)
+    assert num_saved == 30
+    failures = pipeline.failures()
+    assert [(result.target, result.hook) for result in failures] == [
+        ('6y6s1w4g/gps/2018-06-16 12_00_00.csv', 'fail_at_noon')]
+    assert isinstance(failures[0].error, ValueError)
+
+
+def test_submit_blocks_when_workers_fall_behind():
+    release = threading.Event()
+    with Pipeline(max_workers=1, max_pending=1) as pipeline:
+        pipeline.register('gps', lambda context, content: release.wait(5))
+        context = HookContext('u', 'gps', 'u/gps/a.csv', 'u/gps/a.csv', '.')
+        pipeline.submit(context, b'')
+        submitted = threading.Event()
+        thread = threading.Thread(target=lambda: (pipeline.submit(context, b''), submitted.set()))
+        thread.start()
+        assert not submitted.wait(0.2)
+        release.set()
+        assert submitted.wait(5)
+        thread.join()
+    assert len(pipeline.results) == 2
+    # data streams without hooks are not queued at all
+    assert pipeline.submit(HookContext('u', 'accelerometer', 'a', 'a', '.'), b'') is None
+
+
+def test_invalid_max_pending():
+    with pytest.raises(PipelineError):
+        Pipeline(max_pending=0)
@@ -0,0 +1,88 @@
+"""
+Tests for the dry-run backfill planner and the statistics it is based on
+"""
+import json
+import os
+
+import pytest
+import responses
+
+import mano.planner
+import mano.stats
+import mano.sync
+
+STUDY_ID = '123lrVdb0g6tf3PeJr5ZtZC8'
+
+
+def test_latency_fit():
+    stats = {'requests': 3, 'samples': [[0, 2.0], [1000, 3.0], [2000, 4.0]], 'streams': {}}
+    overhead, per_byte = mano.stats.latency(stats)
+    assert overhead == pytest.approx(2.0)
+    assert per_byte == pytest.approx(0.001)
+    assert mano.stats.latency({'requests': 0, 'samples': [], 'streams': {}}) is None
+
+
+def test_pending_windows(tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 100)
+    user_dir = tmp_path / 'u'
+    windows = mano.planner.pending_windows(str(user_dir), '2018-01-01T00:00:00')
+    assert windows[0][:2] == ('2018-01-01T00:00:00', '2018-04-11T00:00:00')
+    assert windows[-1][2] is None
+    # a resume point, and a later window finished out of order
+    (user_dir / mano.sync.CLAIMS_DIR).mkdir(parents=True)
+    (user_dir / '.backfill').write_text('2018-04-11T00:00:00')
+    open(mano.sync._claim_file(str(user_dir), '2018-07-20T00:00:00', '.done'), 'w').close()
+    remaining = mano.planner.pending_windows(str(user_dir), '2018-01-01T00:00:00')
+    assert [window[0] for window in remaining[:2]] == ['2018-04-11T00:00:00', '2018-10-28T00:00:00']
+    assert len(remaining) == len(windows) - 2
+    # nothing was written
+    assert sorted(os.listdir(user_dir)) == ['.backfill', '.claims']
+    (user_dir / '.backfill').write_text('COMPLETE')
+    assert mano.planner.pending_windows(str(user_dir)) == []
+
+
+def test_plan_from_recorded_stats(keyring, mock_zip_data, mock_archive, mock_user_id, mock_studies_response,
+                                  tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 10000)
+    monkeypatch.setattr(mano.sync.time, 'sleep', lambda seconds: None)
+    output_dir = tmp_path / 'Project A'
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        mano.sync.backfill(keyring, STUDY_ID, mock_user_id, str(output_dir), start_date='2018-06-15T00:00:00')
+
+    stats = mano.stats.load(str(output_dir))
+    assert stats['requests'] == 1
+    gps_bytes = sum(info.compress_size for info in mock_archive.infolist() if '/gps/' in info.filename)
+    assert stats['streams']['gps']['bytes'] == gps_bytes
+    assert stats['streams']['accelerometer']['bytes'] == 0
+
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-studies/v1', body=mock_studies_response)
+        rsps.add(responses.POST, keyring['URL'] + '/get-users/v1', body=json.dumps([mock_user_id, 'newuser']))
+        plan = mano.planner.plan(keyring, str(tmp_path), study_ids=[STUDY_ID], start_date='2018-06-15T00:00:00',
+                                 concurrency=2)
+    done, new = plan.rows
+    assert (done['user_id'], done['status'], done['windows'], done['bytes']) == (mock_user_id, 'complete', 0, 0)
+    assert (new['user_id'], new['status'], new['windows']) == ('newuser', 'new', 1)
+    members = [info for info in mock_archive.infolist() if info.filename != 'registry' and not info.is_dir()]
+    member_bytes = sum(info.file_size for info in members)
+    assert new['bytes'] == pytest.approx(sum(info.compress_size for info in members), rel=0.01)
+    assert new['disk_bytes'] == pytest.approx(member_bytes, rel=0.01)
+    assert new['seconds'] == pytest.approx(stats['samples'][0][1], abs=0.2)
+
+    totals = plan.totals()
+    assert totals['requests'] == 1
+    assert totals['pending_users'] == 1
+    assert totals['wall_seconds'] == pytest.approx(totals['seconds'] / 2)
+    assert totals['unknown_data_streams'] == []
+    # only the study and user lists were requested
+    assert not os.path.exists(tmp_path / 'Project A' / 'newuser')
+
+    # a new user is estimated from the study's first data, not from years of windows before it
+    assert mano.planner.first_data(str(output_dir)).isoformat() == '2018-06-15T16:00:00'
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 100)
+    estimator = mano.planner.Estimator(str(output_dir))
+    early = mano.planner.plan_user(str(output_dir), 'newuser', estimator, '2015-10-01T00:00:00',
+                                   study_first_data=mano.planner.first_data(str(output_dir)))
+    assert early['windows'] > new['windows']
+    assert early['bytes'] == pytest.approx(new['bytes'], rel=0.01)
@@ -0,0 +1,74 @@
+"""
+Tests for profiling backfill windows and saves
+"""
+import glob
+import json
+import os
+
+import pytest
+import responses
+
+import mano.profiling
+import mano.sync
+from mano.profiling import Profiler, ProfilingError
+
+
+def _reports(profile_dir) -> list[dict]:
+    reports = []
+    for filename in sorted(glob.glob(os.path.join(profile_dir, '*.json'))):
+        with open(filename) as fo:
+            reports.append(json.load(fo))
+    return reports
+
+
+def test_backfill_window_profile(keyring, mock_zip_data, mock_user_id, tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 10000)
+    monkeypatch.setattr(mano.sync.time, 'sleep', lambda seconds: None)
+    profile_dir = tmp_path / 'profile'
+    profiler = Profiler(str(profile_dir), interval=0.001)
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        mano.sync.backfill(keyring, 'STUDY_ID', mock_user_id, str(tmp_path / 'output'),
+                           start_date='2018-06-15T00:00:00', profile=profiler)
+
+    # the save is part of the window's report
+    reports = _reports(profile_dir)
+    assert len(reports) == 1
+    report = reports[0]
+    assert report['window'] == f'backfill_{mock_user_id}_2018-06-15T00:00:00'
+    assert set(report['phases']) == {'request', 'buffer', 'unzip', 'write', 'registry'}
+    assert report['phases']['write']['calls'] == 30
+    assert report['top_allocations']
+    collapsed = glob.glob(str(profile_dir / '*.collapsed'))
+    assert len(collapsed) == 1
+    with open(collapsed[0]) as fo:
+        for line in fo:
+            stack, count = line.rsplit(' ', 1)
+            assert stack.startswith('phase:')
+            assert int(count) > 0
+
+
+def test_save_profile_with_cprofile(keyring, mock_archive, mock_user_id, tmp_path):
+    profile_dir = tmp_path / 'profile'
+    profiler = Profiler(str(profile_dir), mode='cprofile', memory=False)
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path / 'output'), lock=['gps'],
+                   passphrase='secret', profile=profiler)
+    report, = _reports(profile_dir)
+    assert report['phases']['encrypt']['calls'] == 29
+    assert report['phases']['write']['calls'] == 1
+    assert 'top_allocations' not in report
+    assert any('save' in entry['function'] for entry in report['top_functions'])
+    assert len(glob.glob(str(profile_dir / '*.pstats'))) == 1
+
+
+def test_profile_from_environment(keyring, mock_archive, mock_user_id, tmp_path, monkeypatch):
+    profile_dir = tmp_path / 'profile'
+    monkeypatch.setenv('MANO_PROFILE', str(profile_dir))
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path / 'output'))
+    report, = _reports(profile_dir)
+    assert report['window'] == f'save_{mock_user_id}'
+
+    monkeypatch.delenv('MANO_PROFILE')
+    assert mano.profiling.get() is None
+    with pytest.raises(ProfilingError):
+        Profiler(str(profile_dir), mode='perf')
@@ -0,0 +1,67 @@
+"""
+Tests for bandwidth shaping of downloads
+"""
+import time
+from datetime import datetime
+
+import pytest
+import responses
+
+import mano.ratelimit
+import mano.sync
+from mano.ratelimit import Bandwidth, RateLimitError, Schedule, Transfer
+
+
+def test_schedule():
+    schedule = Schedule.parse('22:00-06:00=unlimited,06:00-22:00=2M')
+    assert schedule.rate(datetime(2024, 1, 1, 23, 30)) is None
+    assert schedule.rate(datetime(2024, 1, 1, 3, 0)) is None
+    assert schedule.rate(datetime(2024, 1, 1, 6, 0)) == 2 * 1024 ** 2
+    assert schedule.rate(datetime(2024, 1, 1, 21, 59)) == 2 * 1024 ** 2
+    # a plain rate is the default outside of the rules
+    assert Schedule.parse('08:00-09:00=1K,512K').rate(datetime(2024, 1, 1, 12, 0)) == 512 * 1024
+    assert Schedule.parse(None).rate() is None
+    with pytest.raises(RateLimitError):
+        Schedule.parse('06:00-25:00=1M')
+    with pytest.raises(RateLimitError):
+        Schedule.parse('fast')
+
+
+def test_bandwidth_limits_throughput():
+    bandwidth = Bandwidth(per_download=20000)
+    chunks = [b'x' * 10000] * 5
+    transfer = Transfer()
+    started = time.monotonic()
+    assert b''.join(bandwidth.stream(chunks, transfer)) == b''.join(chunks)
+    elapsed = time.monotonic() - started
+    # the first 20000 bytes are a burst, the other 30000 take 1.5 seconds
+    assert elapsed == pytest.approx(1.5, abs=0.3)
+    assert transfer.bytes == 50000
+    assert transfer.target == 20000
+    assert transfer.achieved == pytest.approx(50000 / transfer.seconds)
+    metrics = bandwidth.metrics()
+    assert (metrics['bytes'], metrics['transfers'], metrics['target']) == (50000, 1, None)
+    assert metrics['waited'] == pytest.approx(1.5, abs=0.3)
+
+
+def test_bandwidth_shared_cap(monkeypatch):
+    waits = []
+    monkeypatch.setattr(mano.ratelimit.TokenBucket, 'acquire',
+                        lambda self, tokens=1, timeout=None: waits.append((self.rate, tokens)) or 0.0)
+    bandwidth = Bandwidth(rate=1000)
+    list(bandwidth.stream([b'x' * 2500]))
+    list(bandwidth.stream([b'x' * 100]))
+    # chunks larger than the bucket take its capacity at a time, from the same bucket
+    assert waits == [(1000, 1000), (1000, 1000), (1000, 500), (1000, 100)]
+
+
+def test_download_shaped(keyring, mock_zip_data, tmp_path):
+    bandwidth = Bandwidth(rate='100M')
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        archive = mano.sync.download(keyring, 'STUDY_ID', ['USER_ID'], time_start='2018-06-15T00:00:00',
+                                     time_end='2018-06-17T00:00:00', bandwidth=bandwidth)
+    assert archive is not None
+    metrics = bandwidth.metrics()
+    assert metrics['bytes'] == len(mock_zip_data)
+    assert metrics['target'] == 100 * 1024 ** 2
@@ -0,0 +1,94 @@
+"""
+Tests for recent-first backfills
+"""
+import json
+import os
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs
+
+import dateutil.parser
+import responses
+
+import mano
+import mano.planner
+import mano.sync
+
+
+def _windows(rsps) -> list[tuple[datetime, datetime]]:
+    windows = []
+    for call in rsps.calls:
+        body = parse_qs(call.request.body)
+        windows.append((dateutil.parser.parse(body['time_start'][0]), dateutil.parser.parse(body['time_end'][0])))
+    return windows
+
+
+def test_reverse_window():
+    floor = '2018-01-01T00:00:00'
+    assert mano.sync._reverse_window('2018-01-20T00:00:00', floor, 5) == \
+        ('2018-01-15T00:00:00', '2018-01-20T00:00:00', '2018-01-15T00:00:00')
+    assert mano.sync._reverse_window('2018-01-03T00:00:00', floor, 5) == \
+        ('2018-01-01T00:00:00', '2018-01-03T00:00:00', None)
+
+
+def test_recent_first_backfill(keyring, mock_zip_data, mock_user_id, tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 4)
+    monkeypatch.setattr(mano.sync.time, 'sleep', lambda seconds: None)
+    start_date = (datetime.today() - timedelta(days=10)).strftime(mano.TIME_FORMAT)
+    started = datetime.today().replace(microsecond=0)
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        mano.sync.backfill(keyring, 'STUDY_ID', mock_user_id, str(tmp_path), start_date=start_date,
+                           data_streams=['gps'], recent_first=True)
+        windows = _windows(rsps)
+
+    # newest window first, then back to the start date without gaps
+    assert len(windows) == 3
+    assert windows[0][1] >= started
+    assert windows[-1][0] == dateutil.parser.parse(start_date)
+    for newer, older in zip(windows, windows[1:]):
+        assert older[1] == newer[0]
+
+    user_dir = tmp_path / mock_user_id
+    state = json.loads((user_dir / mano.sync.REVERSE_CHECKPOINT).read_text())
+    assert state['backward'] == state['floor'] == start_date
+    # an ordinary backfill continues from the forward frontier
+    assert (user_dir / '.backfill').read_text() == state['forward']
+    assert not os.listdir(user_dir / mano.sync.CLAIMS_DIR)
+    assert mano.planner.pending_windows(str(user_dir)) == []
+
+
+def test_fresh_pulls_between_historical_windows(keyring, mock_zip_data, mock_user_id, tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 1)
+    monkeypatch.setattr(mano.sync.time, 'sleep', lambda seconds: None)
+    now = datetime.today().replace(microsecond=0)
+    user_dir = tmp_path / mock_user_id
+    user_dir.mkdir()
+    state = {
+        'floor': (now - timedelta(days=4)).strftime(mano.TIME_FORMAT),
+        'backward': (now - timedelta(days=2)).strftime(mano.TIME_FORMAT),
+        'forward': (now - timedelta(hours=3)).strftime(mano.TIME_FORMAT),
+    }
+    (user_dir / mano.sync.REVERSE_CHECKPOINT).write_text(json.dumps(state))
+    assert len(mano.planner.pending_windows(str(user_dir))) == 3
+
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        mano.sync.backfill(keyring, 'STUDY_ID', mock_user_id, str(tmp_path), data_streams=['gps'],
+                           recent_first=True)
+        windows = _windows(rsps)
+
+    # the new data since the forward frontier comes first, then the history newest first
+    assert windows[0][0] == now - timedelta(hours=3)
+    assert [window[1] for window in windows[1:]] == [now - timedelta(days=2), now - timedelta(days=3)]
+    state = json.loads((user_dir / mano.sync.REVERSE_CHECKPOINT).read_text())
+    assert state['backward'] == state['floor']
+    assert dateutil.parser.parse(state['forward']) >= now
+
+
+def test_recent_first_skips_complete_backfill(keyring, mock_user_id, tmp_path):
+    user_dir = tmp_path / mock_user_id
+    user_dir.mkdir()
+    (user_dir / '.backfill').write_text('COMPLETE')
+    with responses.RequestsMock():
+        mano.sync.backfill(keyring, 'STUDY_ID', mock_user_id, str(tmp_path), recent_first=True)
+    assert not (user_dir / mano.sync.REVERSE_CHECKPOINT).exists()
@@ -0,0 +1,106 @@
+"""
+Tests for salvaging intact members of damaged archives
+"""
+import io
+import json
+import os
+import zipfile
+
+import pytest
+import responses
+
+import mano.archive
+import mano.salvage
+import mano.sync
+
+
+class Unseekable(io.RawIOBase):
+    """
+    Write-only stream, which makes zipfile write data descriptors like a streaming server would
+    """
+
+    def __init__(self):
+        self.buf = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self.buf.write(b)
+
+
+def _truncated(tmp_path, content: bytes, size: int) -> str:
+    path = tmp_path / 'damaged.zip'
+    path.write_bytes(content[:size])
+    return str(path)
+
+
+def test_salvage_truncated(mock_zip_data, mock_archive, tmp_path):
+    path = _truncated(tmp_path, mock_zip_data, len(mock_zip_data) * 2 // 3)
+    with pytest.raises(zipfile.BadZipFile):
+        zipfile.ZipFile(path)
+    salvaged = mano.salvage.salvage(path)
+    names = salvaged.namelist()
+    assert 0 < len(names) < 30
+    assert 'registry' not in names
+    for name in names:
+        assert salvaged.read(name) == mock_archive.read(name)
+
+
+def test_salvage_skips_corrupt_member(mock_zip_data, mock_archive, tmp_path):
+    info = mock_archive.infolist()[5]
+    content = bytearray(mock_zip_data)
+    # damage the compressed data of one member, and lose the central directory
+    offset = info.header_offset + mano.salvage.LOCAL_HEADER.size + len(info.filename) + 100
+    content[offset] ^= 0xff
+    path = _truncated(tmp_path, bytes(content), mock_zip_data.find(b'PK\x01\x02'))
+
+    salvaged = mano.salvage.salvage(path)
+    names = salvaged.namelist()
+    assert info.filename not in names
+    # every other file member survived, along with the registry entries for them
+    assert len(names) == 30
+    registry = json.loads(salvaged.read('registry'))
+    assert len(registry) == 29
+    assert mano.archive.normalize(info.filename) not in {
+        mano.archive.normalize('/'.join(key.split('/')[2:])) for key in registry}
+
+
+def test_salvage_data_descriptors(tmp_path):
+    stream = Unseekable()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('u/gps/2018-06-15 16_00_00.csv', b'a,b\n' * 1000)
+        archive.writestr('u/gps/2018-06-15 17_00_00.csv', b'c,d\n' * 1000)
+    content = stream.buf.getvalue()
+    path = _truncated(tmp_path, content, content.find(b'PK\x01\x02'))
+
+    with open(path, 'rb') as fo:
+        members = list(mano.salvage.scan(fo.read()))
+    assert [member.filename for member in members] == ['u/gps/2018-06-15 16_00_00.csv',
+                                                       'u/gps/2018-06-15 17_00_00.csv']
+    assert members[1].content == b'c,d\n' * 1000
+
+
+def test_backfill_salvages_and_requests_the_rest(keyring, mock_zip_data, mock_archive, mock_user_id, tmp_path,
+                                                 monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mano.sync, 'BACKFILL_WINDOW', 10000)
+    monkeypatch.setattr(mano.sync.time, 'sleep', lambda seconds: None)
+    output_dir = tmp_path / 'output'
+    url = keyring['URL'] + '/get-data/v1'
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, url, body=mock_zip_data[:len(mock_zip_data) // 2])
+        rsps.add(responses.POST, url, body=mock_zip_data)
+        mano.sync.backfill(keyring, 'STUDY_ID', mock_user_id, str(output_dir), start_date='2018-06-15T00:00:00',
+                           data_streams=['gps'], salvage=True)
+        # the retry only asked for hours that were not salvaged
+        retry = dict(pair.split('=', 1) for pair in rsps.calls[1].request.body.split('&'))
+        assert retry['time_start'] > '2018-06-15T00'
+    # the damaged download is not left behind
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.zip')]
+
+    gps = os.listdir(output_dir / mock_user_id / 'gps')
+    assert len(gps) == 29
+    for filename in gps:
+        member = f'{mock_user_id}/gps/{filename}'
+        assert (output_dir / member).read_bytes() == mock_archive.read(member)
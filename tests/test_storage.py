@@ -0,0 +1,178 @@
+"""
+Tests for mano.storage backends
+"""
+import filecmp
+import json
+import os
+import threading
+import zlib
+
+import pytest
+
+import mano.storage
+import mano.sync
+
+
+GPS_MEMBER = '6y6s1w4g/gps/2018-06-16 11_00_00.csv'
+
+
+def test_directory_storage_names(keyring, mock_archive, mock_user_id, tmp_path):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path))
+    storage = mano.storage.DirectoryStorage(str(tmp_path))
+    names = list(storage.names(f'{mock_user_id}/gps/'))
+    assert len(names) == 29
+    # hidden state files e.g., .registry are not targets
+    assert len(list(storage.names())) == 30
+
+
+@pytest.mark.parametrize('period,expected', [('day', 3), ('month', 2)])
+def test_bundle_storage_save(keyring, mock_archive, mock_user_id, tmp_path, period, expected):
+    storage = mano.storage.BundleStorage(str(tmp_path / 'bundles'), period=period)
+    num_saved = mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), storage=storage)
+    assert num_saved == 30
+
+    # 2 days of gps and 1 of identifiers
+    bundles = [f for _, _, files in os.walk(tmp_path / 'bundles') for f in files if f.endswith('.bundle')]
+    assert len(bundles) == expected
+    # the registry is still kept in the output directory
+    assert os.path.exists(tmp_path / mock_user_id / '.registry')
+
+    assert len(list(storage.names())) == 30
+    assert storage.exists(GPS_MEMBER)
+    with mano.sync.open_saved(GPS_MEMBER, storage=storage) as fo:
+        assert fo.read() == mock_archive.read(GPS_MEMBER)
+
+    # a fresh instance reads the index from disk
+    storage = mano.storage.BundleStorage(str(tmp_path / 'bundles'), period=period)
+    with storage.open(GPS_MEMBER) as fo:
+        assert fo.read() == mock_archive.read(GPS_MEMBER)
+
+
+def test_bundle_storage_rewrite(tmp_path):
+    storage = mano.storage.BundleStorage(str(tmp_path))
+    for content in (b'first', b'second'):
+        with storage.writer(GPS_MEMBER) as fo:
+            fo.write(content)
+    assert list(storage.names()) == [GPS_MEMBER]
+    with storage.open(GPS_MEMBER) as fo:
+        assert fo.read() == b'second'
+
+
+def test_bundle_storage_sees_appends_of_other_writers(tmp_path):
+    reader = mano.storage.BundleStorage(str(tmp_path))
+    writer = mano.storage.BundleStorage(str(tmp_path))
+    with writer.writer(GPS_MEMBER) as fo:
+        fo.write(b'first')
+    assert list(reader.names()) == [GPS_MEMBER]
+    other = GPS_MEMBER.replace('11_00_00', '12_00_00')
+    for content in (b'second', b'third'):
+        with writer.writer(GPS_MEMBER) as fo:
+            fo.write(content)
+    with writer.writer(other) as fo:
+        fo.write(b'other')
+    # the reader picks up the new index entries without a reload
+    assert list(reader.names()) == [GPS_MEMBER, other]
+    with reader.open(GPS_MEMBER) as fo:
+        assert fo.read() == b'third'
+
+
+def test_bundle_storage_failed_write(tmp_path):
+    storage = mano.storage.BundleStorage(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        with storage.writer(GPS_MEMBER) as fo:
+            fo.write(b'partial')
+            raise RuntimeError()
+    assert not storage.exists(GPS_MEMBER)
+
+
+def test_bundle_storage_export(keyring, mock_archive, mock_user_id, tmp_path):
+    classic = tmp_path / 'classic'
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(classic))
+
+    storage = mano.storage.BundleStorage(str(tmp_path / 'bundles'))
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path / 'state'), storage=storage)
+    assert storage.export(str(tmp_path / 'exported')) == 30
+
+    names = list(mano.storage.DirectoryStorage(str(classic)).names())
+    assert list(mano.storage.DirectoryStorage(str(tmp_path / 'exported')).names()) == names
+    match, mismatch, errors = filecmp.cmpfiles(classic, tmp_path / 'exported', names, shallow=False)
+    assert len(match) == 30
+
+
+def test_dedup_storage_save(keyring, mock_archive, mock_user_id, tmp_path):
+    storage = mano.storage.DedupStorage(str(tmp_path))
+    assert mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), storage=storage) == 30
+    written = storage.written
+    blobs = [f for _, _, files in os.walk(tmp_path / '.blobs') for f in files if not f.startswith('.')]
+    assert len(blobs) == written
+    target = tmp_path / GPS_MEMBER
+    assert target.read_bytes() == mock_archive.read(GPS_MEMBER)
+    assert os.stat(target).st_nlink == 2
+
+    # saving the same content again only links the targets to the stored blobs
+    assert mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), storage=storage) == 30
+    assert storage.written == written
+    assert storage.deduplicated == 30 + (30 - written)
+    assert os.stat(target).st_nlink == 2
+    assert len(list(storage.names())) == 30
+    assert not [name for name in os.listdir(target.parent) if name.endswith('.link')]
+
+
+def test_dedup_storage_gc(tmp_path):
+    storage = mano.storage.DedupStorage(str(tmp_path))
+    for target, content in (('u/gps/a.csv', b'same'), ('u/gps/b.csv', b'same'), ('u/gps/c.csv', b'other')):
+        with storage.writer(target) as fo:
+            fo.write(content)
+    assert (storage.written, storage.deduplicated) == (2, 1)
+    os.remove(tmp_path / 'u' / 'gps' / 'c.csv')
+    os.remove(tmp_path / 'u' / 'gps' / 'a.csv')
+
+    assert storage.gc(dry_run=True) == {'blobs': 2, 'removed': 1, 'removed_bytes': 5}
+    assert storage.gc() == {'blobs': 2, 'removed': 1, 'removed_bytes': 5}
+    assert storage.gc() == {'blobs': 1, 'removed': 0, 'removed_bytes': 0}
+    assert (tmp_path / 'u' / 'gps' / 'b.csv').read_bytes() == b'same'
+
+
+def test_dedup_storage_gc_matches_content(tmp_path):
+    storage = mano.storage.DedupStorage(str(tmp_path))
+    for target, content in (('u/gps/a.csv', b'same'), ('u/gps/b.csv', b'other')):
+        with storage.writer(target) as fo:
+            fo.write(content)
+    # a reflink is a file of its own with the content of its blob, and another file has the CRC and
+    # size of the other blob but not its content
+    os.remove(tmp_path / 'u' / 'gps' / 'a.csv')
+    (tmp_path / 'u' / 'gps' / 'a.csv').write_bytes(b'same')
+    os.remove(tmp_path / 'u' / 'gps' / 'b.csv')
+    (tmp_path / 'u' / 'gps' / 'c.csv').write_bytes(b'OTHER')
+    with open(tmp_path / 'u' / '.manifest', 'w') as fo:
+        fo.write(json.dumps({'target': 'u/gps/a.csv', 'size': 4, 'crc': zlib.crc32(b'same')}) + '\n')
+        fo.write(json.dumps({'target': 'u/gps/c.csv', 'size': 5, 'crc': zlib.crc32(b'other')}) + '\n')
+    assert storage.gc() == {'blobs': 2, 'removed': 1, 'removed_bytes': 5}
+    assert storage.candidates(zlib.crc32(b'same'), 4)
+    assert not storage.candidates(zlib.crc32(b'other'), 5)
+
+
+def test_dedup_storage_gc_waits_for_writers(tmp_path):
+    storage = mano.storage.DedupStorage(str(tmp_path))
+    with storage._lock():
+        # a blob that was just stored is not linked to its target yet
+        blob_dir = tmp_path / '.blobs' / 'abcdef12'
+        blob_dir.mkdir()
+        (blob_dir / '4-digest').write_bytes(b'same')
+        collector = threading.Thread(target=storage.gc)
+        collector.start()
+        collector.join(0.2)
+        assert collector.is_alive()
+        os.link(blob_dir / '4-digest', tmp_path / 'a.csv')
+    collector.join()
+    assert (blob_dir / '4-digest').exists()
+
+
+def test_dedup_storage_failed_write(tmp_path):
+    storage = mano.storage.DedupStorage(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        with storage.writer(GPS_MEMBER) as fo:
+            fo.write(b'partial')
+            raise RuntimeError()
+    assert not storage.exists(GPS_MEMBER)
+    assert not os.listdir(tmp_path / '.blobs' / 'tmp')
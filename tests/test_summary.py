@@ -0,0 +1,59 @@
+"""
+Tests for the incremental summary of saved data
+"""
+import os
+import shutil
+from datetime import datetime
+
+import pytest
+
+import mano.cli
+import mano.summary
+import mano.sync
+
+
+@pytest.fixture
+def saved_dir(keyring, mock_archive, mock_user_id, tmp_path):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), compress={'gps': 'gzip'})
+    return tmp_path
+
+
+def test_query(saved_dir, mock_user_id):
+    rows = list(mano.summary.query(str(saved_dir), data_streams=['gps']))
+    assert [(row['day'], row['files'], row['first'], row['last']) for row in rows] == [
+        ('2018-06-15', 8, 16, 23),
+        ('2018-06-16', 21, 0, 20),
+    ]
+    gps_dir = saved_dir / mock_user_id / 'gps'
+    assert sum(row['bytes'] for row in rows) == sum(
+        os.path.getsize(gps_dir / name) for name in os.listdir(gps_dir))
+    assert rows[0]['member_bytes'] > rows[0]['bytes']
+
+    rows = list(mano.summary.query(str(saved_dir), start=datetime(2018, 6, 16), end=datetime(2018, 6, 17)))
+    assert [(row['data_stream'], row['day']) for row in rows] == [('gps', '2018-06-16')]
+
+
+def test_save_is_idempotent(keyring, mock_archive, mock_user_id, saved_dir):
+    before = list(mano.summary.query(str(saved_dir)))
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(saved_dir), compress={'gps': 'gzip'})
+    assert list(mano.summary.query(str(saved_dir))) == before
+    totals = mano.summary.totals(before)
+    assert [(total['data_stream'], total['days'], total['files'], total['first'], total['last'])
+            for total in totals] == [('gps', 2, 29, '2018-06-15', '2018-06-16'),
+                                     ('identifiers', 1, 1, '2018-06-15', '2018-06-15')]
+
+
+def test_rebuild_from_manifest(saved_dir, mock_user_id):
+    before = list(mano.summary.query(str(saved_dir)))
+    shutil.rmtree(mano.summary.summary_dir(str(saved_dir), mock_user_id))
+    assert list(mano.summary.query(str(saved_dir))) == []
+    assert mano.summary.rebuild(str(saved_dir), mock_user_id) == 30
+    assert list(mano.summary.query(str(saved_dir))) == before
+
+
+def test_cli(saved_dir, capsys):
+    mano.cli.main(['summary', '--output-dir', str(saved_dir), '--totals', '--data-stream', 'gps'])
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == 'user_id,data_stream,days,files,bytes,member_bytes,first,last'
+    assert lines[1].startswith('6y6s1w4g,gps,2,29,')
+    assert len(lines) == 2
@@ -1,12 +1,16 @@
 """
 Tests for mano.sync module download functionality.
 """
+import errno
+import os
 import zipfile
 
 import pytest
 import requests
 import responses
 
+import mano.archive
+import mano.memory
 import mano.sync
 
 
@@ -221,3 +225,87 @@ def test_download_connection_error(keyring):
                 time_start='2018-06-15T00:00:00',
                 time_end='2018-06-17T00:00:00'
             )
+
+
+def _stored_archive(path, user_id, content):
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr('registry', '{"a": "b"}')
+        zf.writestr(f'{user_id}/gps/2018-06-16 11_00_00.csv', content)
+    return zipfile.ZipFile(path)
+
+
+def test_save_copies_stored_members_in_kernel(keyring, mock_user_id, tmp_path, monkeypatch):
+    content = b'timestamp,UTC time,latitude\n' * 1000
+    archive = _stored_archive(tmp_path / 'download.zip', mock_user_id, content)
+    copies = []
+    monkeypatch.setattr(mano.sync, '_pread_write', lambda *args: copies.append(args) or 0)
+    # copy_file_range is not supported by every file system, sendfile is used instead
+    copy_file_range = mano.sync._copy_file_range
+    monkeypatch.setattr(mano.sync, '_copy_file_range', lambda *args: copies.append(args) or copy_file_range(*args))
+
+    assert mano.sync.save(keyring, archive, mock_user_id, str(tmp_path / 'output')) == 1
+    assert len(copies) == 1
+    target = tmp_path / 'output' / mock_user_id / 'gps' / '2018-06-16 11_00_00.csv'
+    assert target.read_bytes() == content
+
+
+def test_save_copies_stored_members_of_kept_archives(keyring, mock_user_id, tmp_path, monkeypatch):
+    content = b'timestamp,UTC time,latitude\n' * 1000
+    _stored_archive(tmp_path / 'download.zip', mock_user_id, content).close()
+    copies = []
+    copy_file_range = mano.sync._copy_file_range
+    monkeypatch.setattr(mano.sync, '_copy_file_range', lambda *args: copies.append(args) or copy_file_range(*args))
+
+    # kept archives are read through a memory map, like the archives download returns
+    with mano.archive.open_archive(str(tmp_path / 'download.zip')) as archive:
+        assert mano.sync.save(keyring, archive, mock_user_id, str(tmp_path / 'output')) == 1
+    assert len(copies) == 1
+    target = tmp_path / 'output' / mock_user_id / 'gps' / '2018-06-16 11_00_00.csv'
+    assert target.read_bytes() == content
+
+
+def test_save_stored_member_fallback(keyring, mock_user_id, tmp_path, monkeypatch):
+    content = b'1,2,3\n' * 100
+    archive = _stored_archive(tmp_path / 'download.zip', mock_user_id, content)
+
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, 'not supported')
+    monkeypatch.setattr(mano.sync, '_copy_file_range', unsupported)
+    monkeypatch.setattr(mano.sync, '_sendfile', unsupported)
+    mano.sync.save(keyring, archive, mock_user_id, str(tmp_path / 'output'))
+    target = tmp_path / 'output' / mock_user_id / 'gps' / '2018-06-16 11_00_00.csv'
+    assert target.read_bytes() == content
+
+
+def test_copy_stored_needs_a_readable_target(mock_user_id, tmp_path):
+    content = b'1,2,3\n' * 100
+    archive = _stored_archive(tmp_path / 'download.zip', mock_user_id, content)
+    info = archive.infolist()[-1]
+    # the copy could not be checked, so nothing is copied
+    with open(tmp_path / 'write-only', 'wb') as fo:
+        assert mano.sync._copy_stored(archive, info, fo) is None
+    assert (tmp_path / 'write-only').read_bytes() == b''
+    with open(tmp_path / 'readable', 'w+b') as fo:
+        assert mano.sync._copy_stored(archive, info, fo) == info.CRC
+    assert (tmp_path / 'readable').read_bytes() == content
+
+
+def test_copy_stored_skips_spilled_buffers(mock_user_id, tmp_path):
+    archive = _stored_archive(tmp_path / 'download.zip', mock_user_id, b'1,2,3\n' * 100)
+    # a buffer only knows its size and memory use from the bytes written through it
+    with mano.memory.spool(max_size=0, dir=str(tmp_path)) as spool:
+        spool.write(b'x')
+        assert spool.spilled
+        assert mano.sync._copy_stored(archive, archive.infolist()[-1], spool) is None
+        assert spool.size == 1
+
+
+def test_save_stored_member_bad_crc(keyring, mock_user_id, tmp_path):
+    path = tmp_path / 'download.zip'
+    _stored_archive(path, mock_user_id, b'1,2,3\n' * 100).close()
+    data = path.read_bytes()
+    offset = data.index(b'1,2,3')
+    path.write_bytes(data[:offset] + b'9' + data[offset + 1:])
+    with pytest.raises(zipfile.BadZipFile, match='CRC'):
+        mano.sync.save(keyring, zipfile.ZipFile(path), mock_user_id, str(tmp_path / 'output'))
+    assert not os.path.exists(tmp_path / 'output' / mock_user_id / 'gps' / '2018-06-16 11_00_00.csv')
@@ -0,0 +1,90 @@
+"""
+Tests for reading back locked (encrypted) files
+"""
+import os
+
+import pytest
+
+import mano.sync
+
+PASSPHRASE = 'correct horse battery staple'
+GPS_MEMBER = '6y6s1w4g/gps/2018-06-16 11_00_00.csv'
+
+
+@pytest.fixture
+def locked_dir(keyring, mock_archive, mock_user_id, tmp_path):
+    output_dir = tmp_path / 'output'
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(output_dir), lock=['gps'], passphrase=PASSPHRASE)
+    return output_dir
+
+
+def test_save_derives_a_key_per_save(keyring, mock_archive, mock_user_id, tmp_path, monkeypatch):
+    calls = []
+    kdf = mano.sync.crypt.kdf
+    monkeypatch.setattr(mano.sync.crypt, 'kdf', lambda *args: calls.append(args) or kdf(*args))
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), lock=['gps'], passphrase=PASSPHRASE)
+    assert len(calls) == 1
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), lock=['gps'], passphrase=PASSPHRASE)
+    assert len(calls) == 2
+    # files of a save share the salt, not the IV
+    salts, ivs = set(), set()
+    for path in (tmp_path / mock_user_id / 'gps').iterdir():
+        with open(path, 'rb') as fo:
+            header, _ = mano.sync.crypt.read_header(fo)
+            salts.add(header['kdf']['params']['salt'])
+            ivs.add(header['iv'])
+    assert (len(salts), len(ivs)) == (1, 29)
+
+
+def test_key_cache_derives_once_per_salt(monkeypatch):
+    calls = []
+    monkeypatch.setattr(mano.sync.crypt, 'kdf', lambda *args: calls.append(args) or object())
+    keys = mano.sync._KeyCache(PASSPHRASE)
+    header = {'kdf': {'params': {'salt': 'c2FsdA=='}}}
+    assert keys.get(header) is keys.get(dict(header))
+    keys.get({'kdf': {'params': {'salt': 'cGVwcGVy'}}})
+    assert len(calls) == 2
+
+
+def test_unlock_in_memory(locked_dir, mock_archive, mock_user_id, monkeypatch):
+    calls = []
+    kdf = mano.sync.crypt.kdf
+    monkeypatch.setattr(mano.sync.crypt, 'kdf', lambda *args: calls.append(args) or kdf(*args))
+
+    results = list(mano.sync.unlock(str(locked_dir), mock_user_id, 'gps', PASSPHRASE, max_workers=3))
+    assert len(results) == 29
+    assert [target for target, _ in results] == sorted(target for target, _ in results)
+    for target, content in results:
+        assert content == mock_archive.read(target[:-len(mano.sync.LOCK_EXT)])
+    # one key for the salt of the save
+    assert len(calls) == 1
+
+
+def test_unlock_time_range_to_destination(locked_dir, mock_archive, mock_user_id, tmp_path):
+    destination = tmp_path / 'shm'
+    results = list(mano.sync.unlock(str(locked_dir), mock_user_id, 'gps', PASSPHRASE,
+                                    time_start='2018-06-16T10:30:00', time_end='2018-06-16T12:00:00',
+                                    destination=str(destination)))
+    assert [target for target, _ in results] == [
+        '6y6s1w4g/gps/2018-06-16 10_00_00.csv.lock',
+        '6y6s1w4g/gps/2018-06-16 11_00_00.csv.lock',
+    ]
+    assert results[1][1] == os.path.join(destination, GPS_MEMBER)
+    with open(results[1][1], 'rb') as fo:
+        assert fo.read() == mock_archive.read(GPS_MEMBER)
+
+
+def test_unlock_compressed(keyring, mock_archive, mock_user_id, tmp_path):
+    mano.sync.save(keyring, mock_archive, mock_user_id, str(tmp_path), lock=['gps'], passphrase=PASSPHRASE,
+                   compress={'gps': 'gzip'})
+    target, content = next(mano.sync.unlock(str(tmp_path), mock_user_id, 'gps', PASSPHRASE))
+    assert target.endswith('.csv.gz.lock')
+    assert content == mock_archive.read(target[:-len('.gz.lock')])
+
+
+def test_open_saved_locked(locked_dir, mock_archive):
+    filename = str(locked_dir / (GPS_MEMBER + mano.sync.LOCK_EXT))
+    with pytest.raises(mano.sync.SaveError, match='passphrase'):
+        mano.sync.open_saved(filename)
+    with mano.sync.open_saved(filename, passphrase=PASSPHRASE) as fo:
+        assert fo.read() == mock_archive.read(GPS_MEMBER)
@@ -0,0 +1,149 @@
+"""
+Tests for the durable work queue
+"""
+from datetime import datetime, timedelta
+
+import pytest
+import responses
+
+import mano
+import mano.storage
+import mano.sync
+import mano.workqueue
+
+
+@pytest.fixture(params=['sqlite', 'file'])
+def queue(request, tmp_path):
+    if request.param == 'sqlite':
+        return mano.workqueue.open_queue(f'sqlite://{tmp_path}/queue.db', lease=60, max_attempts=2)
+    return mano.workqueue.open_queue(f'file://{tmp_path}/queue', lease=60, max_attempts=2)
+
+
+def item(user_id='u1'):
+    return mano.workqueue.WorkItem('STUDY', user_id, '2018-06-15T00:00:00', '2018-06-20T00:00:00')
+
+
+def test_put_is_idempotent(queue):
+    assert queue.put(item())
+    assert not queue.put(item())
+    assert queue.counts()['pending'] == 1
+
+
+def test_lease_and_complete(queue):
+    queue.put(item('u1'))
+    queue.put(item('u2'))
+    first = queue.lease('worker-1')
+    second = queue.lease('worker-2')
+    assert {first.user_id, second.user_id} == {'u1', 'u2'}
+    assert queue.lease('worker-3') is None
+
+    queue.heartbeat(first)
+    queue.complete(first)
+    assert queue.counts() == {'pending': 0, 'leased': 1, 'done': 1, 'dead': 0}
+    with pytest.raises(mano.workqueue.LeaseLost):
+        queue.complete(first)
+
+
+def test_expired_lease_is_reclaimed(queue, monkeypatch):
+    queue.put(item())
+    leased = queue.lease('crashed')
+    now = mano.workqueue.time.time()
+    monkeypatch.setattr(mano.workqueue.time, 'time', lambda: now + 120)
+
+    reclaimed = queue.lease('worker')
+    assert reclaimed.id == leased.id
+    assert reclaimed.attempts == 2
+    # the crashed worker no longer holds the lease
+    with pytest.raises(mano.workqueue.LeaseLost):
+        queue.heartbeat(leased)
+
+    # max attempts reached, the next expiry marks the item dead
+    monkeypatch.setattr(mano.workqueue.time, 'time', lambda: now + 240)
+    assert queue.lease('worker') is None
+    assert queue.counts()['dead'] == 1
+
+
+def test_fail_retries_then_dead(queue):
+    queue.put(item())
+    queue.fail(queue.lease('worker'), 'boom')
+    assert queue.counts()['pending'] == 1
+    queue.fail(queue.lease('worker'), 'boom')
+    assert queue.counts()['dead'] == 1
+
+
+def test_enqueue_and_work(queue, keyring, mock_zip_data, tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, '_window', lambda timestamp, window: (
+        timestamp, '2018-06-20T00:00:00', None))
+    added = mano.workqueue.enqueue_backfill(queue, keyring, 'STUDY', user_ids=['6y6s1w4g'],
+                                            start_date='2018-06-15T00:00:00', study_name='Project A')
+    assert added == 1
+
+    worker = mano.workqueue.Worker(queue, keyring, str(tmp_path / 'output'))
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        assert worker.run() == 1
+    assert queue.counts()['done'] == 1
+    assert (tmp_path / 'output' / 'Project A' / '6y6s1w4g' / 'gps' / '2018-06-15 16_00_00.csv').exists()
+    # the worker moved the backfill file forward, so nothing is queued again
+    assert (tmp_path / 'output' / 'Project A' / '6y6s1w4g' / '.backfill').read_text() == 'COMPLETE'
+    assert mano.workqueue.enqueue_backfill(queue, keyring, 'STUDY', user_ids=['6y6s1w4g'],
+                                           start_date='2018-06-15T00:00:00', study_name='Project A',
+                                           output_dir=str(tmp_path / 'output')) == 0
+
+
+def test_worker_saves_like_sync(queue, keyring, mock_zip_data, tmp_path, monkeypatch):
+    monkeypatch.setattr(mano.sync, '_window', lambda timestamp, window: (
+        timestamp, '2018-06-20T00:00:00', None))
+    mano.workqueue.enqueue_backfill(queue, keyring, 'STUDY', user_ids=['6y6s1w4g'], start_date='2018-06-15T00:00:00')
+    worker = mano.workqueue.Worker(queue, keyring, str(tmp_path), lock=['identifiers'], passphrase='secret',
+                                   compress={'gps': 'gzip'}, storage=mano.storage.DedupStorage)
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        assert worker.run() == 1
+    user_dir = tmp_path / 'STUDY' / '6y6s1w4g'
+    assert (user_dir / 'gps' / '2018-06-15 16_00_00.csv.gz').stat().st_nlink == 2
+    assert len(list((user_dir / 'identifiers').glob('*.lock'))) == 1
+    assert (tmp_path / 'STUDY' / '.blobs').is_dir()
+
+
+def test_lease_in_queued_order(queue):
+    for user_id in ('u3', 'u1', 'u2'):
+        queue.put(item(user_id))
+    leased = queue.lease('worker')
+    queue.fail(leased, 'boom')
+    # a retried item keeps its place
+    assert [queue.lease('worker').user_id for _ in range(3)] == ['u3', 'u1', 'u2']
+
+
+def test_enqueue_same_windows_once(queue, keyring):
+    start_date = (datetime.today() - timedelta(days=7)).strftime(mano.TIME_FORMAT)
+    added = mano.workqueue.enqueue_backfill(queue, keyring, 'STUDY', user_ids=['u1'], start_date=start_date)
+    assert added == 2
+    # the last window now ends later, but it is the same window
+    assert mano.workqueue.enqueue_backfill(queue, keyring, 'STUDY', user_ids=['u1'], start_date=start_date) == 0
+
+
+def test_worker_skips_saved_window(queue, keyring, tmp_path):
+    user_dir = tmp_path / 'output' / 'STUDY' / 'u1'
+    user_dir.mkdir(parents=True)
+    (user_dir / '.backfill').write_text('2018-06-20T00:00:00')
+    queue.put(mano.workqueue.WorkItem('STUDY', 'u1', '2018-06-15T00:00:00', '2018-06-20T00:00:00',
+                                      start_date='2018-06-15T00:00:00'))
+    worker = mano.workqueue.Worker(queue, keyring, str(tmp_path / 'output'))
+    # no download is requested
+    with responses.RequestsMock():
+        assert worker.run() == 1
+    assert queue.counts()['done'] == 1
+
+
+def test_worker_finishes_window_as_queued(queue, keyring, mock_zip_data, tmp_path, monkeypatch):
+    start_date = (datetime.today() - timedelta(days=2)).strftime(mano.TIME_FORMAT)
+    assert mano.workqueue.enqueue_backfill(queue, keyring, 'STUDY', user_ids=['6y6s1w4g'], start_date=start_date) == 1
+    # the window is worked on long after it was queued
+    later = datetime.today() + timedelta(days=10)
+    monkeypatch.setattr(mano.sync, 'datetime', type('datetime', (datetime,), {'today': staticmethod(lambda: later)}))
+    worker = mano.workqueue.Worker(queue, keyring, str(tmp_path / 'output'))
+    with responses.RequestsMock() as rsps:
+        rsps.add(responses.POST, keyring['URL'] + '/get-data/v1', body=mock_zip_data)
+        assert worker.run() == 1
+    assert (tmp_path / 'output' / 'STUDY' / '6y6s1w4g' / '.backfill').read_text() == 'COMPLETE'